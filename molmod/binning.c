@@ -0,0 +1,75 @@
+// MolMod is a collection of molecular modelling tools for python.
+// Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+// for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+// reserved unless otherwise stated.
+//
+// This file is part of MolMod.
+//
+// MolMod is free software; you can redistribute it and/or
+// modify it under the terms of the GNU General Public License
+// as published by the Free Software Foundation; either version 3
+// of the License, or (at your option) any later version.
+//
+// MolMod is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>
+//
+//--
+
+
+
+#include <math.h>
+#include "common.h"
+
+
+int binning_pairs(
+  int begin, int end, int nbins0, int nshift, int *neighbors,
+  int *offsets0, int *atoms0, int nbins1, int *offsets1, int *atoms1,
+  int n0, double *cor0, int *species0, int n1, double *cor1, int *species1,
+  int ntable, double *table, int intra, int periodic, double *matrix,
+  double *reciprocal, int capacity, int *pairs, double *deltas,
+  double *distances
+) {
+  // Compute all pairs below the cutoff for the bins0 in [begin,end[.
+  // neighbors[b0*nshift+k] is the index of the k-th neighboring bin in bins1,
+  // or -1 if that bin is empty. Only the first `capacity` pairs are stored,
+  // but all pairs are counted, such that the caller can retry with larger
+  // buffers.
+  int b0, b1, k, a0, a1, i0, i1, count;
+  double delta[3], d;
+
+  count = 0;
+  for (b0=begin; b0<end; b0++) {
+    for (k=0; k<nshift; k++) {
+      b1 = neighbors[b0*nshift+k];
+      if (b1 < 0) continue;
+      for (a0=offsets0[b0]; a0<offsets0[b0+1]; a0++) {
+        i0 = atoms0[a0];
+        for (a1=offsets1[b1]; a1<offsets1[b1+1]; a1++) {
+          i1 = atoms1[a1];
+          if (intra && (i1 >= i0)) continue;
+          if (periodic) {
+            d = distance_delta_periodic(cor1 + 3*i1, cor0 + 3*i0, delta, matrix, reciprocal);
+          } else {
+            d = distance_delta(cor1 + 3*i1, cor0 + 3*i0, delta);
+          }
+          if (d > table[species0[i0]*ntable + species1[i1]]) continue;
+          if (count < capacity) {
+            pairs[2*count  ] = i0;
+            pairs[2*count+1] = i1;
+            deltas[3*count  ] = delta[0];
+            deltas[3*count+1] = delta[1];
+            deltas[3*count+2] = delta[2];
+            distances[count] = d;
+          }
+          count++;
+        }
+      }
+    }
+  }
+  return count;
+}
@@ -36,11 +36,19 @@ from molmod.unit_cells import UnitCell
 import numpy
 
 
-__all__ = ["PairSearchIntra", "PairSearchInter"]
+__all__ = ["PairSearchIntra", "PairSearchInter", "PairSearchImages",
+           "NeighborList"]
 
 
 class Binning(object):
-    """Division of coordinates in regular bins"""
+    """Division of coordinates in regular bins
+
+       The bins are stored in a compact (CSR) format. The atoms are sorted by
+       bin, such that the atoms in bin ``b`` are given by
+       ``atoms[offsets[b]:offsets[b+1]]``. Only non-empty bins are stored. The
+       integer coordinates of bin ``b`` are ``keys[b]``. In case of periodic
+       systems, the keys are wrapped into the central cell.
+    """
     def __init__(self, coordinates, cutoff, grid_cell, integer_cell=None):
         """Initialize a Binning object
 
@@ -60,55 +68,285 @@ class Binning(object):
         """
         self.grid_cell = grid_cell
         self.integer_cell = integer_cell
+        self.coordinates = numpy.asarray(coordinates, float).reshape(-1, 3)
 
-        # setup the bins
-        self._bins = {}
+        # compute the integer bin coordinates of all atoms
+        keys = numpy.floor(grid_cell.to_fractional(self.coordinates)).astype(int)
+        if integer_cell is not None:
+            keys = self.wrap_keys(keys)
 
-        fractional = grid_cell.to_fractional(coordinates)
-        for i in xrange(len(coordinates)):
-            key = tuple(fractional[i].astype(int))
-            if integer_cell is not None:
-                key = self.wrap_key(key)
-            bin = self._bins.get(key)
-            if bin is None:
-                bin = []
-                self._bins[key] = bin
-            bin.append((i, coordinates[i]))
+        # flat bin ids, relative to the box that encloses all keys
+        if len(keys) > 0:
+            self._origin = keys.min(axis=0)
+            self._shape = keys.max(axis=0) - self._origin + 1
+        else:
+            self._origin = numpy.zeros(3, int)
+            self._shape = numpy.ones(3, int)
+        flat = self._get_flat(keys)
+
+        # sort the atoms by bin and store the offsets of the bins
+        self.atoms = flat.argsort(kind="mergesort")
+        flat = flat[self.atoms]
+        first = numpy.ones(len(flat), bool)
+        first[1:] = flat[1:] != flat[:-1]
+        first = first.nonzero()[0]
+        self._flat = flat[first]
+        self.keys = keys[self.atoms[first]]
+        self.offsets = numpy.zeros(len(first)+1, int)
+        self.offsets[:-1] = first
+        self.offsets[-1] = len(flat)
 
         # compute the neigbouring bins within the cutoff
+        self.neighbor_indexes = self._get_neighbor_indexes(cutoff)
+
+        # the periodic boundary conditions in Cartesian coordinates
+        if integer_cell is None:
+            self.unit_cell = None
+        else:
+            self.unit_cell = UnitCell(
+                numpy.dot(grid_cell.matrix, integer_cell.matrix),
+                integer_cell.active
+            )
+
+    def _get_neighbor_indexes(self, radius):
+        """Return the relative keys of all bins within the given radius"""
         if self.integer_cell is None:
-            self.neighbor_indexes = grid_cell.get_radius_indexes(cutoff)
+            return self.grid_cell.get_radius_indexes(radius)
         else:
             max_ranges = numpy.diag(self.integer_cell.matrix).astype(int)
             max_ranges[True^self.integer_cell.active] = -1
-            self.neighbor_indexes = grid_cell.get_radius_indexes(cutoff, max_ranges)
+            return self.grid_cell.get_radius_indexes(radius, max_ranges)
+
+    num_bins = property(lambda self: len(self.keys),
+        doc="The number of non-empty bins")
 
     def __iter__(self):
-        """Iterate over (key,bin) pairs"""
-        return self._bins.iteritems()
+        """Iterate over (key,bin) pairs
+
+           Each bin is an array with the indexes of the atoms in that bin.
+        """
+        for b in xrange(self.num_bins):
+            yield tuple(self.keys[b]), self.get_atoms(b)
+
+    def _get_flat(self, keys):
+        """Convert (wrapped) keys into flat bin ids, -1 if outside the box"""
+        relative = keys - self._origin
+        flat = numpy.zeros(len(keys), int)
+        for i in xrange(3):
+            flat *= self._shape[i]
+            flat += relative[:,i]
+        outside = ((relative < 0) | (relative >= self._shape)).any(axis=1)
+        flat[outside] = -1
+        return flat
+
+    def get_atoms(self, b):
+        """Return the indexes of the atoms in bin ``b``"""
+        return self.atoms[self.offsets[b]:self.offsets[b+1]]
+
+    def lookup(self, keys):
+        """Return the bin indexes for an array with keys, -1 for empty bins
+
+           Argument:
+            | ``keys``  --  an integer array with shape (K,3)
+        """
+        keys = numpy.asarray(keys, int).reshape(-1, 3)
+        if self.integer_cell is not None:
+            keys = self.wrap_keys(keys)
+        flat = self._get_flat(keys)
+        result = self._flat.searchsorted(flat)
+        result[result == len(self._flat)] = 0
+        if len(self._flat) > 0:
+            result[(self._flat[result] != flat) | (flat < 0)] = -1
+        else:
+            result[:] = -1
+        return result
 
     def iter_surrounding(self, center_key):
         """Iterate over all bins surrounding the given bin"""
-        for shift in self.neighbor_indexes:
-            key = tuple(numpy.add(center_key, shift).astype(int))
-            if self.integer_cell is not None:
-                key = self.wrap_key(key)
-            bin = self._bins.get(key)
-            if bin is not None:
-                yield key, bin
+        bs = self.lookup(numpy.add(center_key, self.neighbor_indexes))
+        for b in bs[bs >= 0]:
+            yield tuple(self.keys[b]), self.get_atoms(b)
+
+    def _query_chunk(self, points, radius, neighbor_indexes):
+        """Find all atoms within a radius of a (small) set of points
+
+           Returns: ``point_indexes``, ``atom_indexes``, ``distances`` sorted
+           by point and distance.
+        """
+        counts = self.offsets[1:] - self.offsets[:-1]
+        keys = numpy.floor(self.grid_cell.to_fractional(points)).astype(int)
+        all_points = []
+        all_atoms = []
+        all_distances = []
+        for shift in neighbor_indexes:
+            bs = self.lookup(keys + shift)
+            ps = (bs >= 0).nonzero()[0]
+            bs = bs[ps]
+            sizes = counts[bs]
+            total = sizes.sum()
+            if total == 0:
+                continue
+            # enumerate the atoms in the bins of each point
+            owner = numpy.repeat(numpy.arange(len(ps)), sizes)
+            local = numpy.arange(total) - (sizes.cumsum() - sizes)[owner]
+            ps = ps[owner]
+            atoms = self.atoms[self.offsets[bs][owner] + local]
+            deltas = self.coordinates[atoms] - points[ps]
+            if self.unit_cell is not None:
+                deltas = self.unit_cell.shortest_vector(deltas)
+            distances = numpy.sqrt((deltas**2).sum(axis=1))
+            mask = distances <= radius
+            all_points.append(ps[mask])
+            all_atoms.append(atoms[mask])
+            all_distances.append(distances[mask])
+        if len(all_points) == 0:
+            return numpy.zeros(0, int), numpy.zeros(0, int), numpy.zeros(0, float)
+        ps = numpy.concatenate(all_points)
+        atoms = numpy.concatenate(all_atoms)
+        distances = numpy.concatenate(all_distances)
+        order = numpy.lexsort((atoms, distances, ps))
+        return ps[order], atoms[order], distances[order]
+
+    def query_radius(self, points, radius, chunk_size=10000):
+        """Find all atoms within a radius of each point
+
+           Arguments:
+            | ``points``  --  a Px3 numpy array with Cartesian coordinates
+            | ``radius``  --  the maximum distance between a point and an atom
+
+           Optional argument:
+            | ``chunk_size``  --  the number of points that are processed at
+                                  once. This limits the memory usage.
+                                  [default=10000]
+
+           Returns: ``indptr``, ``indices``, ``distances`` in CSR format. The
+           atoms near point ``p`` are ``indices[indptr[p]:indptr[p+1]]``,
+           sorted by increasing distance. The binning itself is reused, so
+           the points are not binned. In case of periodic systems, the minimum
+           image convention is applied.
+        """
+        points = numpy.asarray(points, float).reshape(-1, 3)
+        neighbor_indexes = self._get_neighbor_indexes(radius)
+        indptr = numpy.zeros(len(points)+1, int)
+        all_atoms = []
+        all_distances = []
+        for begin in xrange(0, len(points), chunk_size):
+            end = min(begin + chunk_size, len(points))
+            ps, atoms, distances = self._query_chunk(
+                points[begin:end], radius, neighbor_indexes
+            )
+            indptr[begin+1:end+1] = numpy.bincount(ps, minlength=end-begin)
+            all_atoms.append(atoms)
+            all_distances.append(distances)
+        indptr = indptr.cumsum()
+        if len(all_atoms) == 0:
+            return indptr, numpy.zeros(0, int), numpy.zeros(0, float)
+        return indptr, numpy.concatenate(all_atoms), numpy.concatenate(all_distances)
+
+    def query_nearest(self, points, k, chunk_size=10000):
+        """Find the k nearest atoms of each point
+
+           Arguments:
+            | ``points``  --  a Px3 numpy array with Cartesian coordinates
+            | ``k``  --  the number of atoms to find for each point
+
+           Optional argument:
+            | ``chunk_size``  --  the number of points that are processed at
+                                  once. [default=10000]
+
+           Returns: ``indices``, ``distances``, both arrays with shape (P,k)
+           sorted by increasing distance.
+
+           The search radius starts at the size of a bin and is doubled for
+           the points that have less than k atoms within the radius. As soon
+           as the number of bins to scan exceeds the number of non-empty bins,
+           the remaining points are compared with all atoms. Ties are
+           resolved in favor of the lowest atom index.
+        """
+        points = numpy.asarray(points, float).reshape(-1, 3)
+        if k < 1 or k > len(self.coordinates):
+            raise ValueError("k must be in the range [1, number of atoms].")
+        indices = numpy.zeros((len(points), k), int)
+        distances = numpy.zeros((len(points), k), float)
+        todo = numpy.arange(len(points))
+        radius = self.grid_cell.spacings.max()
+        while len(todo) > 0:
+            neighbor_indexes = self._get_neighbor_indexes(radius)
+            if len(neighbor_indexes) > self.num_bins:
+                # compare the remaining points with all atoms
+                size = max(1, 1000000//len(self.coordinates))
+                for begin in xrange(0, len(todo), size):
+                    chunk = todo[begin:begin+size]
+                    deltas = self.coordinates - points[chunk].reshape(-1, 1, 3)
+                    if self.unit_cell is not None:
+                        deltas = self.unit_cell.shortest_vector(deltas.reshape(-1, 3))
+                    ds = numpy.sqrt((deltas**2).sum(axis=-1)).reshape(len(chunk), -1)
+                    atoms = ds.argsort(axis=1, kind="mergesort")[:,:k]
+                    indices[chunk] = atoms
+                    distances[chunk] = ds[numpy.arange(len(chunk)).reshape(-1, 1), atoms]
+                break
+            left = []
+            for begin in xrange(0, len(todo), chunk_size):
+                chunk = todo[begin:begin+chunk_size]
+                ps, atoms, ds = self._query_chunk(points[chunk], radius, neighbor_indexes)
+                found = numpy.bincount(ps, minlength=len(chunk))
+                first = found.cumsum() - found
+                complete = (found >= k).nonzero()[0]
+                select = (first[complete].reshape(-1, 1) + numpy.arange(k)).ravel()
+                indices[chunk[complete]] = atoms[select].reshape(-1, k)
+                distances[chunk[complete]] = ds[select].reshape(-1, k)
+                left.append(chunk[found < k])
+            todo = numpy.concatenate(left)
+            radius *= 2
+        return indices, distances
 
     def wrap_key(self, key):
         """Translate the key into the central cell
 
            This method is only applicable in case of a periodic system.
         """
-        return tuple(numpy.round(
-            self.integer_cell.shortest_vector(key)
-        ).astype(int))
+        return tuple(self.wrap_keys(numpy.array([key]))[0])
+
+    def wrap_keys(self, keys):
+        """Translate an array of keys into the central cell
+
+           This method is only applicable in case of a periodic system.
+        """
+        return numpy.round(
+            self.integer_cell.shortest_vector(keys)
+        ).astype(int)
 
 
 class PairSearchBase(object):
     """Base class for :class:`PairSearchIntra` and :class:`PairSearchInter`"""
+    def _setup_cutoff(self, cutoff):
+        """Split the cutoff argument in a global cutoff and a cutoff table"""
+        if isinstance(cutoff, numpy.ndarray):
+            if len(cutoff.shape) != 2 or cutoff.shape[0] != cutoff.shape[1]:
+                raise TypeError("A cutoff table must be a square matrix.")
+            self.cutoff_table = cutoff
+            self.cutoff = cutoff.max()
+        else:
+            self.cutoff_table = None
+            self.cutoff = cutoff
+
+    def _check_species(self, species, coordinates):
+        """Check the per-atom species that are used with the cutoff table"""
+        if self.cutoff_table is None:
+            if species is not None:
+                raise TypeError("Species can only be used with a cutoff table.")
+            return None
+        if species is None:
+            raise TypeError("A cutoff table requires the species of the atoms.")
+        species = numpy.asarray(species, int)
+        if species.shape != (len(coordinates),):
+            raise TypeError("There must be one species for each atom.")
+        if len(species) > 0 and (species.min() < 0 or
+                                 species.max() >= len(self.cutoff_table)):
+            raise ValueError("The species must be valid indexes in the cutoff "
+                             "table.")
+        return species
+
     def _setup_grid(self, cutoff, unit_cell, grid):
         """Choose a proper grid for the binning process"""
         if grid is None:
@@ -147,6 +385,153 @@ class PairSearchBase(object):
 
         return grid_cell, integer_cell
 
+    def _compute_arrays(self, bins0, bins1, intra, species0=None, species1=None):
+        """Compute all pairs below the cutoff
+
+           Arguments:
+            | ``bins0``  --  the binning of the first set of coordinates
+            | ``bins1``  --  the binning of the second set of coordinates
+            | ``intra``  --  when True, only pairs with i0 > i1 are retained
+
+           Optional arguments:
+            | ``species0``  --  the species of the first set of coordinates
+            | ``species1``  --  the species of the second set of coordinates
+
+           The species are only used in combination with a cutoff table.
+
+           The loop runs over the relative positions of neighboring bins. For
+           each relative position, all pairs of atoms in all pairs of bins are
+           generated at once with integer arithmetic on the CSR arrays.
+        """
+        all_pairs = []
+        all_deltas = []
+        all_distances = []
+        counts0 = bins0.offsets[1:] - bins0.offsets[:-1]
+        counts1 = bins1.offsets[1:] - bins1.offsets[:-1]
+        for shift in bins0.neighbor_indexes:
+            b1 = bins1.lookup(bins0.keys + shift)
+            b0 = (b1 >= 0).nonzero()[0]
+            b1 = b1[b0]
+            sizes = counts0[b0]*counts1[b1]
+            total = sizes.sum()
+            if total == 0:
+                continue
+            # enumerate the pairs of atoms within each pair of bins
+            owner = numpy.repeat(numpy.arange(len(b0)), sizes)
+            local = numpy.arange(total) - (sizes.cumsum() - sizes)[owner]
+            width = counts1[b1][owner]
+            i0 = bins0.atoms[bins0.offsets[b0][owner] + local//width]
+            i1 = bins1.atoms[bins1.offsets[b1][owner] + local%width]
+            if intra:
+                mask = i1 < i0
+                i0 = i0[mask]
+                i1 = i1[mask]
+            deltas = bins1.coordinates[i1] - bins0.coordinates[i0]
+            if self.unit_cell is not None:
+                deltas = self.unit_cell.shortest_vector(deltas)
+            distances = numpy.sqrt((deltas**2).sum(axis=1))
+            if self.cutoff_table is None:
+                mask = distances <= self.cutoff
+            else:
+                mask = distances <= self.cutoff_table[species0[i0], species1[i1]]
+            pairs = numpy.zeros((mask.sum(), 2), int)
+            pairs[:,0] = i0[mask]
+            pairs[:,1] = i1[mask]
+            all_pairs.append(pairs)
+            all_deltas.append(deltas[mask])
+            all_distances.append(distances[mask])
+        if len(all_pairs) == 0:
+            return numpy.zeros((0, 2), int), numpy.zeros((0, 3), float), \
+                   numpy.zeros(0, float)
+        return numpy.concatenate(all_pairs), numpy.concatenate(all_deltas), \
+               numpy.concatenate(all_distances)
+
+    def _compute_arrays_threaded(self, bins0, bins1, intra, species0=None, species1=None):
+        """Compute all pairs below the cutoff with the C routine binning_pairs
+
+           The arguments are the same as for :meth:`_compute_arrays`. The bins
+           of ``bins0`` are divided into blocks with a similar amount of work.
+           The blocks are processed by a pool of ``self.num_threads`` threads,
+           which run simultaneously because the C routine releases the GIL.
+        """
+        from molmod.ext import binning_pairs
+        if bins0.num_bins == 0 or bins1.num_bins == 0:
+            return numpy.zeros((0, 2), int), numpy.zeros((0, 3), float), \
+                   numpy.zeros(0, float)
+
+        # table with the neighboring bins in bins1 of each bin in bins0
+        neighbors = numpy.array([
+            bins1.lookup(bins0.keys + shift) for shift in bins0.neighbor_indexes
+        ], numpy.int32).transpose().copy()
+        # estimate the amount of work for each bin in bins0
+        counts0 = bins0.offsets[1:] - bins0.offsets[:-1]
+        counts1 = numpy.zeros(bins1.num_bins + 1, int)
+        counts1[:-1] = bins1.offsets[1:] - bins1.offsets[:-1]
+        work = (counts0*counts1[neighbors].sum(axis=1)).cumsum()
+        num_blocks = min(bins0.num_bins, 4*self.num_threads)
+        bounds = numpy.zeros(num_blocks + 1, int)
+        bounds[1:-1] = work.searchsorted(numpy.arange(1, num_blocks)*(work[-1]/float(num_blocks)))
+        bounds[-1] = bins0.num_bins
+
+        # the arguments that are the same for all blocks
+        if self.cutoff_table is None:
+            table = numpy.array([[self.cutoff]], float)
+            species0 = numpy.zeros(len(bins0.coordinates), numpy.int32)
+            species1 = numpy.zeros(len(bins1.coordinates), numpy.int32)
+        else:
+            table = numpy.asarray(self.cutoff_table, float)
+            species0 = species0.astype(numpy.int32)
+            species1 = species1.astype(numpy.int32)
+        args = (
+            neighbors, bins0.offsets.astype(numpy.int32),
+            bins0.atoms.astype(numpy.int32), bins1.offsets.astype(numpy.int32),
+            bins1.atoms.astype(numpy.int32), bins0.coordinates, species0,
+            bins1.coordinates, species1, table, intra,
+        )
+        if self.unit_cell is None:
+            cell_args = ()
+        else:
+            cell_args = (self.unit_cell.matrix, self.unit_cell.reciprocal)
+
+        def compute_block(block):
+            """Compute the pairs for one block, retry with larger buffers if needed"""
+            begin, end = bounds[block], bounds[block+1]
+            capacity = (work[end-1] - (work[begin-1] if begin > 0 else 0))//4 + 64
+            while True:
+                pairs = numpy.zeros((capacity, 2), numpy.int32)
+                deltas = numpy.zeros((capacity, 3), float)
+                distances = numpy.zeros(capacity, float)
+                count = binning_pairs(begin, end, *(args + (pairs, deltas, distances) + cell_args))
+                if count <= capacity:
+                    return pairs[:count], deltas[:count], distances[:count]
+                capacity = count
+
+        if self.num_threads > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(self.num_threads)
+            try:
+                results = pool.map(compute_block, xrange(num_blocks))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [compute_block(block) for block in xrange(num_blocks)]
+        pairs, deltas, distances = zip(*results)
+        return numpy.concatenate(pairs).astype(int), numpy.concatenate(deltas), \
+               numpy.concatenate(distances)
+
+    def _check_num_threads(self, num_threads):
+        """Check the number of threads for the C implementation"""
+        if num_threads is not None and num_threads < 1:
+            raise ValueError("The number of threads must be at least one.")
+        return num_threads
+
+    def __iter__(self):
+        """Iterate over all pairs with a distance below the cutoff"""
+        pairs, deltas, distances = self.arrays()
+        for (i0, i1), delta, distance in zip(pairs.tolist(), deltas, distances.tolist()):
+            yield i0, i1, delta, distance
+
 
 class PairSearchIntra(PairSearchBase):
     """Iterator over all pairs of coordinates with a distance below a cutoff.
@@ -157,16 +542,25 @@ class PairSearchIntra(PairSearchBase):
            for i, j, distance, delta in PairSearchIntra(coordinates, 2.5):
                print i, j, distance
 
+       All pairs can also be computed at once with the method ``arrays``, which
+       is much faster for large systems::
+
+           pairs, deltas, distances = PairSearchIntra(coordinates, 2.5).arrays()
+
        Note that for periodic systems the minimum image convention is applied.
     """
 
-    def __init__(self, coordinates, cutoff, unit_cell=None, grid=None):
+    def __init__(self, coordinates, cutoff, unit_cell=None, grid=None,
+                 species=None, num_threads=None):
         """
            Arguments:
             | ``coordinates``  --  A Nx3 numpy array with Cartesian coordinates
-            | ``radius``  --  The cutoff radius for the pair distances.
+            | ``cutoff``  --  The cutoff radius for the pair distances.
                               Distances larger than the cutoff will be neglected
-                              in the pair search.
+                              in the pair search. This may also be a square
+                              array with a cutoff for each pair of species.
+                              In that case, the bins are based on the largest
+                              cutoff in the table.
 
            Optional arguments:
             | ``unit_cell``  --  Specifies the periodic boundary conditions
@@ -179,6 +573,15 @@ class PairSearchIntra(PairSearchBase):
                         cell vectors (for those directions that are active in
                         the unit cell). If this is not the case, a ValueError is
                         raised.
+            | ``species``  --  An integer array with the species of each atom.
+                               This is only used with a cutoff table, e.g.
+                               the atom numbers in combination with a table of
+                               bond lengths.
+            | ``num_threads``  --  When given, the pairs are computed in a
+                                   compiled routine, distributed over this
+                                   number of threads. The order of the pairs
+                                   is different from the default numpy
+                                   implementation.
 
            The default value of grid depends on other parameters:
 
@@ -187,25 +590,30 @@ class PairSearchIntra(PairSearchBase):
                 as possible, with spacings below cutoff/2 that are integer
                 divisions of the unit cell spacings
         """
-        self.cutoff = cutoff
+        self._setup_cutoff(cutoff)
         self.unit_cell = unit_cell
-        grid_cell, integer_cell = self._setup_grid(cutoff, unit_cell, grid)
-        self.bins = Binning(coordinates, cutoff, grid_cell, integer_cell)
+        self.species = self._check_species(species, coordinates)
+        self.num_threads = self._check_num_threads(num_threads)
+        grid_cell, integer_cell = self._setup_grid(self.cutoff, unit_cell, grid)
+        self.bins = Binning(coordinates, self.cutoff, grid_cell, integer_cell)
+
+    def arrays(self):
+        """Compute all pairs with a distance below the cutoff at once
+
+           Returns: ``pairs``, ``deltas``, ``distances``
+
+           ``pairs`` is an integer array with shape (M,2), where each row
+           contains ``i0`` and ``i1`` as yielded by the iterator, i.e. with
+           ``i0 > i1``. ``deltas`` is an array with shape (M,3), containing the
+           relative vectors from ``i0`` to ``i1``. ``distances`` is an array
+           with shape (M,) with the norms of the relative vectors.
+        """
+        if self.num_threads is None:
+            compute = self._compute_arrays
+        else:
+            compute = self._compute_arrays_threaded
+        return compute(self.bins, self.bins, True, self.species, self.species)
 
-    def __iter__(self):
-        """Iterate over all pairs with a distance below the cutoff"""
-        for key0, bin0 in self.bins:
-            for key1, bin1 in self.bins.iter_surrounding(key0):
-                for i0, c0 in bin0:
-                    for i1, c1 in bin1:
-                        if i1 >= i0:
-                            continue
-                        delta = c1 - c0
-                        if self.unit_cell is not None:
-                            delta = self.unit_cell.shortest_vector(delta)
-                        distance = numpy.linalg.norm(delta)
-                        if distance <= self.cutoff:
-                            yield i0, i1, delta, distance
 
 class PairSearchInter(PairSearchBase):
     """Iterator over all pairs of coordinates with a distance below a cutoff.
@@ -217,17 +625,26 @@ class PairSearchInter(PairSearchBase):
            for i, j, distance, delta in PairSearchInter(coordinates0, coordinates1, 2.5):
                print i, j, distance
 
+       All pairs can also be computed at once with the method ``arrays``, which
+       is much faster for large systems::
+
+           pairs, deltas, distances = PairSearchInter(coordinates0, coordinates1, 2.5).arrays()
+
        Note that for periodic systems the minimum image convention is applied.
     """
 
-    def __init__(self, coordinates0, coordinates1, cutoff, unit_cell=None, grid=None):
+    def __init__(self, coordinates0, coordinates1, cutoff, unit_cell=None,
+                 grid=None, species0=None, species1=None, num_threads=None):
         """
            Arguments:
             | ``coordinates0``  --  A Nx3 numpy array with Cartesian coordinates
             | ``coordinates1``  --  A Nx3 numpy array with Cartesian coordinates
-            | ``radius``  --  The cutoff radius for the pair distances.
+            | ``cutoff``  --  The cutoff radius for the pair distances.
                               Distances larger than the cutoff will be neglected
-                              in the pair search.
+                              in the pair search. This may also be a square
+                              array with a cutoff for each pair of species.
+                              In that case, the bins are based on the largest
+                              cutoff in the table.
 
            Optional arguments:
             | ``unit_cell``  --  Specifies the periodic boundary conditions
@@ -240,6 +657,13 @@ class PairSearchInter(PairSearchBase):
                         cell vectors (for those directions that are active in
                         the unit cell). If this is not the case, a ValueError is
                         raised.
+            | ``species0``, ``species1``  --  Integer arrays with the species
+                        of each atom in both sets of coordinates. These are only
+                        used with a cutoff table.
+            | ``num_threads``  --  When given, the pairs are computed in a
+                                   compiled routine, distributed over this
+                                   number of threads. See
+                                   :class:`PairSearchIntra`.
 
            The default value of grid depends on other parameters:
              1) When no unit cell is given, it is equal to cutoff/2.9.
@@ -247,21 +671,249 @@ class PairSearchInter(PairSearchBase):
                 as possible, with spacings below cutoff/2 that are integer
                 divisions of the unit cell spacings
         """
-        self.cutoff = cutoff
+        self._setup_cutoff(cutoff)
         self.unit_cell = unit_cell
-        grid_cell, integer_cell = self._setup_grid(cutoff, unit_cell, grid)
-        self.bins0 = Binning(coordinates0, cutoff, grid_cell, integer_cell)
-        self.bins1 = Binning(coordinates1, cutoff, grid_cell, integer_cell)
+        self.species0 = self._check_species(species0, coordinates0)
+        self.species1 = self._check_species(species1, coordinates1)
+        self.num_threads = self._check_num_threads(num_threads)
+        grid_cell, integer_cell = self._setup_grid(self.cutoff, unit_cell, grid)
+        self.bins0 = Binning(coordinates0, self.cutoff, grid_cell, integer_cell)
+        self.bins1 = Binning(coordinates1, self.cutoff, grid_cell, integer_cell)
+
+    def arrays(self):
+        """Compute all pairs with a distance below the cutoff at once
+
+           Returns: ``pairs``, ``deltas``, ``distances``
+
+           ``pairs`` is an integer array with shape (M,2), where each row
+           contains an index in ``coordinates0`` and an index in
+           ``coordinates1``. ``deltas`` is an array with shape (M,3), containing
+           the relative vectors from the first to the second coordinate.
+           ``distances`` is an array with shape (M,) with the norms of the
+           relative vectors.
+        """
+        if self.num_threads is None:
+            compute = self._compute_arrays
+        else:
+            compute = self._compute_arrays_threaded
+        return compute(self.bins0, self.bins1, False, self.species0, self.species1)
+
+
+class PairSearchImages(PairSearchBase):
+    """Search for all pairs of periodic images with a distance below a cutoff.
+
+       Example usage::
+
+           pair_search = PairSearchImages(coordinates, 10.0, unit_cell)
+           pairs, images, deltas, distances = pair_search.arrays()
+
+       In contrast to :class:`PairSearchIntra`, the minimum image convention is
+       not applied. Each pair of atoms is returned for every periodic image
+       within the cutoff, also when the cutoff exceeds half of the spacings of
+       the unit cell. This includes pairs of an atom with its own images. Hence
+       the periodic system does not have to be replicated into a supercell.
+    """
+
+    def __init__(self, coordinates, cutoff, unit_cell, grid=None, species=None,
+                 num_threads=None):
+        """
+           Arguments:
+            | ``coordinates``  --  A Nx3 numpy array with Cartesian coordinates
+            | ``cutoff``  --  The cutoff radius for the pair distances. This
+                              may also be a square array with a cutoff for each
+                              pair of species, see :class:`PairSearchIntra`.
+            | ``unit_cell``  --  Specifies the periodic boundary conditions
+
+           Optional arguments:
+            | ``grid``  --  Specification of the grid for the binning of the
+                            atoms and the nearby images, a floating point number
+                            or a UnitCell object. [default=cutoff/2.9]
+            | ``species``  --  An integer array with the species of each atom.
+                               This is only used with a cutoff table.
+            | ``num_threads``  --  The number of threads for the compiled
+                                   pair search, see :class:`PairSearchIntra`.
+        """
+        self._setup_cutoff(cutoff)
+        self.unit_cell = unit_cell
+        self.coordinates = numpy.asarray(coordinates, float).reshape(-1, 3)
+        self.species = self._check_species(species, self.coordinates)
+        self.grid = grid
+        self.num_threads = self._check_num_threads(num_threads)
+
+    def _get_ghosts(self, fractional):
+        """Return the atom and image indexes of the relevant images
+
+           Argument:
+            | ``fractional``  --  the fractional coordinates of the atoms,
+                                  wrapped into the central cell
+
+           Only images that are within the cutoff of the central cell are
+           retained, i.e. their fractional coordinates may only exceed the
+           range [0,1[ by the cutoff divided by the spacing between the
+           crystal planes.
+        """
+        active = self.unit_cell.active
+        margins = numpy.zeros(3, float)
+        margins[active] = self.cutoff/self.unit_cell.spacings[active]
+        atoms = []
+        images = []
+        for image in self.unit_cell.get_radius_indexes(self.cutoff):
+            shifted = fractional + image
+            mask = ((shifted >= -margins) & (shifted < 1 + margins)).all(axis=1)
+            mask = mask.nonzero()[0]
+            atoms.append(mask)
+            images.append(numpy.repeat([image], len(mask), axis=0).reshape(-1, 3))
+        return numpy.concatenate(atoms), numpy.concatenate(images).astype(int)
+
+    def arrays(self):
+        """Compute all pairs of images with a distance below the cutoff
+
+           Returns: ``pairs``, ``images``, ``deltas``, ``distances``
+
+           ``pairs`` is an integer array with shape (M,2), where each row
+           contains ``i0`` and ``i1``. ``images`` is an integer array with
+           shape (M,3) with the fractional lattice translation of the image of
+           ``i1``. ``deltas`` is an array with shape (M,3), containing the
+           relative vectors from ``i0`` to the image of ``i1``, i.e.
+           ``coordinates[i1] - coordinates[i0] + unit_cell.to_cartesian(image)``.
+           ``distances`` is an array with shape (M,) with the norms of the
+           relative vectors.
+
+           Each periodic pair is returned only once: either ``i0 > i1``, or
+           ``i0 == i1`` and the image is a positive translation in
+           lexicographical order.
+        """
+        # wrap the atoms into the central cell
+        fractional = self.unit_cell.to_fractional(self.coordinates)
+        shifts = numpy.floor(fractional)
+        fractional -= shifts
+        wrapped = self.coordinates - self.unit_cell.to_cartesian(shifts)
+        shifts = shifts.astype(int)
+        # collect the images near the central cell and search for pairs
+        ghost_atoms, ghost_images = self._get_ghosts(fractional)
+        ghosts = wrapped[ghost_atoms] + self.unit_cell.to_cartesian(ghost_images)
+        if self.species is None:
+            cutoff = self.cutoff
+            species1 = None
+        else:
+            cutoff = self.cutoff_table
+            species1 = self.species[ghost_atoms]
+        grid = self.grid
+        if grid is None:
+            grid = self.cutoff/2.9
+        pair_search = PairSearchInter(
+            wrapped, ghosts, cutoff, None, grid, self.species, species1,
+            self.num_threads
+        )
+        pairs, deltas, distances = pair_search.arrays()
+        i0 = pairs[:,0]
+        i1 = ghost_atoms[pairs[:,1]]
+        images = ghost_images[pairs[:,1]]
+        # retain only one of (i0, i1, image) and (i1, i0, -image)
+        nonzero = images != 0
+        first = nonzero.argmax(axis=1)
+        positive = images[numpy.arange(len(images)), first] > 0
+        mask = (i0 > i1) | ((i0 == i1) & nonzero.any(axis=1) & positive)
+        # express the images in terms of the original coordinates
+        images = images[mask] + shifts[i0[mask]] - shifts[i1[mask]]
+        pairs = numpy.array([i0[mask], i1[mask]]).transpose().reshape(-1, 2)
+        return pairs, images, deltas[mask], distances[mask]
 
     def __iter__(self):
-        """Iterate over all pairs with a distance below the cutoff"""
-        for key0, bin0 in self.bins0:
-            for key1, bin1 in self.bins1.iter_surrounding(key0):
-                for i0, c0 in bin0:
-                    for i1, c1 in bin1:
-                        delta = c1 - c0
-                        if self.unit_cell is not None:
-                            delta = self.unit_cell.shortest_vector(delta)
-                        distance = numpy.linalg.norm(delta)
-                        if distance <= self.cutoff:
-                            yield i0, i1, delta, distance
+        """Iterate over all pairs of images with a distance below the cutoff"""
+        pairs, images, deltas, distances = self.arrays()
+        for (i0, i1), image, delta, distance in zip(pairs.tolist(), images, deltas, distances.tolist()):
+            yield i0, i1, image, delta, distance
+
+
+class NeighborList(object):
+    """A Verlet neighbor list that is reused for a series of geometries
+
+       Example usage::
+
+           neighbor_list = NeighborList(5.0, 1.0, unit_cell)
+           for coordinates in trajectory:
+               pairs, deltas, distances = neighbor_list.update(coordinates)
+
+       The list of candidate pairs is computed with a cutoff that is ``skin``
+       larger than the actual cutoff. As long as no atom has moved more than
+       half of the skin since the last rebuild, all pairs below the actual
+       cutoff are guaranteed to be among the candidates, and only the relative
+       vectors and the distances of the candidates are recomputed.
+
+       Note that for periodic systems the minimum image convention is applied.
+       The unit cell is assumed to be the same for all geometries.
+    """
+
+    def __init__(self, cutoff, skin, unit_cell=None, grid=None, num_threads=None):
+        """
+           Arguments:
+            | ``cutoff``  --  The cutoff radius for the pair distances.
+            | ``skin``  --  The additional margin for the candidate pairs.
+
+           Optional arguments:
+            | ``unit_cell``  --  Specifies the periodic boundary conditions
+            | ``grid``  --  Specification of the grid, see
+                            :class:`PairSearchIntra`. The grid is used for the
+                            cutoff ``cutoff+skin``.
+            | ``num_threads``  --  The number of threads for the compiled
+                                   pair search during a rebuild, see
+                                   :class:`PairSearchIntra`.
+        """
+        if skin < 0:
+            raise ValueError("The skin must not be negative.")
+        self.cutoff = cutoff
+        self.skin = skin
+        self.unit_cell = unit_cell
+        self.grid = grid
+        self.num_threads = num_threads
+        self.num_rebuilds = 0
+        self.pairs = None
+        self.deltas = None
+        self.distances = None
+        self._reference = None
+        self._candidates = None
+
+    def _needs_rebuild(self, coordinates):
+        """Test if some atom moved more than half the skin"""
+        if self._reference is None or self._reference.shape != coordinates.shape:
+            return True
+        displacements = coordinates - self._reference
+        if self.unit_cell is not None:
+            displacements = self.unit_cell.shortest_vector(displacements)
+        if len(displacements) == 0:
+            return False
+        return (displacements**2).sum(axis=1).max() > (0.5*self.skin)**2
+
+    def _rebuild(self, coordinates):
+        """Recompute the candidate pairs with the cutoff ``cutoff+skin``"""
+        pair_search = PairSearchIntra(
+            coordinates, self.cutoff + self.skin, self.unit_cell, self.grid,
+            num_threads=self.num_threads
+        )
+        self._candidates = pair_search.arrays()[0]
+        self._reference = coordinates.copy()
+        self.num_rebuilds += 1
+
+    def update(self, coordinates):
+        """Compute the pairs below the cutoff for a new geometry
+
+           Argument:
+            | ``coordinates``  --  A Nx3 numpy array with Cartesian coordinates
+
+           Returns: ``pairs``, ``deltas``, ``distances``, with the same
+           conventions as :meth:`PairSearchIntra.arrays`. These are also stored
+           as attributes of the neighbor list.
+        """
+        if self._needs_rebuild(coordinates):
+            self._rebuild(coordinates)
+        candidates = self._candidates
+        deltas = coordinates[candidates[:,1]] - coordinates[candidates[:,0]]
+        if self.unit_cell is not None:
+            deltas = self.unit_cell.shortest_vector(deltas)
+        distances = numpy.sqrt((deltas**2).sum(axis=1))
+        mask = distances <= self.cutoff
+        self.pairs = candidates[mask]
+        self.deltas = deltas[mask]
+        self.distances = distances[mask]
+        return self.pairs, self.deltas, self.distances
@@ -45,6 +45,8 @@ from molmod.periodic import periodic
 import molmod.units as units
 from molmod import context
 
+import numpy
+
 
 __all__ = [
     "BOND_SINGLE", "BOND_DOUBLE", "BOND_TRIPLE", "BOND_HYBRID",
@@ -84,6 +86,7 @@ class BondData(object):
             in self.lengths.itervalues()
             if len(lengths) > 0
         )
+        self._compute_length_tables()
 
     def _load_bond_data(self, filename):
         """Load the bond data from the given file
@@ -139,6 +142,35 @@ class BondData(object):
                         dataset[pair] = (atom1.covalent_radius + atom2.covalent_radius)
                     #print "%3i  %3i  %s %30s %30s" % (n1, n2, dataset.get(pair), atom1, atom2)
 
+    def _compute_length_tables(self):
+        """Tabulate the bond lengths in dense arrays indexed by atom numbers
+
+           Two attributes are computed:
+
+           * ``lengths_table``: an array with shape (Z, Z, len(bond_types)),
+             where ``lengths_table[n1, n2, i]`` is the length of a bond of type
+             ``bond_types[i]`` between atom numbers ``n1`` and ``n2``.
+           * ``max_lengths``: an array with shape (Z, Z) with the longest bond
+             length for each pair of atom numbers.
+
+           Both arrays are symmetric in the two atom numbers. Missing bond
+           lengths are zero.
+        """
+        max_number = max(
+            max(pair)
+            for lengths in self.lengths.itervalues()
+            for pair in lengths
+        )
+        size = max_number + 1
+        self.lengths_table = numpy.zeros((size, size, len(bond_types)), float)
+        for index, bond_type in enumerate(bond_types):
+            for pair, length in self.lengths[bond_type].iteritems():
+                n1 = min(pair)
+                n2 = max(pair)
+                self.lengths_table[n1, n2, index] = length
+                self.lengths_table[n2, n1, index] = length
+        self.max_lengths = self.lengths_table.max(axis=2)
+
     def bonded(self, n1, n2, distance):
         """Return the estimated bond type
 
@@ -173,6 +205,35 @@ class BondData(object):
                         deviation = new_deviation
         return result
 
+    def bonded_arrays(self, n1, n2, distances):
+        """Return the estimated bond types for arrays of atom pairs
+
+           Arguments:
+            | ``n1``  --  an array with the atom numbers of the first atoms
+            | ``n2``  --  an array with the atom numbers of the second atoms
+            | ``distances``  --  an array with the distances between the atoms
+
+           This is the vectorized counterpart of the method ``bonded``. The
+           return value is an integer array with the best matching bond type
+           for each pair, or zero when the atoms are not bonded.
+        """
+        n1 = numpy.asarray(n1, int)
+        n2 = numpy.asarray(n2, int)
+        distances = numpy.asarray(distances, float)
+        result = numpy.zeros(len(distances), int)
+        size = len(self.lengths_table)
+        known = (n1 >= 0) & (n1 < size) & (n2 >= 0) & (n2 < size)
+        known = known.nonzero()[0]
+        lengths = self.lengths_table[n1[known], n2[known]]
+        d = distances[known].reshape(-1, 1)
+        valid = (lengths > 0) & (d < lengths*self.bond_tolerance)
+        deviations = numpy.where(valid, abs(lengths - d), numpy.inf)
+        # argmin picks the first bond type in case of equal deviations
+        best = deviations.argmin(axis=1)
+        mask = valid.any(axis=1)
+        result[known[mask]] = numpy.array(bond_types)[best[mask]]
+        return result
+
     def get_length(self, n1, n2, bond_type=BOND_SINGLE):
         """Return the length of a bond between n1 and n2 of type bond_type
 
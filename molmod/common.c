@@ -92,6 +92,32 @@ double distance_delta_periodic(double *a, double *b, double *delta, double *matr
   return sqrt(delta[0]*delta[0] + delta[1]*delta[1] + delta[2]*delta[2]);
 }
 
+double distance_delta_periodic_images(double *a, double *b, double *delta, double *matrix, double *reciprocal, int nimages, double *images) {
+  // The images array contains the candidate lattice translations, see
+  // UnitCell.image_candidates. The first one is the zero translation.
+  int k;
+  double dsq, best, base[3], trial[3], *image;
+  best = distance_delta_periodic(a, b, delta, matrix, reciprocal);
+  best *= best;
+  base[0] = delta[0];
+  base[1] = delta[1];
+  base[2] = delta[2];
+  for (k=1; k<nimages; k++) {
+    image = images + 3*k;
+    trial[0] = base[0] - image[0];
+    trial[1] = base[1] - image[1];
+    trial[2] = base[2] - image[2];
+    dsq = trial[0]*trial[0] + trial[1]*trial[1] + trial[2]*trial[2];
+    if (dsq < best) {
+      best = dsq;
+      delta[0] = trial[0];
+      delta[1] = trial[1];
+      delta[2] = trial[2];
+    }
+  }
+  return sqrt(best);
+}
+
 double norm(double *a) {
   return sqrt(a[0]*a[0] + a[1]*a[1] + a[2]*a[2]);
 }
@@ -34,6 +34,7 @@ double distance(double *a, double *b);
 double distance_periodic(double *a, double *b, double *matrix, double *reciprocal);
 double distance_delta(double *a, double *b, double *delta);
 double distance_delta_periodic(double *a, double *b, double *delta, double *matrix, double *reciprocal);
+double distance_delta_periodic_images(double *a, double *b, double *delta, double *matrix, double *reciprocal, int nimages, double *images);
 double norm(double *a);
 
 #endif
@@ -39,7 +39,8 @@ inline void add_grad(
 
 double ff_dm_quad(
   int n, int periodic, double *cor, double *dm0, double *dmk,
-  double amp, double *gradient, double *matrix, double *reciprocal
+  double amp, double *gradient, double *matrix, double *reciprocal,
+  int nimages, double *images
 ) {
   int i,j;
   double delta[3], d, d0, k, tmp, result;
@@ -53,7 +54,7 @@ double ff_dm_quad(
       //printf("i=%i  j=%i  d0=%i\n", i,j,d0);
       if (d0>0) {
         if (periodic) {
-          d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
+          d = distance_delta_periodic_images(cor + 3*i, cor + 3*j, delta, matrix, reciprocal, nimages, images);
         } else {
           d = distance_delta(cor + 3*i, cor + 3*j, delta);
         }
@@ -74,18 +75,25 @@ double ff_dm_quad(
 
 
 double ff_dm_reci(
-  int n, int periodic, double *cor, double *radii, int *dm0,
-  double amp, double *gradient, double *matrix, double *reciprocal
+  int n, int periodic, double *cor, double *radii, int *labels, int *indptr,
+  int *indices, double amp, double *gradient, double *matrix,
+  double *reciprocal, int nimages, double *images
 ) {
-  int i, j;
+  // Only pairs of atoms in the same molecule (same label) are taken into
+  // account. The excluded neighbors of atom i are
+  // indices[indptr[i]:indptr[i+1]], sorted in increasing order.
+  int i, j, k;
   double delta[3], d, r0, tmp, result;
 
   result = 0.0;
   for (i=0; i<n; i++) {
+    k = indptr[i];
     for (j=0; j<i; j++) {
-      if (dm0[i*n+j]>1) {
+      while ((k < indptr[i+1]) && (indices[k] < j)) k++;
+      if ((k < indptr[i+1]) && (indices[k] == j)) continue;
+      if (labels[i] == labels[j]) {
         if (periodic) {
-          d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
+          d = distance_delta_periodic_images(cor + 3*i, cor + 3*j, delta, matrix, reciprocal, nimages, images);
         } else {
           d = distance_delta(cor + 3*i, cor + 3*j, delta);
         }
@@ -107,7 +115,8 @@ double ff_dm_reci(
 
 double ff_bond_quad(
   int m, int n, int periodic, double *cor, int *pairs, double *lengths,
-  double amp, double *gradient, double *matrix, double *reciprocal
+  double amp, double *gradient, double *matrix, double *reciprocal,
+  int nimages, double *images
 ) {
   int b, i, j;
   double delta[3], result, d, tmp;
@@ -117,7 +126,7 @@ double ff_bond_quad(
     i = pairs[2*b  ];
     j = pairs[2*b+1];
     if (periodic) {
-      d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
+      d = distance_delta_periodic_images(cor + 3*i, cor + 3*j, delta, matrix, reciprocal, nimages, images);
     } else {
       d = distance_delta(cor + 3*i, cor + 3*j, delta);
     }
@@ -135,7 +144,8 @@ double ff_bond_quad(
 
 double ff_bond_hyper(
   int m, int n, int periodic, double *cor, int *pairs, double *lengths,
-  double scale, double amp, double *gradient, double *matrix, double *reciprocal
+  double scale, double amp, double *gradient, double *matrix, double *reciprocal,
+  int nimages, double *images
 ) {
   int b, i, j;
   double delta[3], result, d, tmp;
@@ -145,7 +155,7 @@ double ff_bond_hyper(
     i = pairs[2*b  ];
     j = pairs[2*b+1];
     if (periodic) {
-      d = distance_delta_periodic(cor + 3*i, cor + 3*j, delta, matrix, reciprocal);
+      d = distance_delta_periodic_images(cor + 3*i, cor + 3*j, delta, matrix, reciprocal, nimages, images);
     } else {
       d = distance_delta(cor + 3*i, cor + 3*j, delta);
     }
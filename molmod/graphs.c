@@ -44,3 +44,121 @@ void graphs_floyd_warshall(int n, int* dm) {
     }
   }
 }
+
+
+void graphs_bfs_distances(int begin, int end, int n, int* indptr, int* indices, int* queue, int* dm) {
+  // Breadth first search from each source vertex in [begin,end[. The
+  // neighbors of a vertex i are indices[indptr[i]:indptr[i+1]]. The rows of
+  // dm that correspond to the source vertices must be zero on input. Vertices
+  // that can not be reached remain zero, as in graphs_floyd_warshall. The
+  // queue is a work array with n elements.
+  int source, vertex, neighbor, k, head, tail, distance, *row;
+
+  for (source=begin; source<end; source++) {
+    row = dm + ((long)source)*n;
+    queue[0] = source;
+    head = 0;
+    tail = 1;
+    while (head < tail) {
+      vertex = queue[head];
+      head++;
+      distance = row[vertex] + 1;
+      for (k=indptr[vertex]; k<indptr[vertex+1]; k++) {
+        neighbor = indices[k];
+        if ((neighbor != source) && (row[neighbor] == 0)) {
+          row[neighbor] = distance;
+          queue[tail] = neighbor;
+          tail++;
+        }
+      }
+    }
+  }
+}
+
+
+int graphs_bfs_bounded(int begin, int end, int n, int* indptr, int* indices, int max_distance, int* queue, int* depth, int* stamp, int* counts, int capacity, int* neighbors, int* distances) {
+  // Breadth first search from each source vertex in [begin,end[, up to the
+  // given maximum distance. The vertices that are reached from a source
+  // (excluding the source) are stored consecutively in neighbors, with their
+  // distances, and counts[source-begin] is set to their number. Only the
+  // first `capacity` vertices are stored, but all are counted, such that the
+  // caller can retry with larger buffers. queue, depth and stamp are work
+  // arrays with n elements. All elements of stamp must be -1 on input.
+  int source, vertex, neighbor, k, head, tail, distance, count;
+
+  count = 0;
+  for (source=begin; source<end; source++) {
+    stamp[source] = source;
+    queue[0] = source;
+    depth[0] = 0;
+    head = 0;
+    tail = 1;
+    while (head < tail) {
+      vertex = queue[head];
+      distance = depth[head] + 1;
+      head++;
+      if (distance > max_distance) break;
+      for (k=indptr[vertex]; k<indptr[vertex+1]; k++) {
+        neighbor = indices[k];
+        if (stamp[neighbor] != source) {
+          stamp[neighbor] = source;
+          queue[tail] = neighbor;
+          depth[tail] = distance;
+          tail++;
+          if (count < capacity) {
+            neighbors[count] = neighbor;
+            distances[count] = distance;
+          }
+          count++;
+        }
+      }
+    }
+    counts[source-begin] = tail-1;
+  }
+  return count;
+}
+
+
+int graphs_connected_components(int n, int m, int* edges, int* labels) {
+  // Assign a component label to each vertex with a union-find algorithm. The
+  // edges array has m rows with two vertex indices each. On output, the
+  // components are numbered consecutively in the order of their lowest vertex
+  // index. The number of components is returned.
+  int i, a, b, count;
+
+  // The labels array first contains the parent of each vertex in the
+  // union-find forest. The root of each tree is its lowest vertex, which
+  // implies that parents always have a lower index than their children.
+  for (i=0; i<n; i++) {
+    labels[i] = i;
+  }
+  for (i=0; i<m; i++) {
+    a = edges[2*i];
+    while (labels[a] != a) {
+      labels[a] = labels[labels[a]];
+      a = labels[a];
+    }
+    b = edges[2*i+1];
+    while (labels[b] != b) {
+      labels[b] = labels[labels[b]];
+      b = labels[b];
+    }
+    if (a < b) {
+      labels[b] = a;
+    } else if (b < a) {
+      labels[a] = b;
+    }
+  }
+  // Replace the parents by the component labels. The parent of a vertex is
+  // always processed before the vertex itself.
+  count = 0;
+  for (i=0; i<n; i++) {
+    if (labels[i] == i) {
+      labels[i] = count;
+      count++;
+    } else {
+      labels[i] = labels[labels[i]];
+    }
+  }
+  return count;
+}
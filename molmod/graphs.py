@@ -34,14 +34,20 @@
    * Symmetry analysis of graphs (automorphisms). The Graph class can generate a
      list of permutations between vertices that map the graph onto itself. This
      can be used to generate (and test) all possible geometric symmetries in a
-     molecule. See http://en.wikipedia.org/wiki/Graph_automorphism for more
-     info.
+     molecule. The generators, orbits and order of the automorphism group are
+     obtained without enumerating all symmetries. See
+     http://en.wikipedia.org/wiki/Graph_automorphism for more info.
+   * Canonical labels and hashes of graphs, computed with an
+     individualization-refinement search in the spirit of nauty. See
+     http://en.wikipedia.org/wiki/Graph_canonization for more info.
    * Scanning a graph for patterns.
      The GraphSearch is a generic class that can scan a graph for certain
      patterns, e.g. given pattern_graphs, strong rings, isomorphisms,
      automorphisms, ... The pattern_graph can deal with (multiple sets of)
      additional conditions that must be satisfied, such as "give me all
      dihedral angles where the central atoms are carbons" without duplicates.
+     The MultiPatternSearch runs a single search for many such patterns that
+     only differ in their conditions.
 
    The central class in this module is 'Graph'. It caches most of the analysis
    results, which implies that the graph structure can not be changed once the
@@ -59,6 +65,7 @@ __all__ = [
     "GraphError", "Graph", "OneToOne", "Match", "Pattern",
     "CriteriaSet", "Anything", "CritOr", "CritAnd", "CritXor", "CritNot",
     "CustomPattern", "EqualPattern", "RingPattern", "GraphSearch",
+    "MultiPatternSearch", "SearchPlan",
 ]
 
 
@@ -67,11 +74,128 @@ class GraphError(Exception):
     pass
 
 
+def _check_edge_array(edges):
+    """Return a validated int32 copy of an integer array with edges
+
+       The same conditions as in the constructor of :class:`Graph` are tested,
+       but with vectorized operations.
+    """
+    edges = numpy.asarray(edges)
+    if edges.size == 0:
+        return numpy.zeros((0, 2), numpy.int32)
+    if len(edges.shape) != 2 or edges.shape[1] != 2:
+        raise TypeError("The edges must be an array with shape (num_edges, 2).")
+    if not issubclass(edges.dtype.type, numpy.integer):
+        raise TypeError("The edges must contain integers.")
+    if (edges[:,0] == edges[:,1]).any():
+        raise ValueError("A edge must contain two different values.")
+    if (edges < 0).any():
+        raise TypeError("The edges must contain positive integers.")
+    if edges.max() > numpy.iinfo(numpy.int32).max:
+        raise ValueError("The vertex indexes must fit in 32-bit integers.")
+    return edges.astype(numpy.int32)
+
+
+def _map_blocks(fn, size, num_threads=None):
+    """Apply a function to consecutive blocks of the range [0, size[
+
+       Arguments:
+        | ``fn``  --  a function that takes a tuple (begin, end) as argument
+        | ``size``  --  the length of the range
+
+       Optional argument:
+        | ``num_threads``  --  when larger than one, the blocks are processed by
+                               a pool of threads. This only pays off when fn
+                               calls a C routine that releases the GIL.
+
+       Returns a list with the return values of fn for all blocks.
+    """
+    if num_threads is None or num_threads == 1:
+        return [fn((0, size))]
+    from multiprocessing.pool import ThreadPool
+    bounds = numpy.linspace(0, size, min(size, 4*num_threads)+1).astype(int)
+    pool = ThreadPool(num_threads)
+    try:
+        return pool.map(fn, zip(bounds[:-1], bounds[1:]))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _mix_hashes(x):
+    """Scramble the bits of an array with 64-bit unsigned integers
+
+       This is the finalizer of the SplitMix64 random number generator, which
+       is a bijection with good avalanche properties. The argument is not
+       modified.
+    """
+    x = x ^ (x >> numpy.uint64(30))
+    x *= numpy.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> numpy.uint64(27)
+    x *= numpy.uint64(0x94d049bb133111eb)
+    x ^= x >> numpy.uint64(31)
+    return x
+
+
+def _hash_strings(strings):
+    """Convert a list of strings into 128-bit hashes
+
+       Returns an array with two 64-bit unsigned integers for each string. The
+       result does not depend on the platform or the Python process.
+    """
+    import hashlib
+    cache = {}
+    result = numpy.zeros((len(strings), 2), numpy.uint64)
+    for i, string in enumerate(strings):
+        row = cache.get(string)
+        if row is None:
+            row = numpy.frombuffer(hashlib.sha1(string).digest()[:16], "<u8")
+            cache[string] = row
+        result[i] = row
+    return result
+
+
+def _count_rows(a):
+    """The number of distinct rows in a two-dimensional array"""
+    if len(a) == 0:
+        return 0
+    a = a[numpy.lexsort(a.T)]
+    return 1 + (a[1:] != a[:-1]).any(axis=1).sum()
+
+
+class _EdgesAttribute(ReadOnlyAttribute):
+    """The read-only edges attribute of a graph
+
+       The edges are stored as an integer array in the cached attribute
+       ``edge_array`` of the graph. The tuple of frozensets is only constructed
+       when it is requested for the first time.
+    """
+
+    def __init__(self):
+        ReadOnlyAttribute.__init__(self, tuple, none=False, doc="the incidence list")
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        result = getattr(instance, self.attribute_name, None)
+        if result is None:
+            edge_array = getattr(instance, "_cache_edge_array", None)
+            if edge_array is None:
+                return None
+            result = tuple(frozenset(edge) for edge in edge_array.tolist())
+            setattr(instance, self.attribute_name, result)
+        return result
+
+
 class Graph(ReadOnly):
     """An undirected graph, where edges have equal weight
 
        The edges attribute is the most elementary and is always available. All
-       other attributes are optional.
+       other attributes are optional. Internally, the edges are stored in an
+       integer array with shape (num_edges, 2), see ``edge_array``, and the
+       neighbors of all vertices are stored in the compressed sparse row format,
+       see ``neighbor_indptr`` and ``neighbor_indices``. The tuple ``edges`` and
+       the dictionary ``neighbors`` are only constructed when they are used.
 
        Graphs are meant to be immutable objects. Once created they are not
        supposed to be modified. If you want an adapted graph, create a new
@@ -96,7 +220,7 @@ class Graph(ReadOnly):
        >>> # bond orders of ethene
        >>> graph.edge_property = numpy.array([2, 1, 1, 1, 1], int)
     """
-    edges = ReadOnlyAttribute(tuple, none=False, doc="the incidence list")
+    edges = _EdgesAttribute()
     num_vertices = ReadOnlyAttribute(int, none=False, doc="the number of vertices")
 
     def __init__(self, edges, num_vertices=None):
@@ -124,13 +248,31 @@ class Graph(ReadOnly):
                 raise TypeError("The edges must contain integers.")
             if i < 0 or j < 0:
                 raise TypeError("The edges must contain positive integers.")
-            tmp.append(frozenset([i, j]))
-        edges = tuple(tmp)
+            tmp.append((i, j))
+        self._init_edge_array(numpy.array(tmp, numpy.int32).reshape(-1, 2), num_vertices)
+
+    @classmethod
+    def from_arrays(cls, edges, num_vertices=None):
+        """Construct a graph from an integer array with edges
 
-        if len(edges) == 0:
+           Arguments:
+            | ``edges`` -- an integer array with shape (num_edges, 2)
+            | ``num_vertices`` -- number of vertices
+
+           This is equivalent to the constructor, but the edges are validated
+           with vectorized checks and no Python objects are created for the
+           individual edges. Use this for large graphs.
+        """
+        result = cls.__new__(cls)
+        result._init_edge_array(_check_edge_array(edges), num_vertices)
+        return result
+
+    def _init_edge_array(self, edge_array, num_vertices):
+        """Assign the validated edges and the number of vertices"""
+        if len(edge_array) == 0:
             real_num_vertices = 0
         else:
-            real_num_vertices = max(max(a, b) for a, b in edges)+1
+            real_num_vertices = int(edge_array.max())+1
         if num_vertices is not None:
             if not isinstance(num_vertices, int):
                 raise TypeError("The optional argument num_vertices must be an "
@@ -140,10 +282,11 @@ class Graph(ReadOnly):
                     "number of vertices deduced from the edge list.")
             real_num_vertices = num_vertices
 
-        self.edges = edges
+        edge_array.setflags(write=False)
+        self._cache_edge_array = edge_array
         self.num_vertices = real_num_vertices
 
-    num_edges = property(lambda self: len(self.edges),
+    num_edges = property(lambda self: len(self.edge_array),
         doc="*Read-only attribute:* the number of edges in the graph.")
 
     def __mul__(self, repeat):
@@ -154,19 +297,14 @@ class Graph(ReadOnly):
         """
         if not isinstance(repeat, int):
             raise TypeError("Can only multiply a graph with an integer")
-        new_edges = []
-        for i in xrange(repeat):
-            for vertex1, vertex2 in self.edges:
-                new_edges.append(frozenset([
-                    vertex1+i*self.num_vertices,
-                    vertex2+i*self.num_vertices
-                ]))
-        return Graph(new_edges, self.num_vertices*repeat)
+        offsets = numpy.arange(repeat)*self.num_vertices
+        new_edges = self.edge_array + offsets.reshape(-1, 1, 1)
+        return Graph.from_arrays(new_edges.reshape(-1, 2), self.num_vertices*repeat)
 
     __rmul__ = __mul__
 
     def __str__(self):
-        return " ".join("%i-%i" % tuple(sorted([i, j])) for i, j in self.edges)
+        return " ".join("%i-%i" % (min(i, j), max(i, j)) for i, j in self.edge_array)
 
     # functions that should be implemented by derived classes
 
@@ -186,6 +324,34 @@ class Graph(ReadOnly):
 
     # cached attributes:
 
+    @cached
+    def edge_array(self):
+        """The edges as an integer array with shape (num_edges, 2)"""
+        return numpy.array([tuple(edge) for edge in self.edges], numpy.int32).reshape(-1, 2)
+
+    @cached
+    def neighbor_indptr(self):
+        """The neighbors of vertex i are neighbor_indices[neighbor_indptr[i]:neighbor_indptr[i+1]]
+
+           This is the row pointer of the adjacency matrix in the compressed
+           sparse row format.
+        """
+        counts = numpy.bincount(self.edge_array.ravel(), minlength=self.num_vertices)
+        result = numpy.zeros(self.num_vertices+1, int)
+        result[1:] = counts.cumsum()
+        return result
+
+    @cached
+    def neighbor_indices(self):
+        """The neighbors of all vertices, sorted per vertex
+
+           This is the column index array of the adjacency matrix in the
+           compressed sparse row format. See ``neighbor_indptr``.
+        """
+        heads = self.edge_array.ravel()
+        tails = self.edge_array[:,::-1].ravel()
+        return tails[numpy.lexsort((tails, heads))]
+
     @cached
     def edge_index(self):
         """A map to look up the index of a edge"""
@@ -200,45 +366,257 @@ class Graph(ReadOnly):
            This means that vertexX and vertexY1 are connected etc. This also
            implies that the following elements are part of the dictionary:
            ``{vertexY1: (vertexX, ...), vertexY2: (vertexX, ...), ...}``.
+
+           The frozensets are derived from ``neighbor_indptr`` and
+           ``neighbor_indices``.
         """
-        neighbors = dict(
-            (vertex, []) for vertex
-            in xrange(self.num_vertices)
+        indptr = self.neighbor_indptr.tolist()
+        indices = self.neighbor_indices.tolist()
+        return dict(
+            (vertex, frozenset(indices[indptr[vertex]:indptr[vertex+1]]))
+            for vertex in xrange(self.num_vertices)
         )
-        for a, b in self.edges:
-            neighbors[a].append(b)
-            neighbors[b].append(a)
-        # turn lists into frozensets
-        neighbors = dict((key, frozenset(val)) for key, val in neighbors.iteritems())
-        return neighbors
 
     @cached
     def distances(self):
-        """The matrix with the all-pairs shortest path lenghts"""
+        """The matrix with the all-pairs shortest path lenghts
+
+           Vertices that are not connected have a zero distance. For sparse
+           graphs, a breadth first search is carried out from each vertex,
+           which scales as O(V*E). For dense graphs, the Floyd-Warshall
+           algorithm, O(V**3), is faster. See also :meth:`compute_distances`.
+        """
+        if 4*self.num_edges > self.num_vertices*(self.num_vertices-1):
+            return self._compute_distances_floyd_warshall()
+        else:
+            return self._compute_distances_bfs()
+
+    def _compute_distances_floyd_warshall(self):
+        """Compute the distance matrix with the Floyd-Warshall algorithm"""
         from molmod.ext import graphs_floyd_warshall
         distances = numpy.zeros((self.num_vertices,)*2, numpy.int32)
         #distances[:] = -1 # set all -1, which is just a very big integer
         #distances.ravel()[::len(distances)+1] = 0 # set diagonal to zero
-        for i, j in self.edges: # set edges to one
-            distances[i, j] = 1
-            distances[j, i] = 1
+        # set edges to one
+        distances[self.edge_array[:,0], self.edge_array[:,1]] = 1
+        distances[self.edge_array[:,1], self.edge_array[:,0]] = 1
         graphs_floyd_warshall(distances)
         return distances
 
+    def _compute_distances_bfs(self, num_threads=None):
+        """Compute the distance matrix with a breadth first search per vertex
+
+           Optional argument:
+            | ``num_threads``  --  the number of threads. The source vertices
+                                   are divided into blocks that are processed
+                                   simultaneously, because the C routine
+                                   releases the GIL.
+        """
+        from molmod.ext import graphs_bfs_distances
+        size = self.num_vertices
+        distances = numpy.zeros((size, size), numpy.int32)
+        if size == 0:
+            return distances
+        indptr = self.neighbor_indptr.astype(numpy.int32)
+        indices = self.neighbor_indices.astype(numpy.int32)
+
+        def compute_block(bounds):
+            queue = numpy.zeros(size, numpy.int32)
+            graphs_bfs_distances(bounds[0], bounds[1], indptr, indices, queue, distances)
+
+        _map_blocks(compute_block, size, num_threads)
+        return distances
+
+    def compute_distances(self, num_threads=None):
+        """Compute the matrix with the all-pairs shortest path lengths
+
+           Optional argument:
+            | ``num_threads``  --  the number of threads used for the breadth
+                                   first searches.
+
+           The result is the same as the cached attribute ``distances``, which
+           is also assigned by this method. Use this method to compute the
+           distances of a large graph in parallel.
+        """
+        if num_threads is not None and num_threads < 1:
+            raise ValueError("The number of threads must be at least one.")
+        if getattr(self, "_cache_distances", None) is None:
+            distances = self._compute_distances_bfs(num_threads)
+            distances.setflags(write=False)
+            self._cache_distances = distances
+        return self.distances
+
+    def get_distances(self, max_distance, num_threads=None):
+        """Compute the shortest path lengths up to a maximum distance
+
+           Arguments:
+            | ``max_distance``  --  the largest path length of interest
+
+           Optional argument:
+            | ``num_threads``  --  the number of threads used for the breadth
+                                   first searches.
+
+           Returns: ``indptr``, ``indices``, ``distances``
+
+           The result is a sparse matrix in the compressed sparse row format.
+           The vertices within ``max_distance`` of vertex ``i`` (excluding
+           ``i`` itself) are ``indices[indptr[i]:indptr[i+1]]`` and their
+           path lengths are ``distances[indptr[i]:indptr[i+1]]``. Each row is
+           sorted by distance and then by vertex index. In contrast to the
+           cached attribute ``distances``, the memory usage only grows
+           linearly with the size of the graph.
+        """
+        from molmod.ext import graphs_bfs_bounded
+        if max_distance < 0:
+            raise ValueError("The maximum distance can not be negative.")
+        if num_threads is not None and num_threads < 1:
+            raise ValueError("The number of threads must be at least one.")
+        size = self.num_vertices
+        indptr = numpy.zeros(size+1, int)
+        if size == 0 or max_distance == 0:
+            return indptr, numpy.zeros(0, int), numpy.zeros(0, int)
+        csr_indptr = self.neighbor_indptr.astype(numpy.int32)
+        csr_indices = self.neighbor_indices.astype(numpy.int32)
+
+        def compute_block(bounds):
+            begin, end = bounds
+            queue = numpy.zeros(size, numpy.int32)
+            depth = numpy.zeros(size, numpy.int32)
+            stamp = numpy.zeros(size, numpy.int32)
+            counts = numpy.zeros(end-begin, numpy.int32)
+            # first guess of the number of pairs, enlarged when needed
+            capacity = (csr_indptr[end] - csr_indptr[begin])*max_distance + 16
+            while True:
+                stamp[:] = -1
+                neighbors = numpy.zeros(capacity, numpy.int32)
+                distances = numpy.zeros(capacity, numpy.int32)
+                count = graphs_bfs_bounded(
+                    begin, end, csr_indptr, csr_indices, max_distance, queue,
+                    depth, stamp, counts, neighbors, distances
+                )
+                if count <= capacity:
+                    return counts, neighbors[:count], distances[:count]
+                capacity = count
+
+        results = _map_blocks(compute_block, size, num_threads)
+        counts, indices, distances = [numpy.concatenate(parts) for parts in zip(*results)]
+        indptr[1:] = counts.cumsum()
+        # sort each row by distance and then by index
+        rows = numpy.repeat(numpy.arange(size), counts)
+        order = numpy.lexsort((indices, distances, rows))
+        return indptr, indices[order].astype(int), distances[order].astype(int)
+
+    def _get_sweep(self):
+        """Generate a function that computes distances from a single vertex
+
+           The returned function takes a vertex index as argument and returns
+           an integer array with the path lengths from that vertex to all other
+           vertices. Vertices that can not be reached get a distance -1. The
+           work arrays are shared by subsequent calls.
+        """
+        from molmod.ext import graphs_bfs_bounded
+        size = self.num_vertices
+        csr_indptr = self.neighbor_indptr.astype(numpy.int32)
+        csr_indices = self.neighbor_indices.astype(numpy.int32)
+        queue = numpy.zeros(size, numpy.int32)
+        depth = numpy.zeros(size, numpy.int32)
+        stamp = numpy.zeros(size, numpy.int32)
+        counts = numpy.zeros(1, numpy.int32)
+        neighbors = numpy.zeros(size, numpy.int32)
+        distances = numpy.zeros(size, numpy.int32)
+
+        def sweep(vertex):
+            stamp[:] = -1
+            count = graphs_bfs_bounded(
+                vertex, vertex+1, csr_indptr, csr_indices, size, queue, depth,
+                stamp, counts, neighbors, distances
+            )
+            result = numpy.zeros(size, int)
+            result -= 1
+            result[vertex] = 0
+            result[neighbors[:count]] = distances[:count]
+            return result
+
+        return sweep
+
+    @cached
+    def _eccentricity_extrema(self):
+        """The central vertices and the largest eccentricity
+
+           The eccentricity of a vertex is the largest path length to any other
+           vertex in the same connected component. Both extrema are found with
+           breadth first sweeps that narrow down lower and upper bounds for the
+           eccentricities of all vertices [Takes and Kosters, Algorithms 6,
+           100 (2013)]. Each sweep from a vertex v with eccentricity e(v)
+           implies for all vertices w in the same component:
+
+              max(d(v,w), e(v) - d(v,w)) <= e(w) <= e(v) + d(v,w)
+
+           Vertices whose bounds show that they can neither be central nor
+           have the largest eccentricity are discarded. The sweeps alternate
+           between the vertex with the smallest lower bound and the vertex
+           with the largest upper bound. The first two sweeps then correspond
+           to the well known double sweep estimate of the diameter.
+        """
+        size = self.num_vertices
+        # isolated vertices have an eccentricity zero and are never central
+        candidates = self.neighbor_indptr[1:] > self.neighbor_indptr[:-1]
+        if not candidates.any():
+            return numpy.zeros(0, int), 0
+        lower = numpy.zeros(size, int)
+        upper = numpy.zeros(size, int)
+        upper[:] = size
+        sweep = self._get_sweep()
+        active = candidates.copy()
+        high = False
+        while active.any():
+            todo = active.nonzero()[0]
+            if high:
+                vertex = todo[upper[todo].argmax()]
+            else:
+                vertex = todo[lower[todo].argmin()]
+            high = not high
+            distances = sweep(vertex)
+            component = (distances >= 0).nonzero()[0]
+            distances = distances[component]
+            eccentricity = distances.max()
+            lower[component] = numpy.maximum(lower[component], numpy.maximum(
+                distances, eccentricity - distances
+            ))
+            upper[component] = numpy.minimum(upper[component], eccentricity + distances)
+            # The eccentricity of the central vertices is at most center_bound
+            # and the largest eccentricity is at least diameter_bound.
+            center_bound = upper[candidates].min()
+            diameter_bound = lower.max()
+            active &= (lower < upper)
+            active &= (lower <= center_bound) | (upper > diameter_bound)
+        # All central vertices are resolved at this stage.
+        center = upper[candidates].min()
+        central_vertices = (candidates & (lower == upper) & (upper == center)).nonzero()[0]
+        return central_vertices, lower.max()
+
     @cached
     def max_distance(self):
-        """The maximum value in the distances matrix."""
-        if self.distances.shape[0] == 0:
+        """The maximum value in the distances matrix.
+
+           This is computed without the distances matrix, unless the latter is
+           already available.
+        """
+        if self.num_vertices == 0:
             return 0
-        else:
+        elif getattr(self, "_cache_distances", None) is not None:
             return self.distances.max()
+        else:
+            return self._eccentricity_extrema[1]
 
     @cached
     def central_vertices(self):
-        """Vertices that have the lowest maximum distance to any other vertex"""
-        max_distances = self.distances.max(0)
-        max_distances_min = max_distances[max_distances > 0].min()
-        return (max_distances == max_distances_min).nonzero()[0]
+        """Vertices that have the lowest maximum distance to any other vertex
+
+           Isolated vertices are not considered. The distances matrix is not
+           needed to find the central vertices.
+        """
+        return self._eccentricity_extrema[0]
 
     @cached
     def central_vertex(self):
@@ -249,6 +627,20 @@ class Graph(ReadOnly):
         """
         return self.central_vertices[0]
 
+    @cached
+    def component_labels(self):
+        """An array with the index of the connected component of each vertex
+
+           The components are numbered in the order of their lowest vertex
+           index, consistent with ``independent_vertices``. These labels are
+           convenient for reductions over the individual molecules in a
+           molecular graph, e.g. ``numpy.bincount(labels, weights)``.
+        """
+        from molmod.ext import graphs_connected_components
+        labels = numpy.zeros(self.num_vertices, numpy.int32)
+        graphs_connected_components(self.edge_array, labels)
+        return labels.astype(int)
+
     @cached
     def independent_vertices(self):
         """Lists of vertices that are only interconnected within each list
@@ -257,21 +649,13 @@ class Graph(ReadOnly):
            vertex in another list. In case of a molecular graph, this would
            yield the atoms that belong to individual molecules.
         """
-        candidates = set(xrange(self.num_vertices))
-
-        result = []
-        while len(candidates) > 0:
-            pivot = candidates.pop()
-            group = [
-                vertex for vertex, distance
-                in self.iter_breadth_first(pivot)
-            ]
-            candidates.difference_update(group)
-
-            # this sort makes sure that the order of the vertices is respected
-            group.sort()
-            result.append(group)
-        return result
+        labels = self.component_labels
+        if len(labels) == 0:
+            return []
+        # a stable sort keeps the vertices in each group in increasing order
+        order = labels.argsort(kind="mergesort")
+        counts = numpy.bincount(labels)
+        return [group.tolist() for group in numpy.split(order, counts.cumsum()[:-1])]
 
     @cached
     def fingerprint(self):
@@ -280,10 +664,7 @@ class Graph(ReadOnly):
            The result is invariant under permutation of the vertex indexes. The
            chance that two different (molecular) graphs yield the same
            fingerprint is small but not zero. (See unit tests.)"""
-        if self.num_vertices == 0:
-            return numpy.zeros(20, numpy.ubyte)
-        else:
-            return sum(self.vertex_fingerprints)
+        return self.vertex_fingerprints.sum(axis=0, dtype=numpy.uint64)
 
     @cached
     def vertex_fingerprints(self):
@@ -301,33 +682,87 @@ class Graph(ReadOnly):
 
     @cached
     def equivalent_vertices(self):
-        """A dictionary with symmetrically equivalent vertices."""
+        """A dictionary with symmetrically equivalent vertices.
+
+           Each vertex is mapped on the set of vertices in its orbit under the
+           automorphism group. The orbits are computed from the automorphism
+           generators, i.e. without enumerating all symmetries.
+        """
         level1 = {}
-        for i, row in enumerate(self.vertex_fingerprints):
-            key = str(buffer(row))
-            l = level1.get(key)
-            if l is None:
-                l = set([i])
-                level1[key] = l
-            else:
-                l.add(i)
+        for vertex, orbit in enumerate(self.automorphism_orbits):
+            level1.setdefault(orbit, set([])).add(vertex)
         level2 = {}
-        for key, vertices in level1.iteritems():
+        for vertices in level1.itervalues():
             for vertex in vertices:
                 level2[vertex] = vertices
         return level2
 
+    @cached
+    def automorphism_generators(self):
+        """Permutations that generate all graph symmetries
+
+           Each generator is given in the cycle representation of
+           symmetry_cycles, i.e. a tuple of cycles, where each cycle is a tuple
+           of vertices. Each cycle starts with its lowest vertex, the cycles are
+           sorted and vertices that are mapped onto themselves are omitted. The
+           generators are a by-product of the canonical labeling, which avoids
+           the enumeration of all symmetries.
+        """
+        result = []
+        for moved, images in self._canonical_labeling.generators:
+            destinations = dict(zip(moved.tolist(), images.tolist()))
+            cycles = []
+            for vertex in sorted(destinations):
+                if vertex not in destinations:
+                    continue
+                cycle = [vertex]
+                current = destinations.pop(vertex)
+                while current != vertex:
+                    cycle.append(current)
+                    current = destinations.pop(current)
+                cycles.append(tuple(cycle))
+            result.append(tuple(cycles))
+        return result
+
+    @cached
+    def automorphism_orbits(self):
+        """An array with the index of the orbit of each vertex
+
+           Two vertices belong to the same orbit when there is a graph symmetry
+           that maps one onto the other. The orbits are numbered in the order
+           of their lowest vertex index.
+        """
+        return self._canonical_labeling.get_orbits().astype(int)
+
+    @cached
+    def automorphism_group_order(self):
+        """The number of graph symmetries, including the identity"""
+        return self._canonical_labeling.get_order()
+
+    def iter_automorphisms(self):
+        """Iterate over all graph symmetries
+
+           Each symmetry is an integer array with the image of each vertex.
+           The symmetries are generated lazily from the automorphism
+           generators. Keep in mind that the number of symmetries can grow
+           exponentially with the size of the graph.
+        """
+        return self._canonical_labeling.iter_permutations()
+
     @cached
     def symmetries(self):
-        """Graph symmetries (permutations) that map the graph onto itself."""
+        """Graph symmetries (permutations) that map the graph onto itself.
 
-        symmetry_cycles = set([])
+           This is only supported for connected graphs. Use the method
+           iter_automorphisms to avoid the construction of all EqualMatch
+           objects.
+        """
+        if len(self.independent_vertices) > 1:
+            raise ValueError("Symmetries can only be enumerated for connected graphs.")
         symmetries = set([])
-        for match in GraphSearch(EqualPattern(self))(self):
+        for permutation in self.iter_automorphisms():
+            match = EqualMatch(enumerate(permutation.tolist()))
             match.cycles = match.get_closed_cycles()
-            if match.cycles in symmetry_cycles:
-                raise RuntimeError("Duplicates in EqualMatch")
-            symmetry_cycles.add(match.cycles)
             symmetries.add(match)
         return symmetries
 
@@ -339,6 +774,53 @@ class Graph(ReadOnly):
             result.add(symmetry.cycles)
         return result
 
+    @cached
+    def _canonical_labeling(self):
+        """The canonical labels and the automorphisms of the graph"""
+        return _CanonicalLabeling(self)
+
+    @cached
+    def _subject_index(self):
+        """The vertices bucketed for a graph search in this graph"""
+        return _SubjectIndex(self)
+
+    @cached
+    def _masks(self):
+        """The vertex masks and other results of criteria for this graph
+
+           The dictionary is filled by :func:`_get_mask` and
+           :func:`_test_criterion`.
+        """
+        return {}
+
+    @cached
+    def canonical_labels(self):
+        """The position of each vertex in a canonical labeling
+
+           Relabeling two isomorphic graphs with their canonical labels results
+           in identical graphs. The labels depend only on the connectivity and
+           the return values of the methods get_vertex_string and
+           get_edge_string. Symmetrically equivalent vertices can be swapped
+           in the canonical labeling without changing the relabeled graph.
+        """
+        return self._canonical_labeling.labels
+
+    @cached
+    def canonical_hash(self):
+        """A hash string that is identical for isomorphic graphs only
+
+           Two graphs get the same hash if and only if they are isomorphic,
+           taking into account the vertex and edge strings, unless the SHA-1
+           hash has a collision. A collection of graphs can be deduplicated
+           with a dictionary that has the canonical hashes as keys.
+        """
+        import hashlib
+        labeling = self._canonical_labeling
+        digest = hashlib.sha1()
+        digest.update(repr((labeling.vertex_strings, labeling.edge_table)))
+        digest.update(labeling.certificate)
+        return digest.hexdigest()
+
     @cached
     def canonical_order(self):
         """The vertices in a canonical or normalized order.
@@ -357,18 +839,21 @@ class Graph(ReadOnly):
            ordering that feels like natural, i.e. starting in the center and
            pushing vertices with few equivalents to the front. If necessary, the
            nature of the vertices and  their bonds to atoms closer to the center
-           will also play a role, but only as a last resort.
+           will also play a role, but only as a last resort. Any remaining
+           ambiguity is lifted with the canonical_labels.
         """
         # A) find an appropriate starting vertex.
         # Here we take a central vertex that has a minimal number of symmetrical
         # equivalents, 'the highest atom number', and the highest fingerprint.
         # Note that the symmetrical equivalents are computed from the vertex
-        # fingerprints, i.e. without the GraphSearch.
+        # fingerprints, i.e. without the GraphSearch. Remaining ties are broken
+        # with the canonical labels.
         starting_vertex = max(
             (
                 -len(self.equivalent_vertices[vertex]),
                 self.get_vertex_string(vertex),
                 str(buffer(self.vertex_fingerprints[vertex])),
+                self.canonical_labels[vertex],
                 vertex
             ) for vertex in self.central_vertices
         )[-1]
@@ -378,45 +863,29 @@ class Graph(ReadOnly):
         #      2) number of equivalent vertices
         #      3) vertex string, (higher atom numbers come first)
         #      4) fingerprint
-        #      5) vertex index
+        #      5) canonical label
+        #      6) vertex index
         # The last field is only included to collect the result of the sort.
-        # The fingerprint on itself would be sufficient, but the three first are
-        # there to have a naturally appealing result.
+        # The canonical labels on themselves would be sufficient, but the four
+        # first are there to have a naturally appealing result. Ties in the
+        # first four fields can not be resolved locally. Consider e.g. allene:
+        # the four hydrogen atoms are equivalent, but one can make geminiles
+        # consecutive or not. The canonical labels fix such choices in a
+        # consistent way for the whole graph.
         l = [
             [
                 -distance,
                 -len(self.equivalent_vertices[vertex]),
                 self.get_vertex_string(vertex),
                 str(buffer(self.vertex_fingerprints[vertex])),
+                self.canonical_labels[vertex],
                 vertex
             ] for vertex, distance in self.iter_breadth_first(starting_vertex)
             if len(self.neighbors[vertex]) > 0
         ]
         l.sort(reverse=True)
 
-        # C) The order of some vertices is still not completely set. e.g.
-        # consider the case of allene. The four hydrogen atoms are equivalent,
-        # but one can have two different orders: make geminiles consecutive or
-        # don't. It is more trikcy than one would think at first sight. In the
-        # case of allene, geminility could easily solve the problem. Consider a
-        # big flat rotationally symmetric molecule (order 2). The first five
-        # shells are order 4 and one would just give a random order to four
-        # segemnts in the first shell. Only when one reaches the outer part that
-        # has order two, it turns out that the arbitrary choices in the inner
-        # shell play a role. So it does not help to look at relations with
-        # vertices at inner or current shells only. One has to consider the
-        # whole picture. (unit testing reveals troubles like these)
-
-        # I need some sleep now. The code below checks for potential fuzz and
-        # will raise an error if the ordering is not fully determined yet. One
-        # day, I'll need this code more than I do now, and I'll fix things up.
-        # I know how to do this, but I don't care enough right now.
-        # -- Toon
-        for i in xrange(1, len(l)):
-            if l[i][:-1] == l[i-1][:-1]:
-                raise NotImplementedError
-
-        # D) Return only the vertex indexes.
+        # C) Return only the vertex indexes.
         return [record[-1] for record in l]
 
     # other usefull graph functions
@@ -446,8 +915,9 @@ class Graph(ReadOnly):
                 raise ValueError("start must be in the range [0, %i[" %
                                  self.num_vertices)
         from collections import deque
-        work = numpy.zeros(self.num_vertices, int)
-        work[:] = -1
+        indptr = self.neighbor_indptr.tolist()
+        indices = self.neighbor_indices.tolist()
+        work = [-1]*self.num_vertices
         work[start] = 0
         if do_paths:
             result = (start, 0, (start, ))
@@ -461,7 +931,7 @@ class Graph(ReadOnly):
             else:
                 parent, parent_length = todo.popleft()
             current_length = parent_length + 1
-            for current in self.neighbors[parent]:
+            for current in indices[indptr[parent]:indptr[parent+1]]:
                 visited = work[current]
                 if visited == -1 or (do_duplicates and visited == current_length):
                     work[current] = current_length
@@ -511,14 +981,15 @@ class Graph(ReadOnly):
                 raise ValueError("start must be in the range [0, %i[" %
                                  self.num_vertices)
         from collections import deque
-        work = numpy.zeros(self.num_vertices, int)
-        work[:] = -1
+        indptr = self.neighbor_indptr.tolist()
+        indices = self.neighbor_indices.tolist()
+        work = [-1]*self.num_vertices
         work[start] = 0
         todo = deque([start])
         while len(todo) > 0:
             parent = todo.popleft()
             distance = work[parent]
-            for current in self.neighbors[parent]:
+            for current in indices[indptr[parent]:indptr[parent+1]]:
                 if work[current] == -1:
                     yield (parent, current), distance, False
                     work[current] = distance+1
@@ -560,75 +1031,73 @@ class Graph(ReadOnly):
            The attribute ``old_vertex_indexes`` is only constructed when
            ``normalize==True``.
         """
+        subvertices = numpy.array(subvertices, dtype=int).ravel()
         if normalize:
-            revorder = dict((j, i) for i, j in enumerate(subvertices))
-            new_edges = []
-            old_edge_indexes = []
-            for counter, (i, j) in enumerate(self.edges):
-                new_i = revorder.get(i)
-                if new_i is None:
-                    continue
-                new_j = revorder.get(j)
-                if new_j is None:
-                    continue
-                new_edges.append((new_i, new_j))
-                old_edge_indexes.append(counter)
-            # sort the edges
-            order = range(len(new_edges))
-            # argsort in pure python
-            order.sort( key=(lambda i: tuple(sorted(new_edges[i]))) )
-            new_edges = [new_edges[i] for i in order]
-            old_edge_indexes = [old_edge_indexes[i] for i in order]
-
-            result = Graph(new_edges, num_vertices=len(subvertices))
-            result._old_vertex_indexes = numpy.array(subvertices, dtype=int)
-            #result.new_vertex_indexes = revorder
-            result._old_edge_indexes = numpy.array(old_edge_indexes, dtype=int)
+            # map the old vertex indexes on the new ones, -1 if not retained.
+            revorder = numpy.zeros(self.num_vertices, int)
+            revorder[:] = -1
+            revorder[subvertices] = numpy.arange(len(subvertices))
+            new_edges = revorder[self.edge_array]
+            old_edge_indexes = (new_edges >= 0).all(axis=1).nonzero()[0]
+            new_edges = new_edges[old_edge_indexes]
+            # sort the edges, a stable sort on the sorted vertex pairs
+            order = numpy.lexsort((new_edges.max(axis=1), new_edges.min(axis=1)))
+            new_edges = new_edges[order]
+            old_edge_indexes = old_edge_indexes[order]
+
+            result = Graph.from_arrays(new_edges, num_vertices=len(subvertices))
+            result._old_vertex_indexes = subvertices
+            result._old_edge_indexes = old_edge_indexes
         else:
-            subvertices = set(subvertices)
-            old_edge_indexes = numpy.array([
-                i for i, edge in enumerate(self.edges)
-                if edge.issubset(subvertices)
-            ], dtype=int)
-            new_edges = tuple(self.edges[i] for i in old_edge_indexes)
-            result = Graph(new_edges, self.num_vertices)
+            retained = numpy.zeros(self.num_vertices, bool)
+            retained[subvertices] = True
+            old_edge_indexes = retained[self.edge_array].all(axis=1).nonzero()[0]
+            new_edges = self.edge_array[old_edge_indexes]
+            result = Graph.from_arrays(new_edges, self.num_vertices)
             result._old_edge_indexes = old_edge_indexes
             # no need for old and new vertex_indexes because they remain the
             # same.
         return result
 
     def get_vertex_fingerprints(self, vertex_strings, edge_strings, num_iter=None):
-        """Return an array with fingerprints for each vertex"""
-        import hashlib
-        def str2array(x):
-            """convert a has string to a numpy array of bytes"""
-            if len(x) == 0:
-                return numpy.zeros(0, numpy.ubyte)
-            else:
-                return numpy.frombuffer(x, numpy.ubyte)
-        hashrow = lambda x: numpy.frombuffer(hashlib.sha1(x.data).digest(), numpy.ubyte)
-        # initialization
-        result = numpy.zeros((self.num_vertices, 20), numpy.ubyte)
-        for i in xrange(self.num_vertices):
-            result[i] = hashrow(str2array(vertex_strings[i]))
-        for i in xrange(self.num_edges):
-            a, b = self.edges[i]
-            tmp = hashrow(str2array(edge_strings[i]))
-            result[a] += tmp
-            result[b] += tmp
-        work = result.copy()
-        # iterations
-        if num_iter is None:
-            num_iter = self.max_distance
-        for i in xrange(num_iter):
-            for a, b in self.edges:
-                work[a] += result[b]
-                work[b] += result[a]
-            #for a in xrange(self.num_vertices):
-            #    for b in xrange(self.num_vertices):
-            #        work[a] += hashrow(result[b]*self.distances[a, b])
-            for a in xrange(self.num_vertices):
-                result[a] = hashrow(work[a])
+        """Return an array with fingerprints for each vertex
+
+           Arguments:
+            | ``vertex_strings``  --  a string for each vertex
+            | ``edge_strings``  --  a string for each edge
+
+           Optional argument:
+            | ``num_iter``  --  the number of refinement iterations. By default
+                                the iterations stop when the fingerprints no
+                                longer split any class of vertices with equal
+                                fingerprints.
+
+           The fingerprints are computed with the Weisfeiler-Lehman algorithm.
+           Each vertex starts with a hash of its string. In every iteration,
+           the new hash of a vertex is derived from its current hash and the
+           sum of the hashes of its neighbors, combined with the strings of
+           the corresponding edges. The result is an array with two 64-bit
+           unsigned integers per vertex.
+        """
+        result = _hash_strings(vertex_strings)
+        # mixed once more to make them differ from the vertex hashes
+        edge_hashes = _mix_hashes(_hash_strings(edge_strings))
+        begin, end = self.edge_array.T
+        num_classes = _count_rows(result)
+        counter = 0
+        while counter < (self.num_vertices if num_iter is None else num_iter):
+            messages = numpy.zeros(result.shape, numpy.uint64)
+            numpy.add.at(messages, begin, _mix_hashes(result[end] + edge_hashes))
+            numpy.add.at(messages, end, _mix_hashes(result[begin] + edge_hashes))
+            result = _mix_hashes(result*numpy.uint64(0x9e3779b97f4a7c15) + messages)
+            counter += 1
+            if num_iter is None:
+                # The partition into classes can only be refined. When the
+                # number of classes does not change, the iterations converged.
+                new_num_classes = _count_rows(result)
+                if new_num_classes == num_classes:
+                    break
+                num_classes = new_num_classes
         return result
 
     def get_halfs(self, vertex1, vertex2):
@@ -820,9 +1289,484 @@ class Graph(ReadOnly):
         return result
 
 
+class _Automorphisms(object):
+    """Base class for objects that hold generators of an automorphism group
+
+       Derived classes must set the following attributes:
+        | ``size``  --  the number of vertices
+        | ``generators``  --  a list of automorphisms. Each automorphism is a
+                              tuple (moved, images) of two integer arrays: the
+                              vertices that are not mapped onto themselves and
+                              their images.
+        | ``base``  --  a list of vertices such that the generators that fix
+                        the first i vertices of the base generate the subgroup
+                        of all automorphisms that fix these vertices. Only the
+                        identity fixes all vertices of the base.
+    """
+
+    def get_orbits(self, fixed=None):
+        """Orbit labels for a subgroup of the automorphism group
+
+           Optional argument:
+            | ``fixed``  --  only the generators that leave these vertices
+                             unchanged are used.
+
+           Returns an array with the same label for all vertices in one orbit.
+           The orbits are numbered in the order of their lowest vertex.
+        """
+        from molmod.ext import graphs_connected_components
+        # all generators in three concatenated arrays, updated when needed
+        stacked = getattr(self, "_stacked", None)
+        if stacked is None or stacked[0] != len(self.generators):
+            stacked = (
+                len(self.generators),
+                numpy.concatenate([moved for moved, images in self.generators] + [[]]).astype(int),
+                numpy.concatenate([images for moved, images in self.generators] + [[]]).astype(int),
+                numpy.repeat(
+                    numpy.arange(len(self.generators)),
+                    [len(moved) for moved, images in self.generators]
+                ),
+            )
+            self._stacked = stacked
+        num, moved, images, owners = stacked
+        excluded = numpy.zeros(num, bool)
+        if fixed is not None and len(fixed) > 0:
+            mask = numpy.zeros(self.size, bool)
+            mask[fixed] = True
+            excluded[owners[mask[moved]]] = True
+        keep = ~excluded[owners]
+        orbits = numpy.zeros(self.size, numpy.int32)
+        edges = numpy.array([moved[keep], images[keep]]).T.astype(numpy.int32)
+        graphs_connected_components(edges, orbits)
+        return orbits
+
+    def get_order(self):
+        """The number of elements in the automorphism group"""
+        result = 1
+        for i, vertex in enumerate(self.base):
+            orbits = self.get_orbits(self.base[:i])
+            result *= int((orbits == orbits[vertex]).sum())
+        return result
+
+    def iter_permutations(self):
+        """Iterate over all automorphisms
+
+           Each automorphism is an integer array with the image of each vertex.
+           They are constructed as products of coset representatives, one for
+           each vertex in the base, such that only the representatives must be
+           kept in memory.
+        """
+        import itertools
+        identity = numpy.arange(self.size)
+        transversals = []
+        for i, vertex in enumerate(self.base):
+            fixed = set(self.base[:i])
+            permutations = []
+            for moved, images in self.generators:
+                if fixed.isdisjoint(moved):
+                    permutation = identity.copy()
+                    permutation[moved] = images
+                    permutations.append(permutation)
+            # representatives that map the base vertex on each vertex of its
+            # orbit (a Schreier tree)
+            representatives = {vertex: identity}
+            todo = [vertex]
+            while len(todo) > 0:
+                current = todo.pop()
+                for permutation in permutations:
+                    image = permutation[current]
+                    if image not in representatives:
+                        representatives[image] = permutation[representatives[current]]
+                        todo.append(image)
+            transversals.append([representatives[key] for key in sorted(representatives)])
+        for representatives in itertools.product(*transversals):
+            result = identity
+            for representative in representatives:
+                result = result[representative]
+            yield result
+
+
+class _CanonicalSearch(_Automorphisms):
+    """Individualization-refinement search for canonical labels and symmetries
+
+       This is a compact version of the search tree in nauty [B.D. McKay and
+       A. Piperno, J. Symb. Comput. 60, 94 (2014)]. The vertices are first
+       divided in ordered cells based on their colors. These cells are split
+       until the neighbors of a vertex no longer distinguish it from the other
+       vertices in its cell. When cells with more than one vertex remain, each
+       vertex of the first such cell is individualized in turn, followed by a
+       new refinement. Every leaf of this search tree is a discrete partition,
+       i.e. a labeling of the vertices. The canonical labeling is the leaf
+       with the largest certificate, which is the sorted list of relabeled
+       edges. Leaves with equal certificates reveal automorphisms, which are
+       used to prune equivalent branches of the tree. Pendant vertices with the
+       same color, attached to the same vertex through the same kind of edge,
+       are interchangeable from the start.
+
+       After construction, the following attributes are available:
+        | ``labels``  --  the position of each vertex in the canonical order
+        | ``certificate``  --  a string that is identical for isomorphic
+                               graphs with the same colors
+        | ``generators``  --  a list of automorphisms found during the search,
+                              which generate the automorphism group
+        | ``base``  --  the vertices individualized on the first path of the
+                        search tree
+
+       The properties of the base follow from the fact that the subtree of each
+       node on the first path is searched completely, except for branches that
+       are equivalent to branches that were already explored.
+    """
+
+    def __init__(self, colors, begin, end, edge_labels, num_edge_labels):
+        """
+           Arguments:
+            | ``colors``  --  an integer array with a color for each vertex.
+                              Only vertices with the same color can be mapped
+                              onto each other.
+            | ``begin``, ``end``  --  two integer arrays with the vertex
+                                      indexes of the edges
+            | ``edge_labels``  --  an integer array with a label for each
+                                   edge, in the range [0, num_edge_labels[
+            | ``num_edge_labels``  --  the number of different edge labels
+        """
+        self.size = len(colors)
+        self.begin = begin
+        self.end = end
+        self.edge_labels = edge_labels
+        self.num_edge_labels = num_edge_labels
+        self.edge_hashes = _mix_hashes(edge_labels.astype(numpy.uint64) + numpy.uint64(1))
+        self.generators = []
+        self.base = []
+        self._add_pendant_twins(colors)
+        cells, num_cells = self._split(numpy.zeros(self.size, int), colors)
+        self._search(*self._refine(cells, num_cells))
+
+    def _add_pendant_twins(self, colors):
+        """Add the transpositions of equivalent pendant vertices"""
+        degrees = numpy.bincount(self.begin, minlength=self.size) + \
+                  numpy.bincount(self.end, minlength=self.size)
+        mask = degrees[self.begin] == 1
+        pendant = numpy.concatenate([self.begin[mask], self.end[degrees[self.end] == 1]])
+        anchor = numpy.concatenate([self.end[mask], self.begin[degrees[self.end] == 1]])
+        labels = numpy.concatenate([self.edge_labels[mask], self.edge_labels[degrees[self.end] == 1]])
+        order = numpy.lexsort((pendant, labels, colors[pendant], anchor))
+        pendant = pendant[order]
+        same = (anchor[order][1:] == anchor[order][:-1]) & \
+               (labels[order][1:] == labels[order][:-1]) & \
+               (colors[pendant][1:] == colors[pendant][:-1])
+        for i in same.nonzero()[0]:
+            moved = pendant[i:i+2]
+            self.generators.append((moved, moved[::-1]))
+
+    def _split(self, cells, codes):
+        """Split the cells of a partition based on an integer code per vertex
+
+           A partition is represented by an array with for each vertex the
+           position of the first vertex of its cell in the ordered partition.
+           The new cells are sorted by code within each original cell.
+
+           Returns the new partition and its number of cells.
+        """
+        order = numpy.lexsort((codes, cells))
+        sorted_cells = cells[order]
+        sorted_codes = codes[order]
+        first = numpy.ones(self.size, bool)
+        first[1:] = (sorted_cells[1:] != sorted_cells[:-1]) | (sorted_codes[1:] != sorted_codes[:-1])
+        starts = numpy.arange(self.size)
+        starts[~first] = 0
+        result = numpy.zeros(self.size, int)
+        result[order] = numpy.maximum.accumulate(starts)
+        return result, first.sum()
+
+    def _refine(self, cells, num_cells):
+        """Split cells until the partition no longer changes
+
+           In each iteration, the vertices in a cell are distinguished by the
+           (hashed) multiset of cells and edge labels of their neighbors.
+        """
+        while num_cells < self.size:
+            codes = numpy.zeros(self.size, numpy.uint64)
+            hashes = cells.astype(numpy.uint64)*numpy.uint64(0x9e3779b97f4a7c15)
+            numpy.add.at(codes, self.begin, _mix_hashes(hashes[self.end] ^ self.edge_hashes))
+            numpy.add.at(codes, self.end, _mix_hashes(hashes[self.begin] ^ self.edge_hashes))
+            cells, new_num_cells = self._split(cells, codes)
+            if new_num_cells == num_cells:
+                break
+            num_cells = new_num_cells
+        return cells, num_cells
+
+    def _individualize(self, cells, num_cells, vertex):
+        """Put a vertex in front of its cell and refine the partition"""
+        cells = cells.copy()
+        mask = cells == cells[vertex]
+        mask[vertex] = False
+        cells[mask] += 1
+        return self._refine(cells, num_cells + 1)
+
+    def _get_certificate(self, labels):
+        """A string representation of the graph relabeled by a leaf"""
+        a = labels[self.begin]
+        b = labels[self.end]
+        codes = numpy.maximum(a, b)*self.size + numpy.minimum(a, b)
+        codes = codes*self.num_edge_labels + self.edge_labels
+        codes.sort()
+        # big-endian: comparing strings is equivalent to comparing the codes
+        return codes.astype(">i8").tostring()
+
+    def _add_generator(self, labels0, labels1):
+        """Store the automorphism that maps one leaf onto another"""
+        images = labels1.argsort()[labels0]
+        moved = (images != numpy.arange(self.size)).nonzero()[0]
+        if len(moved) > 0:
+            self.generators.append((moved, images[moved]))
+
+    def _search(self, cells, num_cells):
+        """Walk through the search tree, starting from the refined root"""
+        # Each frame on the stack corresponds to a node that is not a leaf:
+        # [cells, num_cells, path, candidates, index of next candidate,
+        #  explored candidates, on the first path].
+        stack = []
+        node = (cells, num_cells, [], True)
+        first_labels = None
+        while True:
+            if node is not None:
+                cells, num_cells, path, on_first_path = node
+                node = None
+                if num_cells == self.size:
+                    certificate = self._get_certificate(cells)
+                    if first_labels is None:
+                        first_labels = cells
+                        first_certificate = certificate
+                        self.labels = cells
+                        self.certificate = certificate
+                    elif certificate == first_certificate:
+                        self._add_generator(first_labels, cells)
+                        # The subtree of the node on the first path where the
+                        # current path branched off, is equivalent to the
+                        # subtree of the first path. Jump back to that node.
+                        while not stack[-1][-1]:
+                            stack.pop()
+                    elif certificate == self.certificate:
+                        self._add_generator(self.labels, cells)
+                    elif certificate > self.certificate:
+                        self.labels = cells
+                        self.certificate = certificate
+                else:
+                    counts = numpy.bincount(cells, minlength=self.size)
+                    target = (counts > 1).nonzero()[0][0]
+                    candidates = (cells == target).nonzero()[0]
+                    stack.append([cells, num_cells, path, candidates, 0, [], on_first_path])
+            if len(stack) == 0:
+                break
+            # select the next child of the node on top of the stack that is not
+            # equivalent to a child that was already explored
+            frame = stack[-1]
+            cells, num_cells, path, candidates, index, explored, on_first_path = frame
+            if len(explored) > 0:
+                orbits = self.get_orbits(path)
+                explored_orbits = set(orbits[explored])
+                while index < len(candidates) and orbits[candidates[index]] in explored_orbits:
+                    index += 1
+            if index == len(candidates):
+                stack.pop()
+                continue
+            vertex = candidates[index]
+            if on_first_path and len(explored) == 0:
+                self.base.append(vertex)
+            frame[4] = index + 1
+            explored.append(vertex)
+            node = self._individualize(cells, num_cells, vertex) + (
+                path + [vertex], on_first_path and len(explored) == 1
+            )
+
+
+class _CanonicalLabeling(_Automorphisms):
+    """Canonical labels and automorphisms of a graph
+
+       Each connected component is labeled separately with a _CanonicalSearch.
+       The components are then sorted by their certificates, such that
+       isomorphic components become consecutive in the canonical order. The
+       automorphisms of the graph are generated by the automorphisms of the
+       components and the swaps of isomorphic components.
+
+       After construction, the following attributes are available:
+        | ``labels``  --  the position of each vertex in the canonical order
+        | ``certificate``  --  a string that is identical for isomorphic graphs
+        | ``vertex_strings``  --  the vertex strings in the canonical order
+        | ``edge_table``  --  the sorted list of different edge strings
+        | ``generators``  --  a list of automorphisms, which generate the
+                              automorphism group
+        | ``base``  --  one vertex of each interchangeable component without
+                        automorphisms, followed by the bases of the components
+    """
+
+    def __init__(self, graph):
+        """
+           Argument:
+            | ``graph``  --  the graph to be labeled
+        """
+        size = graph.num_vertices
+        vertex_strings = [graph.get_vertex_string(i) for i in xrange(size)]
+        edge_strings = [graph.get_edge_string(i) for i in xrange(graph.num_edges)]
+        # Edge labels are the ranks in the sorted list of distinct edge strings.
+        self.edge_table = sorted(set(edge_strings))
+        ranks = dict((string, rank) for rank, string in enumerate(self.edge_table))
+        edge_labels = numpy.array([ranks[string] for string in edge_strings], int)
+        # Vertex colors are the ranks of the vertex strings and fingerprints.
+        keys = [
+            (string, str(buffer(row))) for string, row
+            in zip(vertex_strings, graph.vertex_fingerprints)
+        ]
+        ranks = dict((key, rank) for rank, key in enumerate(sorted(set(keys))))
+        colors = numpy.array([ranks[key] for key in keys], int)
+
+        # Group the vertices and edges per component. The local index of a
+        # vertex is its position in its component.
+        components = graph.component_labels
+        num_components = components.max() + 1 if size > 0 else 0
+        vertex_order = components.argsort(kind="mergesort")
+        vertex_starts = numpy.zeros(num_components+1, int)
+        vertex_starts[1:] = numpy.bincount(components, minlength=num_components).cumsum()
+        local = numpy.zeros(size, int)
+        local[vertex_order] = numpy.arange(size) - vertex_starts[components[vertex_order]]
+        begin = graph.edge_array[:,0].astype(int)
+        end = graph.edge_array[:,1].astype(int)
+        edge_order = components[begin].argsort(kind="mergesort")
+        edge_starts = numpy.zeros(num_components+1, int)
+        edge_starts[1:] = numpy.bincount(components[begin], minlength=num_components).cumsum()
+
+        # Label each component. Components with exactly the same local arrays
+        # are only searched once.
+        searches = {}
+        results = []
+        for i in xrange(num_components):
+            vertices = vertex_order[vertex_starts[i]:vertex_starts[i+1]]
+            edges = edge_order[edge_starts[i]:edge_starts[i+1]]
+            arrays = (
+                colors[vertices], local[begin[edges]], local[end[edges]],
+                edge_labels[edges]
+            )
+            key = "".join(array.tostring() for array in arrays)
+            search = searches.get(key)
+            if search is None:
+                search = _CanonicalSearch(*(arrays + (len(self.edge_table),)))
+                searches[key] = search
+            sorted_colors = numpy.zeros(len(vertices), int)
+            sorted_colors[search.labels] = arrays[0]
+            certificate = numpy.array([len(vertices), len(search.certificate)], ">i8").tostring() + \
+                          sorted_colors.astype(">i8").tostring() + search.certificate
+            results.append((certificate, vertices, search))
+
+        # Sort the components and assign the global labels.
+        results.sort(key=(lambda result: result[0]))
+        self.size = size
+        self.labels = numpy.zeros(size, int)
+        self.generators = []
+        # The swaps of isomorphic components without automorphisms (e.g.
+        # isolated vertices) do not move any vertex of the component bases.
+        # One vertex of each such component, except the last one of a series,
+        # is added to the base, before the bases of the components.
+        swap_base = []
+        component_base = []
+        offset = 0
+        previous = None
+        for certificate, vertices, search in results:
+            self.labels[vertices] = search.labels + offset
+            offset += len(vertices)
+            for moved, images in search.generators:
+                self.generators.append((vertices[moved], vertices[images]))
+            component_base.extend(vertices[search.base])
+            # swap with the previous component if both are isomorphic
+            sorted_vertices = vertices[search.labels.argsort()]
+            if previous is not None and previous[0] == certificate:
+                moved = numpy.concatenate([previous[1], sorted_vertices])
+                images = numpy.concatenate([sorted_vertices, previous[1]])
+                self.generators.append((moved, images))
+                if len(search.base) == 0:
+                    swap_base.append(previous[1][0])
+            previous = certificate, sorted_vertices
+        self.base = swap_base + component_base
+        self.certificate = "".join(result[0] for result in results)
+        order = self.labels.argsort()
+        self.vertex_strings = [vertex_strings[i] for i in order]
+
 # Pattern matching
 
 
+class _SubjectIndex(object):
+    """The vertices of a subject graph, bucketed for the graph search
+
+       The vertices are grouped by their vertex string and their degree. These
+       buckets are refined by the fingerprint class of the vertices, which is
+       only computed when a pattern asks for it. All lookups return the
+       vertices in increasing order, such that a graph search visits them in
+       the same order as a plain loop over all vertices.
+    """
+
+    def __init__(self, graph):
+        """
+           Argument:
+            | ``graph``  --  the subject graph
+        """
+        self.graph = graph
+        self.degrees = numpy.diff(graph.neighbor_indptr)
+        buckets = {}
+        for vertex1 in xrange(graph.num_vertices):
+            key = graph.get_vertex_string(vertex1), self.degrees[vertex1]
+            buckets.setdefault(key, []).append(vertex1)
+        self.buckets = dict(
+            (key, numpy.array(vertices)) for key, vertices in buckets.iteritems()
+        )
+        self._fingerprint_buckets = None
+
+    def _get_fingerprint_buckets(self):
+        """A dictionary with the vertices for each fingerprint class"""
+        if self._fingerprint_buckets is None:
+            buckets = {}
+            for vertex1, row in enumerate(self.graph.vertex_fingerprints):
+                buckets.setdefault(row.tostring(), []).append(vertex1)
+            self._fingerprint_buckets = dict(
+                (key, numpy.array(vertices)) for key, vertices
+                in buckets.iteritems()
+            )
+        return self._fingerprint_buckets
+
+    def get_vertices(self, degree, exact=False, vertex_string=None, fingerprint=None):
+        """Return the vertices that may be related to a pattern vertex
+
+           Arguments:
+            | ``degree``  --  the minimum number of neighbors
+
+           Optional arguments:
+            | ``exact``  --  when True, the number of neighbors must be equal
+                             to ``degree``
+            | ``vertex_string``  --  when given, only vertices with this
+                                     vertex string are returned
+            | ``fingerprint``  --  when given, only vertices with this
+                                   fingerprint are returned
+
+           The result is a sorted array with vertex indexes.
+        """
+        selected = [
+            vertices for (string, degree1), vertices in self.buckets.iteritems()
+            if (degree1 == degree if exact else degree1 >= degree) and
+               (vertex_string is None or string == vertex_string)
+        ]
+        if len(selected) == 0:
+            return numpy.zeros(0, int)
+        result = numpy.concatenate(selected)
+        if fingerprint is not None:
+            vertices = self._get_fingerprint_buckets().get(
+                numpy.asarray(fingerprint).tostring()
+            )
+            if vertices is None:
+                return numpy.zeros(0, int)
+            result = numpy.intersect1d(result, vertices)
+        else:
+            result.sort()
+        return result
+
+
 class OneToOne(object):
     """Implements a discrete bijection between source and destination elements
 
@@ -934,6 +1878,202 @@ class Match(OneToOne):
         return result
 
 
+class _MatchView(object):
+    """A dictionary-like view on the relations in a :class:`_MatchState`"""
+
+    def __init__(self, state, values, sources):
+        """
+           Arguments:
+            | ``state``  --  the match state
+            | ``values``  --  the list with the destination of each source,
+                              -1 if the source is not related
+            | ``sources``  --  a function that returns the sources in the match
+        """
+        self._state = state
+        self._values = values
+        self._sources = sources
+
+    def get(self, key, default=None):
+        """Return the destination of key, or default if it is not related"""
+        if 0 <= key < len(self._values):
+            value = self._values[key]
+            if value != -1:
+                return value
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __delitem__(self, key):
+        self[key]
+        self._values[key] = -1
+        if self._values is self._state._forward:
+            self._state._size -= 1
+
+    def __len__(self):
+        return len(self._state)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        """The sources in the match"""
+        return [key for key in self._sources() if self._values[key] != -1]
+
+    def iteritems(self):
+        """Iterate over all (source, destination) pairs"""
+        for key in self.keys():
+            yield key, self._values[key]
+
+
+class _MatchState(object):
+    """The partial match of a graph search, modified in place
+
+       The relations are stored in two preallocated lists: the subject vertex
+       of each pattern vertex and the pattern vertex of each subject vertex.
+       Unrelated vertices are marked with -1. Plain lists are used because the
+       search accesses them one element at a time. The search extends the
+       state with a set of new relations and rolls them back after all
+       completions of the extended match are visited. A :class:`Match` object
+       is only created for a completed match.
+
+       The state has the interface of a :class:`Match` that is used by the
+       patterns: ``forward``, ``reverse``, ``len``, ``add_relation`` and
+       ``get_new_edges``. Attributes assigned by a pattern, such as
+       ``ring_vertices``, are transferred to the completed match and removed
+       when the relations are rolled back. The pattern vertices must be
+       non-negative integers.
+    """
+
+    def __init__(self, vertex0, vertex1, num_vertices1):
+        """
+           Arguments:
+            | ``vertex0``  --  the first vertex in the pattern graph
+            | ``vertex1``  --  the related vertex in the subject graph
+            | ``num_vertices1``  --  the number of vertices in the subject graph
+        """
+        self._forward = []
+        self._reverse = [-1]*num_vertices1
+        self._sources = []
+        self._size = 0
+        self._marks = []
+        self._forward_view = _MatchView(self, self._forward, lambda: self._sources)
+        self._reverse_view = _MatchView(self, self._reverse, self._get_destinations)
+        self.add_relation(vertex0, vertex1)
+        self._ends1 = set([vertex1])
+
+    def _get_destinations(self):
+        """The subject vertices in the match"""
+        return [
+            self._forward[source] for source in self._sources
+            if self._forward[source] != -1
+        ]
+
+    @property
+    def forward(self):
+        """A view on the relations from the pattern to the subject graph"""
+        return self._forward_view
+
+    @property
+    def reverse(self):
+        """A view on the relations from the subject to the pattern graph"""
+        return self._reverse_view
+
+    def __len__(self):
+        return self._size
+
+    def __str__(self):
+        result = "|"
+        for source, destination in self.forward.iteritems():
+            result += " %s -> %s |" % (source, destination)
+        return result
+
+    def __mul__(self, other):
+        """Return the result of the 'after' operator."""
+        result = OneToOne()
+        for source, mid in other.forward.iteritems():
+            destination = self._forward[mid]
+            result.forward[source] = destination
+            result.reverse[destination] = source
+        return result
+
+    def add_relation(self, source, destination):
+        """Add a new relation to the match"""
+        if source < len(self._forward) and self._forward[source] != -1:
+            raise ValueError("Source is already in use.")
+        if self._reverse[destination] != -1:
+            raise ValueError("Destination is already in use.")
+        if source >= len(self._forward):
+            self._forward.extend([-1]*(source + 1 - len(self._forward)))
+        self._forward[source] = destination
+        self._reverse[destination] = source
+        self._sources.append(source)
+        self._size += 1
+
+    def get_new_edges(self, subject_graph):
+        """See :meth:`Match.get_new_edges`"""
+        result = []
+        reverse = self._reverse
+        for vertex in self._ends1:
+            for neighbor in subject_graph.neighbors[vertex]:
+                if reverse[neighbor] == -1:
+                    result.append((vertex, neighbor))
+        return result
+
+    def push(self, new_relations):
+        """Extend the match with a dictionary of new relations
+
+           The relations are not checked. The sources and destinations must
+           not be in the match yet.
+        """
+        self._marks.append((len(self._sources), self._ends1))
+        forward = self._forward
+        reverse = self._reverse
+        for source, destination in new_relations.iteritems():
+            if source >= len(forward):
+                forward.extend([-1]*(source + 1 - len(forward)))
+            forward[source] = destination
+            reverse[destination] = source
+            self._sources.append(source)
+        self._size += len(new_relations)
+        self._ends1 = set(new_relations.itervalues())
+
+    def pop(self):
+        """Undo all changes since the last call to push"""
+        num_sources, self._ends1 = self._marks.pop()
+        for source in self._sources[num_sources:]:
+            destination = self._forward[source]
+            if destination != -1:
+                self._forward[source] = -1
+                self._reverse[destination] = -1
+                self._size -= 1
+        del self._sources[num_sources:]
+        for key in self.__dict__.keys():
+            if not key.startswith("_"):
+                del self.__dict__[key]
+
+    def get_match(self, MatchClass):
+        """Return a new match object with the current relations"""
+        result = MatchClass()
+        forward = self._forward
+        for source in self._sources:
+            destination = forward[source]
+            if destination != -1:
+                result.forward[source] = destination
+                result.reverse[destination] = source
+        result.previous_ends1 = set(self._ends1)
+        for key, value in self.__dict__.iteritems():
+            if not key.startswith("_"):
+                setattr(result, key, value)
+        return result
+
+
 class Pattern(object):
     """Base class for a pattern in a graph.
 
@@ -982,6 +2122,28 @@ class Pattern(object):
         """
         return True
 
+    def get_num_unmatched_neighbors(self, vertex0):
+        """The number of neighbors of ``vertex0`` that are matched after it
+
+           When a relation with ``vertex0`` is added to a match, the related
+           subject vertex must have at least this number of neighbors that are
+           not part of the match yet (exactly this number when ``sub`` is
+           False). The :class:`GraphSearch` uses this for a look-ahead that
+           discards relations before they are combined. None disables the
+           look-ahead.
+        """
+        return None
+
+    def get_candidate_masks(self, subject_graph):
+        """Boolean arrays with the subject vertices that may match a vertex
+
+           The result is a dictionary with a mask for some pattern vertices.
+           The :class:`GraphSearch` computes it once at the beginning of a
+           search and only relates a pattern vertex to the subject vertices in
+           its mask. These masks are not used when only one match is sought.
+        """
+        return {}
+
     def check_next_match(self, match, new_relations, subject_graph, one_match):
         """Does this match object make sense for the current pattern
 
@@ -1030,11 +2192,29 @@ class CriteriaSet(object):
             self.edge_criteria = edge_criteria
         self.info = kwargs
 
+    def get_vertex_masks(self, subject_graph):
+        """Return the masks of the vertex criteria for a subject graph
+
+           The result is a dictionary with a boolean array for each pattern
+           vertex whose criterion has a mask. The masks are computed only once
+           for each subject graph.
+        """
+        result = {}
+        for vertex0, c in self.vertex_criteria.iteritems():
+            mask = _get_mask(c, subject_graph)
+            if mask is not None:
+                result[vertex0] = mask
+        return result
+
     def test_match(self, match, pattern_graph, subject_graph):
         """Test if a match satisfies the criteria"""
         for vertex0, c in self.vertex_criteria.iteritems():
             vertex1 = match.forward[vertex0]
-            if not c(vertex1, subject_graph):
+            mask = _get_mask(c, subject_graph)
+            if mask is None:
+                if not _test_criterion(c, vertex1, subject_graph):
+                    return False
+            elif not mask[vertex1]:
                 return False
         for edge0_index, c in self.edge_criteria.iteritems():
             vertex0a, vertex0b = pattern_graph.edges[edge0_index]
@@ -1042,11 +2222,62 @@ class CriteriaSet(object):
                 match.forward[vertex0a],
                 match.forward[vertex0b],
             ])]
-            if not c(edge1_index, subject_graph):
+            if not _test_criterion(c, edge1_index, subject_graph, True):
                 return False
         return True
 
 # few basic example criteria
+#
+# A criterion may have a method mask(graph) that returns a boolean array with
+# the result of the criterion for all vertices of the graph at once. It may
+# return None when the mask can not be computed, e.g. because it depends on
+# criteria without such a method.
+
+
+def _get_mask(criterion, graph):
+    """Return the mask of a vertex criterion for a graph, or None
+
+       The mask is computed only once for each graph.
+    """
+    masks = graph._masks
+    if criterion in masks:
+        return masks[criterion]
+    fn = getattr(criterion, "mask", None)
+    if fn is None:
+        result = None
+    else:
+        result = fn(graph)
+    masks[criterion] = result
+    return result
+
+
+def _get_masks(criteria, graph):
+    """Return the masks of a list of criteria, or None if one is missing"""
+    result = []
+    for criterion in criteria:
+        mask = _get_mask(criterion, graph)
+        if mask is None:
+            return None
+        result.append(mask)
+    return result
+
+
+def _test_criterion(criterion, index, graph, edge=False):
+    """Test a vertex or edge criterion without a mask
+
+       The result for each vertex or edge of a graph is computed only once.
+    """
+    key = criterion, edge
+    results = graph._masks.get(key)
+    if results is None:
+        results = {}
+        graph._masks[key] = results
+    result = results.get(index)
+    if result is None:
+        result = bool(criterion(index, graph))
+        results[index] = result
+    return result
+
 
 class Anything(object):
     """A criterion that always returns True"""
@@ -1054,6 +2285,10 @@ class Anything(object):
         """Always returns True"""
         return True
 
+    def mask(self, graph):
+        """Returns an array where all vertices are True"""
+        return numpy.ones(graph.num_vertices, bool)
+
 
 class CritOr(object):
     """OR Operator for criteria objects"""
@@ -1078,6 +2313,16 @@ class CritOr(object):
                 return True
         return False
 
+    def mask(self, graph):
+        """The OR operation on the masks of all criteria, if available"""
+        masks = _get_masks(self.criteria, graph)
+        if masks is None:
+            return None
+        result = numpy.zeros(graph.num_vertices, bool)
+        for mask in masks:
+            result |= mask
+        return result
+
 
 class CritAnd(object):
     """AND Operator for criteria objects"""
@@ -1102,6 +2347,16 @@ class CritAnd(object):
                 return False
         return True
 
+    def mask(self, graph):
+        """The AND operation on the masks of all criteria, if available"""
+        masks = _get_masks(self.criteria, graph)
+        if masks is None:
+            return None
+        result = numpy.ones(graph.num_vertices, bool)
+        for mask in masks:
+            result &= mask
+        return result
+
 
 class CritXor(object):
     """XOR Operator for criteria objects"""
@@ -1130,6 +2385,16 @@ class CritXor(object):
                 count += 1
         return (count % 2) == 1
 
+    def mask(self, graph):
+        """The XOR operation on the masks of all criteria, if available"""
+        masks = _get_masks(self.criteria, graph)
+        if masks is None:
+            return None
+        result = numpy.zeros(graph.num_vertices, bool)
+        for mask in masks:
+            result ^= mask
+        return result
+
 
 class CritNot(object):
     """Inverion of another criterion"""
@@ -1151,6 +2416,13 @@ class CritNot(object):
         """
         return not self.criterion(index, graph)
 
+    def mask(self, graph):
+        """The inversion of the mask of the criterion, if available"""
+        mask = _get_mask(self.criterion, graph)
+        if mask is None:
+            return None
+        return ~mask
+
 
 # pattern and match stuff
 
@@ -1207,6 +2479,7 @@ class CustomPattern(Pattern):
         self.level_edges = {}
         self.level_constraints = {}
         self.duplicate_checks = set([])
+        self.num_unmatched_neighbors = {}
         if pattern_graph is None:
             return
         if len(pattern_graph.independent_vertices) != 1:
@@ -1228,15 +2501,80 @@ class CustomPattern(Pattern):
             for cycles in pattern_graph.symmetry_cycles:
                 if len(cycles) > 0:
                     self.duplicate_checks.add((cycles[0][0], cycles[0][1]))
+        # C) The neighbors of a vertex that are not closer to the start vertex
+        # are matched in the same or later levels.
+        distances = dict(pattern_graph.iter_breadth_first(self.start_vertex))
+        for vertex0, distance in distances.iteritems():
+            self.num_unmatched_neighbors[vertex0] = sum(
+                distances[neighbor] >= distance
+                for neighbor in pattern_graph.neighbors[vertex0]
+            )
+
+    def get_candidate_masks(self, subject_graph):
+        """See :meth:`Pattern.get_candidate_masks`
+
+           A canonical match may relate vertex0 to vertex1 when a symmetric
+           image of vertex0 satisfies its vertex criterion in vertex1, for at
+           least one criteria set. Pattern vertices with a criterion without a
+           mask are not included in the dictionary.
+        """
+        result = {}
+        if self.criteria_sets:
+            orbits = self.pattern_graph.automorphism_orbits
+            for vertex0 in xrange(self.pattern_graph.num_vertices):
+                images = (orbits == orbits[vertex0]).nonzero()[0].tolist()
+                mask = numpy.zeros(subject_graph.num_vertices, bool)
+                for criteria_set in self.criteria_sets:
+                    vertex_masks = criteria_set.get_vertex_masks(subject_graph)
+                    if not all(image in vertex_masks for image in images):
+                        mask = None
+                        break
+                    for image in images:
+                        mask |= vertex_masks[image]
+                if mask is not None:
+                    result[vertex0] = mask
+        return result
 
+    def _get_initial_vertices(self, subject_graph):
+        """The subject vertices that may be related to the start vertex"""
+        return subject_graph._subject_index.get_vertices(
+            self.num_unmatched_neighbors[self.start_vertex], not self.sub
+        )
 
     def iter_initial_relations(self, subject_graph):
         """Iterate over all valid initial relations for a match"""
         vertex0 = self.start_vertex
-        for vertex1 in xrange(subject_graph.num_vertices):
+        for vertex1 in self._get_initial_vertices(subject_graph):
+            vertex1 = int(vertex1)
             if self.compare(vertex0, vertex1, subject_graph):
                 yield vertex0, vertex1
 
+    def get_num_unmatched_neighbors(self, vertex0):
+        """See :meth:`Pattern.get_num_unmatched_neighbors`"""
+        return self.num_unmatched_neighbors[vertex0]
+
+    def compile(self):
+        """Return an immutable :class:`SearchPlan` for this pattern
+
+           The plan is meant to search for the same pattern in a large number
+           of subject graphs, possibly with several processes.
+        """
+        return SearchPlan(self)
+
+    def get_traversal_key(self):
+        """A key that is equal for patterns that grow the same matches
+
+           Patterns with the same key only differ in their criteria sets and
+           vertex tags. Apart from the filtering with criteria masks, they
+           produce the same canonical matches, such that a
+           :class:`MultiPatternSearch` can share the graph search among them.
+        """
+        return (
+            self.__class__, self.pattern_graph.num_vertices,
+            tuple(tuple(edge) for edge in self.pattern_graph.edges),
+            self.start_vertex, self.criteria_sets is None,
+        )
+
     def get_new_edges(self, level):
         """Get new edges from the pattern graph for the graph search algorithm
 
@@ -1391,6 +2729,21 @@ class EqualPattern(CustomPattern):
         for pair in CustomPattern.iter_initial_relations(self, subject_graph):
             yield pair
 
+    def get_traversal_key(self):
+        """See :meth:`CustomPattern.get_traversal_key`"""
+        return CustomPattern.get_traversal_key(self) + (
+            self.pattern_graph.vertex_fingerprints.tostring(),
+        )
+
+    def _get_initial_vertices(self, subject_graph):
+        """The subject vertices that may be related to the start vertex"""
+        vertex0 = self.start_vertex
+        return subject_graph._subject_index.get_vertices(
+            self.num_unmatched_neighbors[vertex0], True,
+            self.pattern_graph.get_vertex_string(vertex0),
+            self.pattern_graph.vertex_fingerprints[vertex0],
+        )
+
     def compare(self, vertex0, vertex1, subject_graph):
         """Returns true when the two vertices are of the same kind"""
         return (
@@ -1530,6 +2883,31 @@ class RingPattern(Pattern):
         return False
 
 
+# The graph search and the subject graph in a worker process of a GraphSearch
+_search_worker_args = None
+
+
+def _init_search_worker(graph_search, subject_graph, one_match):
+    """Store the arguments of a parallel graph search in a worker process"""
+    global _search_worker_args
+    masks = graph_search._get_candidate_masks(subject_graph, one_match)
+    _search_worker_args = graph_search, subject_graph, one_match, masks
+
+
+def _search_initial_relation(initial_relation):
+    """Return the final matches that follow from one initial relation"""
+    graph_search, subject_graph, one_match, masks = _search_worker_args
+    result = []
+    ifm = graph_search._iter_final_matches(
+        subject_graph, one_match, [initial_relation], masks
+    )
+    for final_match in ifm:
+        result.append(final_match)
+        if one_match:
+            break
+    return result
+
+
 class GraphSearch(object):
     """An algorithm that searches for all matches of a pattern in a graph
 
@@ -1540,16 +2918,27 @@ class GraphSearch(object):
          ...     print match.forward
     """
 
-    def __init__(self, pattern, debug=False):
+    def __init__(self, pattern, debug=False, workers=None, ordered=False):
         """
            Arguments:
             | ``pattern``  --  A Pattern instance, describing the pattern to
                                look for
             | ``debug``  --  When true, debugging info is printed on screen
                              [default=False]
+            | ``workers``  --  When larger than one, the initial relations are
+                               distributed over a pool of worker processes.
+                               The subject graph is passed once to each
+                               worker. The pattern and the matches must be
+                               picklable. [default=None]
+            | ``ordered``  --  When True, the matches found by the workers are
+                               yielded in the same order as in a serial
+                               search. Otherwise they are yielded as soon as
+                               they are found. [default=False]
         """
         self.pattern = pattern
         self.debug = debug
+        self.workers = workers
+        self.ordered = ordered
 
     def __call__(self, subject_graph, one_match=False):
         """Iterator over all matches of self.pattern in the given graph.
@@ -1560,22 +2949,131 @@ class GraphSearch(object):
             | one_match --  If True, only one match will be returned. This
                             allows certain optimizations.
         """
-        # Matches are grown iteratively.
+        if self.workers is not None and self.workers > 1:
+            ifm = self._iter_final_matches_pool(subject_graph, one_match)
+        else:
+            ifm = self._iter_final_matches(subject_graph, one_match)
+        for final_match in ifm:
+            yield final_match
+            if one_match: return
+
+    def _iter_final_matches(self, subject_graph, one_match, initial_relations=None, masks=None):
+        """Iterate over the final matches that follow from initial relations"""
+        icm = self._iter_canonical_matches(subject_graph, one_match, initial_relations, masks)
+        for canonical_match in icm:
+            # Some patterns my exclude symmetrically equivalent matches as
+            # to aviod dupplicates. with such a 'canonical' solution,
+            # the pattern is allowed to generate just those symmatrical
+            # duplicates of interest.
+            ifm = self.pattern.iter_final_matches(canonical_match, subject_graph, one_match)
+            for final_match in ifm:
+                if self.debug:
+                    self.print_debug("final_match: %s" % final_match)
+                yield final_match
+
+    def _iter_final_matches_pool(self, subject_graph, one_match):
+        """Iterate over the final matches, found by a pool of processes"""
+        from multiprocessing import Pool
+        masks = self._get_candidate_masks(subject_graph, one_match)
+        initial_relations = list(self._iter_initial_relations(subject_graph, masks))
+        if len(initial_relations) == 0:
+            return
+        # fill the caches that all workers need before they are started
+        subject_graph.neighbors
+        chunksize = max(1, len(initial_relations)/(4*self.workers))
+        pool = Pool(
+            self.workers, _init_search_worker, (self, subject_graph, one_match)
+        )
+        try:
+            if self.ordered:
+                results = pool.imap(_search_initial_relation, initial_relations, chunksize)
+            else:
+                results = pool.imap_unordered(_search_initial_relation, initial_relations, chunksize)
+            for final_matches in results:
+                for final_match in final_matches:
+                    yield final_match
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _iter_canonical_matches(self, subject_graph, one_match, initial_relations=None, masks=None):
+        """Iterate over the completed matches, before symmetry expansion"""
+        its = self._iter_states(subject_graph, one_match, initial_relations, masks)
+        for state in its:
+            yield state.get_match(self.pattern.MatchClass)
+
+    def _get_candidate_masks(self, subject_graph, one_match):
+        """The candidate masks of the pattern for one search
+
+           The criteria sets are ignored when only one match is sought, so
+           are the masks.
+        """
+        if one_match:
+            return {}
+        return self.pattern.get_candidate_masks(subject_graph)
+
+    def _iter_initial_relations(self, subject_graph, masks):
+        """Iterate over the initial relations that are allowed by the masks"""
         for vertex0, vertex1 in self.pattern.iter_initial_relations(subject_graph):
-            init_match = self.pattern.MatchClass.from_first_relation(vertex0, vertex1)
-            # init_match cotains only one source -> dest relation. starting from
+            mask = masks.get(vertex0)
+            if mask is None or mask[vertex1]:
+                yield vertex0, vertex1
+
+    def _iter_states(self, subject_graph, one_match, initial_relations=None, masks=None):
+        """Iterate over the completed matches as a match state
+
+           The state is modified after each step of the iterator. It must not
+           be stored by the caller.
+        """
+        if masks is None:
+            masks = self._get_candidate_masks(subject_graph, one_match)
+        if initial_relations is None:
+            initial_relations = self._iter_initial_relations(subject_graph, masks)
+        # Matches are grown iteratively.
+        for vertex0, vertex1 in initial_relations:
+            state = _MatchState(vertex0, vertex1, subject_graph.num_vertices)
+            # state cotains only one source -> dest relation. starting from
             # this initial match, the function iter_matches extends the match
             # in all possible ways and yields the completed matches
-            for canonical_match in self._iter_matches(init_match, subject_graph, one_match):
-                # Some patterns my exclude symmetrically equivalent matches as
-                # to aviod dupplicates. with such a 'canonical' solution,
-                # the pattern is allowed to generate just those symmatrical
-                # duplicates of interest.
-                ifm = self.pattern.iter_final_matches(canonical_match, subject_graph, one_match)
-                for final_match in ifm:
-                    self.print_debug("final_match: %s" % final_match)
-                    yield final_match
-                    if one_match: return
+            for state in self._iter_matches(state, subject_graph, one_match, masks):
+                yield state
+
+    def count(self, subject_graph):
+        """Return the number of matches of self.pattern in the given graph
+
+           Argument:
+            | subject_graph  --  The subject_graph in which the matches
+                                 according to self.pattern have to be found.
+
+           The result is the number of matches that would be yielded by the
+           iterator ``self(subject_graph)``, but no match objects are created
+           for the completed matches. The symmetry expansion of some
+           patterns, e.g. with criteria sets, still constructs the final
+           matches.
+        """
+        result = 0
+        for state in self._iter_states(subject_graph, False):
+            ifm = self.pattern.iter_final_matches(state, subject_graph, False)
+            for final_match in ifm:
+                result += 1
+        return result
+
+    def exists(self, subject_graph):
+        """Return True if the pattern occurs in the given graph
+
+           Argument:
+            | subject_graph  --  The subject_graph in which the matches
+                                 according to self.pattern have to be found.
+
+           The search stops at the first match. Unlike the option
+           ``one_match``, the criteria sets of the pattern are taken into
+           account.
+        """
+        for state in self._iter_states(subject_graph, False):
+            ifm = self.pattern.iter_final_matches(state, subject_graph, False)
+            for final_match in ifm:
+                return True
+        return False
 
     def print_debug(self, text, indent=0):
         """Only prints debug info on screen when self.debug == True."""
@@ -1596,7 +3094,7 @@ class GraphSearch(object):
             l.append(end_vertex0)
         dests = {}
         for start_vertex1, end_vertex1 in edges1:
-            start_vertex0 = init_match.reverse[start_vertex1]
+            start_vertex0 = init_match._reverse[start_vertex1]
             l = dests.setdefault(start_vertex0, [])
             l.append(end_vertex1)
         for start_vertex0, end_vertices0 in sources.iteritems():
@@ -1604,7 +3102,7 @@ class GraphSearch(object):
             yield end_vertices0, end_vertices1
 
 
-    def _iter_new_relations(self, init_match, subject_graph, edges0, constraints0, edges1):
+    def _iter_new_relations(self, init_match, subject_graph, edges0, constraints0, edges1, masks):
         """Given an onset for a match, iterate over all possible new key-value pairs"""
         # Count the number of unique edges0[i][1] values. This is also
         # the number of new relations.
@@ -1625,6 +3123,21 @@ class GraphSearch(object):
                     for tail in combine_small(compatible_relations, num-1):
                         yield (pivot, ) + tail
 
+        # The number of neighbors of each subject vertex that are not in the
+        # match yet. This is the room left for the relations of later levels.
+        neighbors1 = subject_graph.neighbors
+        num_unmatched1 = {}
+        def get_num_unmatched1(vertex1):
+            """The number of neighbors of vertex1 outside init_match"""
+            result = num_unmatched1.get(vertex1)
+            if result is None:
+                result = sum(
+                    init_match._reverse[neighbor1] == -1
+                    for neighbor1 in neighbors1[vertex1]
+                )
+                num_unmatched1[vertex1] = result
+            return result
+
         # generate candidate relations
         candidate_relations = []
         icg = self._iter_candidate_groups(init_match, edges0, edges1)
@@ -1635,20 +3148,39 @@ class GraphSearch(object):
                  len(end_vertices0) != len(end_vertices1):
                 return # an exact match is sought, this can never work
             l = []
+            used1 = set([])
             for end_vertex0 in end_vertices0:
+                num_unmatched0 = self.pattern.get_num_unmatched_neighbors(end_vertex0)
+                mask = masks.get(end_vertex0)
+                found = False
                 for end_vertex1 in end_vertices1:
+                    if mask is not None and not mask[end_vertex1]:
+                        continue
+                    # look ahead: is there enough room for the neighbors of
+                    # end_vertex0 that are matched in the next levels?
+                    if num_unmatched0 is not None:
+                        num_unmatched = get_num_unmatched1(end_vertex1)
+                        if num_unmatched < num_unmatched0 or (not
+                           self.pattern.sub and num_unmatched != num_unmatched0):
+                            continue
                     if self.pattern.compare(end_vertex0, end_vertex1, subject_graph):
                         l.append((end_vertex0, end_vertex1))
+                        used1.add(end_vertex1)
+                        found = True
+                if not found:
+                    return # end_vertex0 can not be related to any vertex
+            if len(used1) < len(end_vertices0):
+                return # too few distinct candidates for the pattern vertices
             # len(end_vertices0) = the total number of relations that must be
             # made in this group
-            if len(l) > 0:
-                # turn l into a list of sets of internally compatible candidate
-                # relations in this group
-                l = list(combine_small(l, len(end_vertices0)))
-                candidate_relations.append(l)
+            # turn l into a list of sets of internally compatible candidate
+            # relations in this group
+            l = list(combine_small(l, len(end_vertices0)))
+            candidate_relations.append(l)
         if len(candidate_relations) == 0:
             return
-        self.print_debug("candidate_relations: %s" % candidate_relations)
+        if self.debug:
+            self.print_debug("candidate_relations: %s" % candidate_relations)
 
         def combine_big(pos=0):
             """Iterate over all possible sets of relations"""
@@ -1665,7 +3197,8 @@ class GraphSearch(object):
         # final loop
         for new_relations in combine_big():
             new_relations = set(new_relations)
-            self.print_debug("new_relations: %s" % (new_relations, ))
+            if self.debug:
+                self.print_debug("new_relations: %s" % (new_relations, ))
             # check the total number of new relations
             if len(new_relations) != num_new_relations:
                 continue
@@ -1685,15 +3218,19 @@ class GraphSearch(object):
                 continue
             yield forward
 
-    def _iter_matches(self, input_match, subject_graph, one_match, level=0):
+    def _iter_matches(self, state, subject_graph, one_match, masks, level=0):
         """Given an onset for a match, iterate over all completions of that match
 
            This iterator works recursively. At each level the match is extended
            with a new set of relations based on vertices in the pattern graph
-           that are at a distances 'level' from the starting vertex
+           that are at a distances 'level' from the starting vertex. The
+           argument state is a :class:`_MatchState` that is extended in place
+           and restored before the iterator returns. The argument masks is
+           the result of :meth:`Pattern.get_candidate_masks`.
         """
         self.print_debug("ENTERING _ITER_MATCHES", 1)
-        self.print_debug("input_match: %s" % input_match)
+        if self.debug:
+            self.print_debug("input_match: %s" % state)
         # A) collect the new edges in the pattern graph and the subject graph
         # to extend the match.
         #
@@ -1705,10 +3242,11 @@ class GraphSearch(object):
         # Second note: suffix 0 indicates the pattern graph and suffix 1
         # is used for the subject graph.
         edges0, constraints0 = self.pattern.get_new_edges(level)
-        edges1 = input_match.get_new_edges(subject_graph)
-        self.print_debug("edges0: %s" % edges0)
-        self.print_debug("constraints0: %s" % constraints0)
-        self.print_debug("edges1: %s" % edges1)
+        edges1 = state.get_new_edges(subject_graph)
+        if self.debug:
+            self.print_debug("edges0: %s" % edges0)
+            self.print_debug("constraints0: %s" % constraints0)
+            self.print_debug("edges1: %s" % edges1)
 
         # B) iterate over the sets of new relations: [(vertex0[i], vertex1[j]),
         # ...] that contain all endpoints of edges0, that satisfy the
@@ -1718,16 +3256,185 @@ class GraphSearch(object):
         # separate concerns. This iterator also calls the routines that check
         # whether vertex1[j] also satisfies additional conditions inherent
         # vertex0[i].
-        inr = self._iter_new_relations(input_match, subject_graph, edges0,
-                                       constraints0, edges1)
+        inr = self._iter_new_relations(state, subject_graph, edges0,
+                                       constraints0, edges1, masks)
         for new_relations in inr:
-            # for each set of new_relations, construct a next_match and recurse
-            next_match = input_match.copy_with_new_relations(new_relations)
-            if not self.pattern.check_next_match(next_match, new_relations, subject_graph, one_match):
-                continue
-            if self.pattern.complete(next_match, subject_graph):
-                yield next_match
-            else:
-                for match in self._iter_matches(next_match, subject_graph, one_match, level+1):
-                    yield match
+            # for each set of new_relations, extend the state and recurse
+            state.push(new_relations)
+            if self.pattern.check_next_match(state, new_relations, subject_graph, one_match):
+                if self.pattern.complete(state, subject_graph):
+                    yield state
+                else:
+                    for state in self._iter_matches(state, subject_graph, one_match, masks, level+1):
+                        yield state
+            state.pop()
         self.print_debug("LEAVING_ITER_MATCHES", -1)
+
+
+class MultiPatternSearch(object):
+    """Searches for the matches of many custom patterns at once
+
+       Patterns that only differ in their criteria sets and vertex tags, e.g.
+       a list of BondPatterns for different atom types, share one graph
+       search. Each completed match is passed to all patterns of the group,
+       which yield the final matches that satisfy their criteria sets.
+
+       Usage:
+
+         >>> mps = MultiPatternSearch([pattern_a, pattern_b, pattern_c])
+         >>> for pattern, match in mps(graph):
+         ...     print pattern, match.forward
+    """
+
+    def __init__(self, patterns, debug=False):
+        """
+           Arguments:
+            | ``patterns``  --  A list of CustomPattern instances
+
+           Optional argument:
+            | ``debug``  --  When true, debugging info is printed on screen
+                             [default=False]
+        """
+        self.patterns = patterns
+        # group the patterns by traversal key, in the order of appearance
+        self.groups = []
+        groups = {}
+        for pattern in patterns:
+            key = pattern.get_traversal_key()
+            group = groups.get(key)
+            if group is None:
+                group = []
+                groups[key] = group
+                self.groups.append((GraphSearch(pattern, debug), group))
+            group.append(pattern)
+        # The criteria masks of the shared search must admit the candidates of
+        # all patterns in the group, hence the union of all criteria sets.
+        for graph_search, group in self.groups:
+            if len(group) > 1 and group[0].criteria_sets is not None:
+                leader = copy.copy(group[0])
+                leader.criteria_sets = sum((
+                    list(pattern.criteria_sets) for pattern in group
+                ), [])
+                graph_search.pattern = leader
+
+    def __call__(self, subject_graph):
+        """Iterate over all matches of all patterns in the given graph
+
+           Argument:
+            | ``subject_graph``  --  The graph in which the patterns are
+                                     searched
+
+           This iterator yields tuples (pattern, final_match). The matches of
+           one group of patterns are yielded for each completed match of the
+           graph search, so the matches of the different patterns are
+           interleaved.
+        """
+        for graph_search, group in self.groups:
+            for canonical_match in graph_search._iter_canonical_matches(subject_graph, False):
+                for pattern in group:
+                    ifm = pattern.iter_final_matches(canonical_match, subject_graph, False)
+                    for final_match in ifm:
+                        yield pattern, final_match
+
+
+# The search plan in a worker process of SearchPlan.iter_batch
+_plan_worker_plan = None
+
+
+def _init_plan_worker(plan):
+    """Store the search plan in a worker process"""
+    global _plan_worker_plan
+    _plan_worker_plan = plan
+
+
+def _search_plan_graph(subject_graph):
+    """Return the list of matches of the stored plan in one subject graph"""
+    return list(_plan_worker_plan.iter_matches(subject_graph))
+
+
+class SearchPlan(ReadOnly):
+    """An immutable plan to search for a custom pattern in many graphs
+
+       The plan is created with :meth:`CustomPattern.compile`. It contains a
+       private copy of the pattern, such that later changes to the original
+       pattern do not affect the plan. The result of each criterion for a
+       subject vertex or edge is computed only once per subject graph.
+
+       A plan can be pickled, e.g. to send it to other processes, if the
+       criteria of the pattern can be pickled.
+
+       Usage:
+
+         >>> plan = pattern.compile()
+         >>> for matches in plan.iter_batch(graphs, workers=4):
+         ...     print len(matches)
+    """
+    pattern = ReadOnlyAttribute(CustomPattern, none=False, doc="a private "
+        "copy of the pattern")
+
+    def __init__(self, pattern):
+        """
+           Argument:
+            | ``pattern``  --  a CustomPattern instance
+
+           Later changes to ``pattern`` do not affect the plan.
+        """
+        self.pattern = copy.deepcopy(pattern)
+
+    def iter_matches(self, subject_graph):
+        """Iterate over all matches of the pattern in the given graph
+
+           Argument:
+            | ``subject_graph``  --  The graph in which the matches are
+                                     searched
+
+           The matches are the same as those of a :class:`GraphSearch` with
+           the pattern of this plan.
+        """
+        pattern = self.pattern
+        graph_search = GraphSearch(pattern)
+        for canonical_match in graph_search._iter_canonical_matches(subject_graph, False):
+            ifm = pattern.iter_final_matches(canonical_match, subject_graph, False)
+            for final_match in ifm:
+                yield final_match
+
+    def iter_batch(self, subject_graphs, workers=None, chunksize=16):
+        """Iterate over the matches of the pattern in many graphs
+
+           Argument:
+            | ``subject_graphs``  --  An iterable with subject graphs. It is
+                                      consumed gradually, such that it may be
+                                      a generator that reads a large file.
+
+           Optional arguments:
+            | ``workers``  --  When larger than one, the graphs are sent to a
+                               pool of worker processes. The plan is passed
+                               once to each worker. The graphs and the
+                               matches must be picklable. Note that only the
+                               read-only attributes of a graph are pickled.
+                               [default=None]
+            | ``chunksize``  --  The number of graphs that are sent to a
+                                 worker at once. [default=16]
+
+           For each subject graph, a list with its matches is yielded, in the
+           same order as the graphs.
+        """
+        if workers is None or workers <= 1:
+            for subject_graph in subject_graphs:
+                yield list(self.iter_matches(subject_graph))
+            return
+        import itertools
+        from multiprocessing import Pool
+        subject_graphs = iter(subject_graphs)
+        pool = Pool(workers, _init_plan_worker, (self,))
+        try:
+            while True:
+                # Only a limited number of graphs is loaded in memory.
+                block = list(itertools.islice(subject_graphs, 4*workers*chunksize))
+                if len(block) == 0:
+                    break
+                for matches in pool.imap(_search_plan_graph, block, chunksize):
+                    yield matches
+        finally:
+            pool.terminate()
+            pool.join()
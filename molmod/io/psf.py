@@ -392,11 +392,11 @@ class PSFFile(object):
 
     def get_graph(self):
         """Return the bond graph represented by the data structure"""
-        return Graph(self.bonds)
+        return Graph.from_arrays(self.bonds)
 
     def get_molecular_graph(self):
         """Return the molecular graph represented by the data structure"""
-        return MolecularGraph(self.bonds, self.numbers)
+        return MolecularGraph.from_arrays(self.bonds, self.numbers)
 
     def get_groups(self):
         """Return a list of groups of atom indexes
@@ -39,6 +39,203 @@ __all__ = [
 ]
 
 
+def _get_bond_cutoffs(scaling):
+    """Return a table with the longest bond for each pair of atom numbers"""
+    from molmod.bonds import bonds
+    return numpy.minimum(
+        bonds.max_lengths*(bonds.bond_tolerance*scaling),
+        bonds.max_length*bonds.bond_tolerance
+    )
+
+
+def _find_bonds(coordinates, numbers, unit_cell, scaling):
+    """Find all bonded pairs of atoms, before the 45 degree check
+
+       Returns: ``pairs``, ``deltas``, ``distances``, ``orders``
+    """
+    from molmod.bonds import bonds
+    # Only look for pairs that are within the longest tabulated bond for
+    # their pair of elements. Unknown elements get species zero, for which
+    # no bond lengths are tabulated.
+    cutoff_table = _get_bond_cutoffs(scaling)
+    species = numbers.copy()
+    species[(species < 0) | (species >= len(cutoff_table))] = 0
+    pair_search = PairSearchIntra(
+        coordinates,
+        cutoff_table,
+        unit_cell,
+        species=species
+    )
+    pairs, deltas, distances = pair_search.arrays()
+    orders = bonds.bonded_arrays(
+        numbers[pairs[:,0]], numbers[pairs[:,1]], distances/scaling
+    )
+    mask = orders > 0
+    return pairs[mask], deltas[mask], distances[mask], orders[mask]
+
+
+def _iter_slabs(coordinates, unit_cell, num_slabs, halo):
+    """Divide the atoms in slabs with a halo
+
+       Arguments:
+        | ``coordinates``  --  the Cartesian coordinates of all atoms
+        | ``unit_cell``  --  the periodic boundary conditions, or None
+        | ``num_slabs``  --  the number of slabs
+        | ``halo``  --  the thickness of the halo on both sides of a slab
+
+       The slabs are perpendicular to the active cell vector with the largest
+       spacing, or else to the Cartesian axis with the largest extent. Yields
+       tuples (``atoms``, ``owned``) with the sorted indexes of the atoms in the
+       slab and its halo, and a mask for the atoms that belong to the slab.
+    """
+    if unit_cell is not None and unit_cell.active.any():
+        spacings = unit_cell.spacings*unit_cell.active
+        axis = spacings.argmax()
+        fractional = unit_cell.to_fractional(coordinates)[:,axis]
+        positions = (fractional - numpy.floor(fractional))*spacings[axis]
+        length = spacings[axis]
+        periodic = True
+    else:
+        extents = coordinates.max(axis=0) - coordinates.min(axis=0)
+        axis = extents.argmax()
+        positions = coordinates[:,axis] - coordinates[:,axis].min()
+        length = max(extents[axis], 1.0)
+        periodic = False
+    width = length/num_slabs
+    slabs = numpy.floor(positions/width).astype(int).clip(0, num_slabs-1)
+    for slab in xrange(num_slabs):
+        relative = positions - slab*width
+        if periodic:
+            relative %= length
+            local = (relative < width + halo) | (relative >= length - halo)
+        else:
+            local = (relative >= -halo) & (relative < width + halo)
+        atoms = local.nonzero()[0]
+        yield atoms, slabs[atoms] == slab
+
+
+def _find_slab_bonds(args):
+    """Find the bonds of the atoms in one slab
+
+       The argument is a tuple (``atoms``, ``owned``, ``coordinates``,
+       ``numbers``, ``unit_cell``, ``scaling``), where the first two are yielded
+       by :func:`_iter_slabs` and the coordinates and numbers are those of the
+       atoms in the slab and its halo. Returns the bonds whose atom with the
+       highest index belongs to the slab, with their lengths and orders, and
+       the bonds that are discarded by the 45 degree check of the atoms in the
+       slab. All atom indexes are global.
+    """
+    atoms, owned, coordinates, numbers, unit_cell, scaling = args
+    pairs, deltas, distances, orders = _find_bonds(
+        coordinates, numbers, unit_cell, scaling
+    )
+    pruned = _get_pruned_bonds(pairs, deltas, distances, owned)
+    mask = owned[pairs[:,0]]
+    return atoms[pairs[mask]], distances[mask], orders[mask], atoms[pairs[pruned]]
+
+
+def _find_bonds_slabs(coordinates, numbers, unit_cell, scaling, num_slabs, workers):
+    """Find the bonds slab by slab, including the 45 degree check
+
+       The halo of each slab is as thick as the longest possible bond, such
+       that all bonds of the atoms in the slab are found. Each bond is
+       reported by the slab that owns its atom with the highest index. A bond
+       is discarded when the 45 degree check of any of its atoms, carried out
+       in the slab that owns the atom, rejects it.
+
+       Returns: ``pairs``, ``distances``, ``orders``
+    """
+    if len(numbers) == 0:
+        return numpy.zeros((0, 2), int), numpy.zeros(0, float), numpy.zeros(0, int)
+    halo = _get_bond_cutoffs(scaling).max()
+    # only the atoms of a slab and its halo are sent to a worker
+    tasks = [
+        (atoms, owned, coordinates[atoms], numbers[atoms], unit_cell, scaling)
+        for atoms, owned in _iter_slabs(coordinates, unit_cell, num_slabs, halo)
+    ]
+    if workers is not None and workers > 1:
+        from multiprocessing import Pool
+        pool = Pool(workers)
+        try:
+            results = pool.map(_find_slab_bonds, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_find_slab_bonds(task) for task in tasks]
+    pairs, distances, orders, pruned = zip(*results)
+    pairs = numpy.concatenate(pairs).reshape(-1, 2)
+    distances = numpy.concatenate(distances)
+    orders = numpy.concatenate(orders)
+    pruned = numpy.concatenate(pruned).reshape(-1, 2)
+    # merge the results and remove the discarded bonds
+    size = len(numbers)
+    keys = pairs[:,0]*size + pairs[:,1]
+    mask = True^numpy.in1d(keys, pruned[:,0]*size + pruned[:,1])
+    order = keys[mask].argsort()
+    return pairs[mask][order], distances[mask][order], orders[mask][order]
+
+
+def _get_pruned_bonds(pairs, deltas, distances, owned=None):
+    """Find the bonds that make an angle below 45 degrees with a shorter bond
+
+       Arguments:
+        | ``pairs``  --  an integer array with shape (M,2) with the bonds
+        | ``deltas``  --  the relative vectors from the first to the second atom
+        | ``distances``  --  the lengths of the relative vectors
+
+       Optional argument:
+        | ``owned``  --  a boolean mask for the atoms. When given, only the
+                         45 degree check of these atoms is carried out.
+
+       The bonds of each atom are sorted from long to short. A bond is pruned
+       when the cosine with a shorter bond of the same atom exceeds
+       ``0.5**0.5``. The atoms are grouped by their number of bonds, such that
+       all cosines within a group are computed at once. Returns a boolean
+       array that is True for the pruned bonds.
+    """
+    threshold = 0.5**0.5
+    num_bonds = len(pairs)
+    result = numpy.zeros(num_bonds, bool)
+    # every bond is considered from both atoms
+    centers = numpy.concatenate([pairs[:,0], pairs[:,1]])
+    others = numpy.concatenate([pairs[:,1], pairs[:,0]])
+    deltas = numpy.concatenate([deltas, -deltas])
+    lengths = numpy.concatenate([distances, distances])
+    bond_indexes = numpy.concatenate([numpy.arange(num_bonds)]*2)
+    # sort by center, from long to short bonds
+    order = numpy.lexsort((others, -lengths, centers))
+    centers = centers[order]
+    deltas = deltas[order]
+    lengths = lengths[order]
+    bond_indexes = bond_indexes[order]
+    first = numpy.ones(len(centers), bool)
+    first[1:] = centers[1:] != centers[:-1]
+    starts = first.nonzero()[0]
+    degrees = numpy.diff(numpy.append(starts, len(centers)))
+    for degree in numpy.unique(degrees):
+        if degree < 2:
+            continue
+        # indexes with shape (num_centers, degree) for all centers with the
+        # current degree
+        indexes = starts[degrees == degree].reshape(-1, 1) + numpy.arange(degree)
+        group_deltas = deltas[indexes]
+        group_lengths = lengths[indexes]
+        valid = group_lengths > 0
+        safe_lengths = numpy.where(valid, group_lengths, 1.0)
+        # cosines[c, j, i] for the longer bond j and the shorter bond i
+        dots = (group_deltas.reshape(-1, degree, 1, 3)*group_deltas.reshape(-1, 1, degree, 3)).sum(axis=3)
+        cosines = dots/safe_lengths.reshape(-1, 1, degree)/safe_lengths.reshape(-1, degree, 1)
+        shorter = numpy.arange(degree) > numpy.arange(degree).reshape(-1, 1)
+        hits = (cosines > threshold) & shorter
+        hits &= valid.reshape(-1, degree, 1) & valid.reshape(-1, 1, degree)
+        pruned = hits.any(axis=2)
+        if owned is not None:
+            pruned &= owned[centers[indexes]]
+        result[bond_indexes[indexes[pruned]]] = True
+    return result
+
+
 class MolecularGraph(Graph):
     """Describes a molecular graph: connectivity, atom numbers and bond orders.
 
@@ -62,7 +259,7 @@ class MolecularGraph(Graph):
 
     def _check_symbols(self, symbols):
         """the size must be the same as the length of the array numbers and all elements must be strings"""
-        if len(symbols) != self.size:
+        if len(symbols) != self.num_vertices:
             raise TypeError("The number of symbols in the graph does not "
                 "match the length of the atomic numbers array.")
         for symbol in symbols:
@@ -74,11 +271,12 @@ class MolecularGraph(Graph):
         "vertices")
     orders = ReadOnlyAttribute(numpy.ndarray, none=False, check=_check_orders,
         npdim=1, npdtype=float, doc="the bond orders associated with the edges")
-    symbols = ReadOnlyAttribute(tuple, _check_symbols, doc="symbols for the "
+    symbols = ReadOnlyAttribute(tuple, check=_check_symbols, doc="symbols for the "
         "atoms, which can be element names for force-field atom types")
 
     @classmethod
-    def from_geometry(cls, molecule, do_orders=False, scaling=1.0):
+    def from_geometry(cls, molecule, do_orders=False, scaling=1.0,
+                      num_slabs=None, workers=None):
         """Construct a MolecularGraph object based on interatomic distances
 
            All short distances are computed with the binning module and compared
@@ -93,74 +291,41 @@ class MolecularGraph(Graph):
             | ``scaling``  --  scale the threshold for the connectivity. increase
                                this to 1.5 in case of transition states when a
                                fully connected topology is required.
-        """
-        from molmod.bonds import bonds
-
-        unit_cell = molecule.unit_cell
-        pair_search = PairSearchIntra(
-            molecule.coordinates,
-            bonds.max_length*bonds.bond_tolerance,
-            unit_cell
-        )
-
-        orders = []
-        lengths = []
-        edges = []
-
-        for i0, i1, delta, distance in pair_search:
-            bond_order = bonds.bonded(molecule.numbers[i0], molecule.numbers[i1], distance/scaling)
-            if bond_order is not None:
-                if do_orders:
-                    orders.append(bond_order)
-                lengths.append(distance)
-                edges.append((i0,i1))
-
-        if do_orders:
-            result = cls(edges, molecule.numbers, orders, symbols=molecule.symbols)
+            | ``num_slabs``  --  when given, space is divided in this number of
+                                 slabs and the bonds are searched slab by slab.
+                                 This limits the memory usage for very large
+                                 systems.
+            | ``workers``  --  when given, the slabs are processed by a pool of
+                               this number of processes. [default: num_slabs
+                               equals workers]
+
+           When the system is divided in slabs, the edges are sorted by the
+           first and then the second atom index.
+        """
+        if num_slabs is None and workers is not None:
+            num_slabs = workers
+        if num_slabs is None:
+            pairs, deltas, distances, orders = _find_bonds(
+                molecule.coordinates, molecule.numbers, molecule.unit_cell,
+                scaling
+            )
+            # run a check on all neighbors. if two bonds point in a direction
+            # that differs only by 45 deg. the longest of the two is discarded.
+            mask = True^_get_pruned_bonds(pairs, deltas, distances)
+            pairs = pairs[mask]
+            distances = distances[mask]
+            orders = orders[mask]
         else:
-            result = cls(edges, molecule.numbers, symbols=molecule.symbols)
-
-        # run a check on all neighbors. if two bonds point in a direction that
-        # differs only by 45 deg. the longest of the two is discarded. the
-        # double loop over the neighbors is done such that the longest bonds
-        # are eliminated first
-        slated_for_removal = set([])
-        threshold = 0.5**0.5
-        for c, ns in result.neighbors.iteritems():
-            lengths_ns = []
-            for n in ns:
-                delta = molecule.coordinates[n] - molecule.coordinates[c]
-                if unit_cell is not None:
-                    delta = unit_cell.shortest_vector(delta)
-                length = numpy.linalg.norm(delta)
-                lengths_ns.append([length, delta, n])
-            lengths_ns.sort(reverse=True, cmp=(lambda r0, r1: cmp(r0[0], r1[0])))
-            for i0, (length0, delta0, n0) in enumerate(lengths_ns):
-                for i1, (length1, delta1, n1) in enumerate(lengths_ns[:i0]):
-                    if length1 == 0.0:
-                        continue
-                    cosine = numpy.dot(delta0, delta1)/length0/length1
-                    if cosine > threshold:
-                        # length1 > length0
-                        slated_for_removal.add((c,n1))
-                        lengths_ns[i1][0] = 0.0
-        # construct a mask
-        mask = numpy.ones(len(edges), bool)
-        for i0, i1 in slated_for_removal:
-            edge_index = result.edge_index.get(frozenset([i0,i1]))
-            if edge_index is None:
-                raise ValueError('Could not find edge that has to be removed: %i %i' % (i0, i1))
-            mask[edge_index] = False
-        # actual removal
-        edges = [edges[i] for i in xrange(len(edges)) if mask[i]]
+            pairs, distances, orders = _find_bonds_slabs(
+                molecule.coordinates, molecule.numbers, molecule.unit_cell,
+                scaling, num_slabs, workers
+            )
+
         if do_orders:
-            bond_order = [bond_order[i] for i in xrange(len(bond_order)) if mask[i]]
-            result = cls(edges, molecule.numbers, orders)
+            result = cls.from_arrays(pairs, molecule.numbers, orders.astype(float))
         else:
-            result = cls(edges, molecule.numbers)
-
-        lengths = [lengths[i] for i in xrange(len(lengths)) if mask[i]]
-        result.bond_lengths = numpy.array(lengths)
+            result = cls.from_arrays(pairs, molecule.numbers)
+        result.bond_lengths = distances
 
         return result
 
@@ -206,6 +371,28 @@ class MolecularGraph(Graph):
         self.orders = orders
         self.symbols = symbols
 
+    @classmethod
+    def from_arrays(cls, edges, numbers, orders=None, symbols=None):
+        """Construct a molecular graph from an integer array with edges
+
+           Arguments:
+            | ``edges``  --  an integer array with shape (num_edges, 2)
+            | ``numbers``  --  consecutive atom numbers
+
+           Optional arguments:
+            | ``orders``  --  bond orders
+            | ``symbols``  --  atomic symbols
+
+           See :meth:`molmod.graphs.Graph.from_arrays` for more information.
+        """
+        result = super(MolecularGraph, cls).from_arrays(edges, len(numbers))
+        if orders is None:
+            orders = numpy.ones(result.num_edges, float)
+        result.numbers = numbers
+        result.orders = orders
+        result.symbols = symbols
+        return result
+
     def __mul__(self, repeat):
         """Construct a graph that repeats this graph a number of times
 
@@ -215,10 +402,8 @@ class MolecularGraph(Graph):
         if not isinstance(repeat, int):
             raise TypeError("Can only multiply a graph with an integer")
         # copy edges
-        new_edges = []
-        for i in xrange(repeat):
-            for vertex1, vertex2 in self.edges:
-                new_edges.append(frozenset([vertex1+i*self.num_vertices, vertex2+i*self.num_vertices]))
+        offsets = numpy.arange(repeat)*self.num_vertices
+        new_edges = (self.edge_array + offsets.reshape(-1, 1, 1)).reshape(-1, 2)
         # copy numbers
         new_numbers = numpy.zeros((repeat, len(self.numbers)), int)
         new_numbers[:] = self.numbers
@@ -232,7 +417,7 @@ class MolecularGraph(Graph):
             new_symbols = self.symbols*repeat
         else:
             new_symbols = None
-        return MolecularGraph(new_edges, new_numbers, new_orders, new_symbols)
+        return MolecularGraph.from_arrays(new_edges, new_numbers, new_orders, new_symbols)
 
     __rmul__ = __mul__
 
@@ -274,11 +459,11 @@ class MolecularGraph(Graph):
         if self.symbols is None:
             new_symbols = None
         elif normalize:
-            new_symbols = tuple(self.symbols[i] for i in graph._old_vertex_indexes)
+            new_symbols = tuple(numpy.array(self.symbols, object)[graph._old_vertex_indexes])
         else:
             new_symbols = self.symbols
         new_orders = self.orders[graph._old_edge_indexes]
-        result = MolecularGraph(graph.edges, new_numbers, new_orders, new_symbols)
+        result = MolecularGraph.from_arrays(graph.edge_array, new_numbers, new_orders, new_symbols)
         if normalize:
             result._old_vertex_indexes = graph._old_vertex_indexes
         result._old_edge_indexes = graph._old_edge_indexes
@@ -354,6 +539,14 @@ class HasAtomNumber(object):
         """
         return graph.numbers[index] == self.number
 
+    def mask(self, graph):
+        """Return a boolean array that is True for the atoms with this number
+
+           Argument:
+            | ``graph``  --  the graph on which the criterion is tested
+        """
+        return graph.numbers == self.number
+
 
 class HasNumNeighbors(object):
     """Criterion for the number of neighboring vertexes"""
@@ -375,6 +568,14 @@ class HasNumNeighbors(object):
         """
         return len(graph.neighbors[index]) == self.count
 
+    def mask(self, graph):
+        """Return a boolean array that is True for the atoms with this count
+
+           Argument:
+            | ``graph``  --  the graph on which the criterion is tested
+        """
+        return numpy.diff(graph.neighbor_indptr) == self.count
+
 
 class HasNeighborNumbers(object):
     """Criterion for the atom numbers of the neighbor vertexes"""
@@ -405,6 +606,27 @@ class HasNeighborNumbers(object):
         neighbor_numbers.sort()
         return neighbor_numbers == self.numbers
 
+    def mask(self, graph):
+        """Return a boolean array that is True for the atoms with these neighbors
+
+           Argument:
+            | ``graph``  --  the graph on which the criterion is tested
+
+           The neighbors of each number are counted for all atoms at once.
+           When the number of neighbors and all the counts are correct, there
+           are no neighbors with other atom numbers.
+        """
+        degrees = numpy.diff(graph.neighbor_indptr)
+        result = degrees == len(self.numbers)
+        owners = numpy.repeat(numpy.arange(graph.num_vertices), degrees)
+        neighbor_numbers = graph.numbers[graph.neighbor_indices]
+        for number in set(self.numbers):
+            counts = numpy.bincount(
+                owners[neighbor_numbers == number], minlength=graph.num_vertices
+            )
+            result &= counts == self.numbers.count(number)
+        return result
+
 
 class HasNeighbors(object):
     """Tests if the neighbors of a vertex match the given criteria"""
@@ -565,6 +787,10 @@ class NRingPattern(CustomPattern):
         pattern_graph = Graph([(i, (i+1)%size) for i in xrange(size)])
         CustomPattern.__init__(self, pattern_graph, criteria_sets, vertex_tags)
 
+    def get_traversal_key(self):
+        """See :meth:`molmod.graphs.CustomPattern.get_traversal_key`"""
+        return CustomPattern.get_traversal_key(self) + (self.strong,)
+
     def check_next_match(self, match, new_relations, subject_graph, one_match):
         """Check if the (onset for a) match can be a valid (part of a) ring"""
         if not CustomPattern.check_next_match(self, match, new_relations, subject_graph, one_match):
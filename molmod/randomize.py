@@ -27,6 +27,7 @@ from random import shuffle, sample
 
 from molmod.molecules import Molecule
 from molmod.graphs import GraphError
+from molmod.binning import PairSearchIntra
 from molmod.transformations import Translation, Complete
 from molmod.vectors import random_orthonormal, random_unit
 
@@ -338,13 +339,23 @@ def check_nonbond(molecule, thresholds):
        a coarse guess of a proper threshold value.
     """
 
-    # check that no atoms overlap
-    for atom1 in xrange(molecule.graph.num_vertices):
-        for atom2 in xrange(atom1):
-            if molecule.graph.distances[atom1, atom2] > 2:
-                distance = numpy.linalg.norm(molecule.coordinates[atom1] - molecule.coordinates[atom2])
-                if distance < thresholds[frozenset([molecule.numbers[atom1], molecule.numbers[atom2]])]:
-                    return False
+    if len(thresholds) == 0:
+        return True
+    # check that no atoms overlap. Only pairs of atoms in the same molecule
+    # that are separated by more than two bonds are tested.
+    graph = molecule.graph
+    size = graph.num_vertices
+    labels = graph.component_labels
+    indptr, indices, distances = graph.get_distances(2)
+    excluded = numpy.repeat(numpy.arange(size), indptr[1:] - indptr[:-1])*size + indices
+    # only the pairs within the largest threshold can be too close
+    cutoff = max(thresholds.itervalues())
+    pairs, deltas, distances = PairSearchIntra(molecule.coordinates, cutoff).arrays()
+    mask = labels[pairs[:,0]] == labels[pairs[:,1]]
+    mask &= True^numpy.in1d(pairs[:,0]*size + pairs[:,1], excluded)
+    for (atom1, atom2), distance in zip(pairs[mask], distances[mask]):
+        if distance < thresholds[frozenset([molecule.numbers[atom1], molecule.numbers[atom2]])]:
+            return False
     return True
 
 
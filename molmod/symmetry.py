@@ -42,9 +42,10 @@ def compute_rotsym(molecule, graph, threshold=1e-3*angstrom):
                              given threshold, the rotation is considered to
                              transform the molecule onto itself.
     """
+    if len(graph.independent_vertices) > 1:
+        raise ValueError("The graph must be connected.")
     result = 0
-    for match in graph.symmetries:
-        permutation = list(j for i,j in sorted(match.forward.iteritems()))
+    for permutation in graph.iter_automorphisms():
         new_coordinates = molecule.coordinates[permutation]
         rmsd = fit_rmsd(molecule.coordinates, new_coordinates)[2]
         if rmsd < threshold:
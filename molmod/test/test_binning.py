@@ -25,6 +25,7 @@
 from molmod import *
 from molmod.io import *
 from molmod.periodic import periodic
+from molmod.binning import Binning
 
 import numpy, unittest
 
@@ -58,7 +59,7 @@ class BinningTestCase(unittest.TestCase):
                 fast_distance = distances.get(identifier)
                 if fast_distance is None:
                     missing_pairs.append(tuple(identifier) + (distance,))
-                elif fast_distance != distance:
+                elif abs(fast_distance - distance) > 1e-10:
                     wrong_distances.append(tuple(identifier) + (fast_distance, distance))
                 else:
                     num_correct += 1
@@ -221,3 +222,240 @@ class BinningTestCase(unittest.TestCase):
                 in pair_search
             ]
             self.verify_distances_inter(coordinates0, coordinates1, cutoff, distances, unit_cell)
+
+    def verify_arrays(self, pair_search, cutoff, coordinates0, coordinates1=None, unit_cell=None):
+        pairs, deltas, distances = pair_search.arrays()
+        self.assertEqual(pairs.shape, (len(distances), 2))
+        self.assertEqual(deltas.shape, (len(distances), 3))
+        # brute force reference, with i0 > i1 for pairs within one system and
+        # the same minimum image convention as the pair search
+        expected = {}
+        for i0, coord0 in enumerate(coordinates0):
+            if coordinates1 is None:
+                others = coordinates0[:i0]
+            else:
+                others = coordinates1
+            for i1, coord1 in enumerate(others):
+                delta = coord1 - coord0
+                if unit_cell is not None:
+                    delta = unit_cell.shortest_vector(delta)
+                distance = numpy.linalg.norm(delta)
+                if distance < cutoff:
+                    expected[i0, i1] = delta, distance
+        self.assertEqual(len(expected), len(distances))
+        for (i0, i1), delta, distance in zip(pairs, deltas, distances):
+            expected_delta, expected_distance = expected[i0, i1]
+            self.assertAlmostEqual(abs(delta - expected_delta).max(), 0.0)
+            self.assertAlmostEqual(distance, expected_distance)
+
+    def test_arrays_intra_random_periodic(self):
+        for i in xrange(10):
+            coordinates = numpy.random.uniform(0,1,(20,3))
+            while True:
+                unit_cell = UnitCell(
+                    numpy.random.uniform(0,5,(3,3)),
+                    numpy.random.randint(0,2,3).astype(bool),
+                )
+                if unit_cell.spacings.min() > 0.5:
+                    break
+            coordinates = unit_cell.to_cartesian(coordinates)*3-unit_cell.matrix.sum(axis=1)
+            cutoff = numpy.random.uniform(1, 6)
+            pair_search = PairSearchIntra(coordinates, cutoff, unit_cell)
+            self.verify_arrays(pair_search, cutoff, coordinates, unit_cell=unit_cell)
+            pair_search = PairSearchIntra(coordinates, cutoff)
+            self.verify_arrays(pair_search, cutoff, coordinates)
+
+    def test_arrays_inter_random(self):
+        for i in xrange(10):
+            coordinates0 = numpy.random.uniform(0,5,(20,3))
+            coordinates1 = numpy.random.uniform(0,5,(20,3))
+            cutoff = numpy.random.uniform(1, 6)
+            pair_search = PairSearchInter(coordinates0, coordinates1, cutoff)
+            self.verify_arrays(pair_search, cutoff, coordinates0, coordinates1)
+
+    def verify_threads(self, reference, threaded):
+        pairs0, deltas0, distances0 = reference.arrays()
+        pairs1, deltas1, distances1 = threaded.arrays()
+        self.assertEqual(pairs1.shape, pairs0.shape)
+        order0 = numpy.lexsort(pairs0.transpose())
+        order1 = numpy.lexsort(pairs1.transpose())
+        self.assert_((pairs0[order0] == pairs1[order1]).all())
+        self.assert_(numpy.allclose(deltas0[order0], deltas1[order1]))
+        self.assert_(numpy.allclose(distances0[order0], distances1[order1]))
+
+    def test_arrays_threads(self):
+        for i in xrange(10):
+            coordinates = numpy.random.uniform(0,1,(200,3))
+            while True:
+                unit_cell = UnitCell(
+                    numpy.random.uniform(0,5,(3,3)),
+                    numpy.random.randint(0,2,3).astype(bool),
+                )
+                if unit_cell.spacings.min() > 0.5:
+                    break
+            coordinates = unit_cell.to_cartesian(coordinates)*3-unit_cell.matrix.sum(axis=1)
+            cutoff = numpy.random.uniform(1, 6)
+            for num_threads in 1, 3:
+                self.verify_threads(
+                    PairSearchIntra(coordinates, cutoff, unit_cell),
+                    PairSearchIntra(coordinates, cutoff, unit_cell, num_threads=num_threads),
+                )
+            coordinates1 = numpy.random.uniform(0,5,(50,3))
+            species0 = numpy.random.randint(0, 2, 200)
+            species1 = numpy.random.randint(0, 2, 50)
+            cutoff_table = numpy.array([[cutoff, 2.0], [2.0, 1.0]])
+            self.verify_threads(
+                PairSearchInter(coordinates, coordinates1, cutoff_table, species0=species0, species1=species1),
+                PairSearchInter(coordinates, coordinates1, cutoff_table, species0=species0, species1=species1, num_threads=3),
+            )
+        self.assertRaises(ValueError, PairSearchIntra, coordinates, cutoff, num_threads=0)
+
+    def test_arrays_empty(self):
+        coordinates = numpy.array([[0.0, 0.0, 0.0], [10.0, 0.0, 0.0]])
+        for num_threads in None, 2:
+            pairs, deltas, distances = PairSearchIntra(coordinates, 2.0, num_threads=num_threads).arrays()
+            self.assertEqual(pairs.shape, (0, 2))
+            self.assertEqual(deltas.shape, (0, 3))
+            self.assertEqual(distances.shape, (0,))
+
+    def test_neighbor_list(self):
+        unit_cell = UnitCell(numpy.identity(3)*15.0)
+        coordinates = numpy.random.uniform(0, 15, (50, 3))
+        neighbor_list = NeighborList(4.0, 1.0, unit_cell)
+        for i in xrange(20):
+            coordinates = coordinates + numpy.random.normal(0, 0.1, (50, 3))
+            pairs, deltas, distances = neighbor_list.update(coordinates)
+            expected = PairSearchIntra(coordinates, 4.0, unit_cell).arrays()
+            self.assertEqual(
+                set(tuple(pair) for pair in pairs),
+                set(tuple(pair) for pair in expected[0]),
+            )
+            self.assertAlmostEqual(
+                abs(numpy.sort(distances) - numpy.sort(expected[2])).max(), 0.0
+            )
+            self.assertAlmostEqual(
+                abs(numpy.sqrt((deltas**2).sum(axis=1)) - distances).max(), 0.0
+            )
+        self.assert_(neighbor_list.num_rebuilds < 20)
+
+    def test_binning_csr(self):
+        coordinates = numpy.random.uniform(-5, 5, (100, 3))
+        grid_cell = UnitCell(numpy.identity(3)*1.5)
+        bins = Binning(coordinates, 3.0, grid_cell)
+        self.assertEqual(sorted(bins.atoms), range(100))
+        self.assertEqual(bins.offsets[-1], 100)
+        for key, atoms in bins:
+            self.assert_(len(atoms) > 0)
+            for i in atoms:
+                self.assertEqual(tuple(numpy.floor(coordinates[i]/1.5).astype(int)), key)
+        self.assertEqual(bins.lookup(bins.keys).tolist(), range(bins.num_bins))
+        self.assertEqual(bins.lookup([[100, 100, 100]]).tolist(), [-1])
+
+    def test_cutoff_table(self):
+        coordinates = numpy.random.uniform(0, 8, (60, 3))
+        species = numpy.random.randint(0, 3, 60)
+        cutoff_table = numpy.array([
+            [1.0, 2.0, 3.0],
+            [2.0, 1.5, 2.5],
+            [3.0, 2.5, 0.5],
+        ])
+        pairs, deltas, distances = PairSearchIntra(
+            coordinates, cutoff_table, species=species
+        ).arrays()
+        expected = set([])
+        for i0 in xrange(60):
+            for i1 in xrange(i0):
+                distance = numpy.linalg.norm(coordinates[i0] - coordinates[i1])
+                if distance <= cutoff_table[species[i0], species[i1]]:
+                    expected.add((i0, i1))
+        self.assertEqual(set(tuple(pair) for pair in pairs), expected)
+
+        coordinates1 = numpy.random.uniform(0, 8, (30, 3))
+        species1 = numpy.random.randint(0, 3, 30)
+        pairs, deltas, distances = PairSearchInter(
+            coordinates, coordinates1, cutoff_table, species0=species,
+            species1=species1
+        ).arrays()
+        expected = set([])
+        for i0 in xrange(60):
+            for i1 in xrange(30):
+                distance = numpy.linalg.norm(coordinates[i0] - coordinates1[i1])
+                if distance <= cutoff_table[species[i0], species1[i1]]:
+                    expected.add((i0, i1))
+        self.assertEqual(set(tuple(pair) for pair in pairs), expected)
+
+        self.assertRaises(TypeError, PairSearchIntra, coordinates, cutoff_table)
+        self.assertRaises(ValueError, PairSearchIntra, coordinates, cutoff_table, species=species+1)
+
+    def test_pair_search_images(self):
+        for counter in xrange(10):
+            matrix = numpy.random.uniform(-1, 1, (3, 3)) + numpy.identity(3)*3
+            unit_cell = UnitCell(matrix, numpy.random.randint(0, 2, 3).astype(bool))
+            coordinates = numpy.random.uniform(-5, 5, (7, 3))
+            species = numpy.random.randint(0, 2, 7)
+            cutoff_table = numpy.array([[4.5, 3.0], [3.0, 2.0]])
+            pair_search = PairSearchImages(coordinates, cutoff_table, unit_cell, species=species)
+            pairs, images, deltas, distances = pair_search.arrays()
+            check = coordinates[pairs[:,1]] - coordinates[pairs[:,0]] + unit_cell.to_cartesian(images)
+            self.assert_(numpy.allclose(check, deltas))
+            self.assert_(numpy.allclose(numpy.sqrt((check**2).sum(axis=1)), distances))
+            # brute force over a large number of images
+            ranges = unit_cell.get_radius_ranges(25.0)
+            indexes = numpy.indices(2*ranges+1).reshape(3, -1).T - ranges
+            expected = set([])
+            for i0 in xrange(7):
+                for i1 in xrange(i0+1):
+                    delta = coordinates[i1] - coordinates[i0] + unit_cell.to_cartesian(indexes)
+                    distance = numpy.sqrt((delta**2).sum(axis=1))
+                    cutoff = cutoff_table[species[i0], species[i1]]
+                    for index in indexes[distance <= cutoff]:
+                        if i0 == i1 and tuple(index) <= (0, 0, 0):
+                            continue
+                        expected.add((i0, i1, tuple(index)))
+            found = set((i0, i1, tuple(image)) for (i0, i1), image in zip(pairs, images))
+            self.assertEqual(len(found), len(pairs))
+            self.assertEqual(found, expected)
+
+    def test_pair_search_images_mic(self):
+        # with a small cutoff, the result is equivalent to the intra search
+        coordinates = numpy.random.uniform(0, 10, (40, 3))
+        unit_cell = UnitCell(numpy.identity(3, float)*10)
+        pairs, images, deltas, distances = PairSearchImages(coordinates, 3.0, unit_cell).arrays()
+        pairs_mic, deltas_mic, distances_mic = PairSearchIntra(coordinates, 3.0, unit_cell).arrays()
+        self.assertEqual(set(tuple(pair) for pair in pairs), set(tuple(pair) for pair in pairs_mic))
+        self.assertAlmostEqual(distances.sum(), distances_mic.sum())
+
+    def get_query_distances(self, coordinates, point, unit_cell):
+        deltas = coordinates - point
+        if unit_cell is not None:
+            deltas = unit_cell.shortest_vector(deltas)
+        return numpy.sqrt((deltas**2).sum(axis=1))
+
+    def test_query_radius(self):
+        for unit_cell in None, UnitCell(numpy.array([[10.0, 2.0, 0.0], [0.0, 9.0, 1.0], [0.0, 0.0, 11.0]])):
+            coordinates = numpy.random.uniform(0, 10, (200, 3))
+            bins = PairSearchIntra(coordinates, 3.0, unit_cell).bins
+            points = numpy.random.uniform(-3, 13, (100, 3))
+            indptr, indices, distances = bins.query_radius(points, 2.5, chunk_size=17)
+            self.assertEqual(indptr.shape, (101,))
+            for p in xrange(100):
+                ds = self.get_query_distances(coordinates, points[p], unit_cell)
+                atoms = indices[indptr[p]:indptr[p+1]]
+                self.assertEqual(set(atoms), set((ds <= 2.5).nonzero()[0]))
+                self.assertEqual(len(atoms), len(set(atoms)))
+                self.assert_(numpy.allclose(distances[indptr[p]:indptr[p+1]], ds[atoms]))
+                self.assert_((numpy.diff(distances[indptr[p]:indptr[p+1]]) >= 0).all())
+
+    def test_query_nearest(self):
+        for unit_cell in None, UnitCell(numpy.array([[10.0, 2.0, 0.0], [0.0, 9.0, 1.0], [0.0, 0.0, 11.0]])):
+            coordinates = numpy.random.uniform(0, 10, (200, 3))
+            bins = PairSearchIntra(coordinates, 3.0, unit_cell).bins
+            points = numpy.random.uniform(-3, 13, (100, 3))
+            for k in 1, 4, 200:
+                indices, distances = bins.query_nearest(points, k, chunk_size=17)
+                self.assertEqual(indices.shape, (100, k))
+                for p in xrange(100):
+                    ds = self.get_query_distances(coordinates, points[p], unit_cell)
+                    self.assert_(numpy.allclose(distances[p], numpy.sort(ds)[:k]))
+                    self.assert_(numpy.allclose(ds[indices[p]], distances[p]))
+            self.assertRaises(ValueError, bins.query_nearest, points, 201)
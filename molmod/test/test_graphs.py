@@ -24,7 +24,7 @@
 
 from molmod import *
 
-import unittest, copy, numpy
+import unittest, copy, numpy, cPickle
 
 
 __all__ = ["GraphTestCase"]
@@ -289,6 +289,48 @@ class GraphTestCase(unittest.TestCase):
         self.assertEqual(expecting.shape,graph.distances.shape)
         self.assert_((expecting==graph.distances).all())
 
+    def test_distances_bfs(self):
+        for case in self.iter_cases(disconnected=True):
+            graph = case.graph
+            expecting = graph._compute_distances_floyd_warshall()
+            self.assert_((graph._compute_distances_bfs() == expecting).all())
+            self.assert_((graph._compute_distances_bfs(3) == expecting).all())
+            self.assert_((graph.distances == expecting).all())
+        # random graphs, including dense ones
+        for num_edges in 10, 40, 150:
+            edges = set([])
+            while len(edges) < num_edges:
+                i, j = numpy.random.randint(0, 20, 2)
+                if i != j:
+                    edges.add(frozenset([int(i), int(j)]))
+            graph = Graph(edges, 25)
+            expecting = graph._compute_distances_floyd_warshall()
+            self.assert_((graph.compute_distances(2) == expecting).all())
+            self.assert_((graph.distances == expecting).all())
+        self.assertEqual(Graph([]).compute_distances(2).shape, (0, 0))
+        self.assertRaises(ValueError, Graph([(0, 1)]).compute_distances, 0)
+
+    def test_get_distances(self):
+        for case in self.iter_cases(disconnected=True):
+            graph = case.graph
+            size = graph.num_vertices
+            for max_distance in 0, 1, 2, 4:
+                for num_threads in None, 2:
+                    indptr, indices, distances = graph.get_distances(max_distance, num_threads)
+                    self.assertEqual(indptr.shape, (size+1,))
+                    self.assertEqual(indices.shape, (indptr[-1],))
+                    self.assertEqual(distances.shape, (indptr[-1],))
+                    expecting = graph.distances.copy()
+                    expecting[expecting > max_distance] = 0
+                    dense = numpy.zeros((size, size), int)
+                    for i in xrange(size):
+                        begin, end = indptr[i:i+2]
+                        dense[i, indices[begin:end]] = distances[begin:end]
+                        row = zip(distances[begin:end], indices[begin:end])
+                        self.assertEqual(row, sorted(row))
+                    self.assert_((dense == expecting).all())
+        self.assertRaises(ValueError, Graph([(0, 1)]).get_distances, -1)
+
     def test_neighbors(self):
         for case in self.iter_cases():
             g = case.graph
@@ -299,6 +341,44 @@ class GraphTestCase(unittest.TestCase):
                     self.assert_(frozenset([central,neighbor]) in g.edges)
             self.assertEqual(counter, len(g.edges)*2)
 
+    def test_edge_array(self):
+        for case in self.iter_cases(disconnected=True):
+            g = case.graph
+            self.assertEqual(g.edge_array.shape, (g.num_edges, 2))
+            self.assertEqual(g.edge_array.dtype, numpy.int32)
+            for row, edge in zip(g.edge_array, g.edges):
+                self.assertEqual(frozenset(row), edge)
+            # the compressed sparse row format
+            self.assertEqual(g.neighbor_indptr.shape, (g.num_vertices+1,))
+            self.assertEqual(g.neighbor_indptr[-1], 2*g.num_edges)
+            for vertex in xrange(g.num_vertices):
+                begin, end = g.neighbor_indptr[vertex:vertex+2]
+                indices = list(g.neighbor_indices[begin:end])
+                self.assertEqual(indices, sorted(g.neighbors[vertex]))
+            # the array is derived from the edges after unpickling
+            g2 = cPickle.loads(cPickle.dumps(g))
+            self.assertEqual(g2.edges, g.edges)
+            self.assertEqual(g2.num_vertices, g.num_vertices)
+            self.assertEqual(set(frozenset(row) for row in g2.edge_array), set(g.edges))
+        graph = Graph([])
+        self.assertEqual(graph.edge_array.shape, (0, 2))
+        self.assertEqual(graph.edges, ())
+
+    def test_from_arrays(self):
+        for case in self.iter_cases(disconnected=True):
+            g0 = case.graph
+            g1 = Graph.from_arrays(g0.edge_array.astype(int))
+            self.assertEqual(g1.edges, g0.edges)
+            self.assertEqual(g1.num_vertices, g0.num_vertices)
+            g1 = Graph.from_arrays(g0.edge_array, g0.num_vertices+3)
+            self.assertEqual(g1.num_vertices, g0.num_vertices+3)
+        self.assertEqual(Graph.from_arrays([]).num_vertices, 0)
+        self.assertRaises(TypeError, Graph.from_arrays, [[0, 1, 2]])
+        self.assertRaises(TypeError, Graph.from_arrays, [[0, 1.5]])
+        self.assertRaises(TypeError, Graph.from_arrays, [[0, -1]])
+        self.assertRaises(ValueError, Graph.from_arrays, [[0, 1], [2, 2]])
+        self.assertRaises(ValueError, Graph.from_arrays, [[0, 1]], 1)
+
     def test_central_vertices(self):
         for case in self.iter_cases():
             g = case.graph
@@ -309,11 +389,43 @@ class GraphTestCase(unittest.TestCase):
                 self.assert_(g.distances[c].max() == max_distances_min)
             self.assert_(g.central_vertex in g.central_vertices)
 
+    def test_central_vertices_sweeps(self):
+        for case in self.iter_cases(disconnected=True):
+            # a fresh graph without distances matrix
+            g = Graph(case.graph.edges, case.graph.num_vertices)
+            central_vertices = g.central_vertices
+            max_distance = g.max_distance
+            self.assertEqual(getattr(g, "_cache_distances", None), None)
+            max_distances = g.distances.max(axis=1)
+            max_distances_min = max_distances[max_distances>0].min()
+            expected = (max_distances == max_distances_min).nonzero()[0]
+            self.assertEqual(list(central_vertices), list(expected))
+            self.assertEqual(max_distance, g.distances.max())
+        # a long ring with a tail, which needs several sweeps
+        edges = [(i, (i+1)%20) for i in xrange(20)] + [(i, i+1) for i in xrange(19, 30)]
+        g = Graph(edges)
+        self.assertEqual(list(g.central_vertices), [19, 20])
+        self.assertEqual(g.max_distance, 21)
+        self.assertEqual(g.max_distance, g.distances.max())
+
     def test_independent_vertices(self):
         edges = [(0,1), (0,2), (0,3), (1,4), (1,5), (6,7), (6,8), (6,9), (7,10), (7,11)]
         g = Graph(edges)
         self.assertEqual(g.independent_vertices, [[0, 1, 2, 3, 4, 5], [6, 7, 8, 9, 10, 11]])
 
+    def test_component_labels(self):
+        edges = [(0,7), (7,3), (5,1), (4,6), (6,5)]
+        g = Graph(edges, 9)
+        self.assertEqual(list(g.component_labels), [0, 1, 2, 0, 1, 1, 1, 0, 3])
+        self.assertEqual(g.independent_vertices, [[0, 3, 7], [1, 4, 5, 6], [2], [8]])
+        for case in self.iter_cases(disconnected=True):
+            g = case.graph
+            self.assertEqual(g.component_labels.shape, (g.num_vertices,))
+            for label, group in enumerate(g.independent_vertices):
+                self.assert_((g.component_labels[group] == label).all())
+                for vertex, distance in g.iter_breadth_first(group[0]):
+                    self.assert_(vertex in group)
+
     def test_fingerprints(self):
         for case in self.iter_cases():
             g0 = case.graph
@@ -324,6 +436,112 @@ class GraphTestCase(unittest.TestCase):
             for i in xrange(g0.num_vertices):
                 self.assert_((g0.vertex_fingerprints[i]==g1.vertex_fingerprints[permutation[i]]).all())
 
+    def test_vertex_fingerprints_refinement(self):
+        # a chain of seven vertices
+        g = Graph([(0,1), (1,2), (2,3), (3,4), (4,5), (5,6)])
+        self.assertEqual(g.vertex_fingerprints.shape, (7, 2))
+        self.assertEqual(g.vertex_fingerprints.dtype, numpy.uint64)
+        self.assertEqual(g.fingerprint.shape, (2,))
+        for i in xrange(7):
+            self.assertEqual(g.equivalent_vertices[i], set([i, 6-i]))
+        # no iterations: all vertices are the same
+        fingerprints = g.get_vertex_fingerprints([""]*7, [""]*6, 0)
+        self.assert_((fingerprints == fingerprints[0]).all())
+        # one iteration: only the end points differ
+        fingerprints = g.get_vertex_fingerprints([""]*7, [""]*6, 1)
+        self.assert_((fingerprints[0] == fingerprints[6]).all())
+        self.assert_((fingerprints[1:6] == fingerprints[3]).all())
+        self.assert_((fingerprints[0] != fingerprints[3]).any())
+        # the edge strings matter
+        fingerprints = g.get_vertex_fingerprints([""]*7, ["a", "", "", "", "", ""], 1)
+        self.assert_((fingerprints[0] != fingerprints[6]).any())
+
+    def test_canonical_hash(self):
+        for case in self.iter_cases(disconnected=True):
+            g0 = case.graph
+            permutation = numpy.random.permutation(g0.num_vertices)
+            new_edges = tuple((permutation[i], permutation[j]) for i,j in g0.edges)
+            g1 = Graph(new_edges, g0.num_vertices)
+            self.assertEqual(g0.canonical_hash, g1.canonical_hash)
+            order0 = g0.canonical_labels.argsort()
+            order1 = g1.canonical_labels.argsort()
+            self.assertEqual(
+                g0.get_subgraph(order0, normalize=True).edges,
+                g1.get_subgraph(order1, normalize=True).edges,
+            )
+            order0 = g0.canonical_order
+            order1 = g1.canonical_order
+            self.assertEqual(
+                g0.get_subgraph(order0, normalize=True).edges,
+                g1.get_subgraph(order1, normalize=True).edges,
+            )
+        # equal hashes for isomorphic graphs only
+        cases = list(self.iter_cases())
+        for case0 in cases:
+            for case1 in cases:
+                g0 = case0.graph
+                g1 = case1.graph
+                isomorphic = (
+                    g0.num_vertices == g1.num_vertices and
+                    g0.num_edges == g1.num_edges and
+                    g0.full_match(g1) is not None
+                )
+                self.assertEqual(g0.canonical_hash == g1.canonical_hash, isomorphic)
+        # Two triangles and a hexagon have the same fingerprints.
+        g0 = Graph([(0,1), (1,2), (2,0), (3,4), (4,5), (5,3)])
+        g1 = Graph([(0,1), (1,2), (2,3), (3,4), (4,5), (5,0)])
+        self.assert_((g0.vertex_fingerprints == g1.vertex_fingerprints).all())
+        self.assertNotEqual(g0.canonical_hash, g1.canonical_hash)
+        # A graph with the shape of allene, for which the four hydrogens can
+        # not be ordered based on the fingerprints alone.
+        g0 = Graph([(0,1), (1,2), (0,3), (0,4), (2,5), (2,6)])
+        g1 = Graph([(5,4), (4,6), (5,0), (5,3), (6,2), (6,1)])
+        self.assertEqual(g0.canonical_hash, g1.canonical_hash)
+        self.assertEqual(
+            g0.get_subgraph(g0.canonical_order, normalize=True).edges,
+            g1.get_subgraph(g1.canonical_order, normalize=True).edges,
+        )
+
+    def test_automorphisms(self):
+        for case in self.iter_cases(disconnected=True):
+            g = case.graph
+            edges = set(g.edges)
+            permutations = list(g.iter_automorphisms())
+            self.assertEqual(len(permutations), g.automorphism_group_order)
+            self.assertEqual(len(set(tuple(p) for p in permutations)), len(permutations))
+            for permutation in permutations:
+                self.assertEqual(set(frozenset(permutation[list(e)]) for e in edges), edges)
+            for cycles in g.automorphism_generators:
+                permutation = numpy.arange(g.num_vertices)
+                for cycle in cycles:
+                    self.assertEqual(cycle[0], min(cycle))
+                    permutation[list(cycle)] = cycle[1:] + cycle[:1]
+                self.assertEqual(set(frozenset(permutation[list(e)]) for e in edges), edges)
+            if len(g.independent_vertices) == 1:
+                self.assertEqual(g.automorphism_group_order, len(g.symmetries))
+            for vertex, orbit in enumerate(g.automorphism_orbits):
+                self.assertEqual(
+                    g.equivalent_vertices[vertex],
+                    set((g.automorphism_orbits == orbit).nonzero()[0])
+                )
+        # large groups
+        g = Graph([(a, b) for a in xrange(64) for b in xrange(a) if bin(a^b).count("1") == 1])
+        self.assertEqual(g.automorphism_group_order, 46080) # hypercube: 2**6*6!
+        self.assert_((g.automorphism_orbits == 0).all())
+        g = Graph([(3*i, 3*i+1) for i in xrange(20)] + [(3*i, 3*i+2) for i in xrange(20)])
+        self.assertEqual(g.automorphism_group_order, 2**20*2432902008176640000) # 2**20*20!
+        self.assertEqual(list(g.automorphism_orbits), [0, 1, 1]*20)
+        # disconnected graphs with interchangeable rigid components
+        g = MolecularGraph([(0, 1), (2, 3)], numpy.array([1, 9, 1, 9])) # 2 HF
+        self.assertEqual(g.automorphism_group_order, 2)
+        self.assertEqual(len(list(g.iter_automorphisms())), 2)
+        g = Graph([], 3)
+        self.assertEqual(g.automorphism_group_order, 6)
+        self.assertEqual(len(set(tuple(p) for p in g.iter_automorphisms())), 6)
+        g = Graph([(0, 1), (1, 2), (3, 4), (4, 5)], 8) # 2 chains, 2 isolated vertices
+        self.assertEqual(g.automorphism_group_order, 16)
+        self.assertEqual(len(set(tuple(p) for p in g.iter_automorphisms())), 16)
+
     def test_symmetries(self):
         cases = self.iter_cases()
         for case in cases:
@@ -633,6 +851,36 @@ class GraphTestCase(unittest.TestCase):
                     break
             self.assert_(found)
 
+    def test_subject_index(self):
+        subject_graph = Graph([(0,1),(1,2),(1,3),(2,4),(3,4),(4,5),(4,6)])
+        index = subject_graph._subject_index
+        self.assertEqual(index.get_vertices(3).tolist(), [1,4])
+        self.assertEqual(index.get_vertices(2, exact=True).tolist(), [2,3])
+        self.assertEqual(index.get_vertices(1, vertex_string="foo").tolist(), [])
+        fingerprint = subject_graph.vertex_fingerprints[2]
+        self.assertEqual(index.get_vertices(0, fingerprint=fingerprint).tolist(), [2,3])
+        pattern = CustomPattern(Graph([(0,1),(0,2),(0,3)]))
+        self.assertEqual(pattern.num_unmatched_neighbors, {0: 3, 1: 0, 2: 0, 3: 0})
+        self.assertEqual(list(pattern.iter_initial_relations(subject_graph)), [(0,1),(0,4)])
+
+    def test_custom_pattern_lookahead(self):
+        # compare the matches with a brute force search for subgraphs
+        import itertools
+        subject_graph = Graph([
+            (0,1),(1,2),(2,3),(3,4),(4,5),(5,0),(0,6),(6,7),(6,8),(3,9),(9,10),
+        ])
+        for pattern_edges in [(0,1),(1,2),(1,3),(3,4)], [(0,1),(1,2),(2,0),(0,3)]:
+            pattern_graph = Graph(pattern_edges)
+            expected = set([])
+            for images in itertools.permutations(xrange(subject_graph.num_vertices), pattern_graph.num_vertices):
+                if all(frozenset([images[i], images[j]]) in subject_graph.edge_index
+                       for i, j in pattern_graph.edges):
+                    expected.add(images)
+            matches = set([])
+            for match in GraphSearch(CustomPattern(pattern_graph))(subject_graph):
+                matches.add(tuple(match.forward[i] for i in xrange(pattern_graph.num_vertices)))
+            self.assertEqual(matches, expected)
+
     def test_pattern_lower_symmetry(self):
         subject_graph = Graph([
             (0,1),(1,2),(2,3),(3,4),(4,5),(5,0),
@@ -666,3 +914,50 @@ class GraphTestCase(unittest.TestCase):
             sizes.sort()
             sizes = tuple(sizes)
             self.assertEqual(sizes, expected_sizes)
+
+    def test_graph_search_workers(self):
+        mol = Molecule.from_file(context.get_fn("test/opt_5ring12T.xyz"))
+        mol.set_default_graph()
+        pattern = RingPattern(12)
+        expected = [match.ring_vertices for match in GraphSearch(pattern)(mol.graph)]
+        gs = GraphSearch(pattern, workers=2, ordered=True)
+        self.assertEqual([match.ring_vertices for match in gs(mol.graph)], expected)
+        gs = GraphSearch(pattern, workers=2)
+        self.assertEqual(sorted(match.ring_vertices for match in gs(mol.graph)), sorted(expected))
+        self.assertEqual(len(list(gs(mol.graph, one_match=True))), 1)
+
+    def test_graph_search_count_exists(self):
+        subject_graph = Graph([(0,1),(1,2),(2,3),(3,4),(4,5),(5,0),(0,6),(6,7),(3,8)])
+        patterns = [
+            RingPattern(8),
+            CustomPattern(Graph([(0,1),(1,2),(2,3)])),
+            CustomPattern(Graph([(0,1),(1,2),(2,3)]), [CriteriaSet()]),
+            CustomPattern(Graph([(0,1),(1,2),(2,0)])),
+        ]
+        for pattern in patterns:
+            gs = GraphSearch(pattern)
+            num_matches = len(list(gs(subject_graph)))
+            self.assertEqual(gs.count(subject_graph), num_matches)
+            self.assertEqual(gs.exists(subject_graph), num_matches > 0)
+        self.assertEqual(GraphSearch(patterns[-1]).count(subject_graph), 0)
+
+    def test_match_state(self):
+        from molmod.graphs import _MatchState
+        state = _MatchState(0, 3, 5)
+        state.push({1: 2, 2: 4})
+        self.assertEqual(len(state), 3)
+        self.assertEqual(state.forward[2], 4)
+        self.assertEqual(state.reverse.get(2), 1)
+        self.assert_(1 not in state.reverse)
+        self.assertEqual(sorted(state.get_new_edges(Graph([(3,2),(2,0),(4,1)]))), [(2,0),(4,1)])
+        state.add_relation(3, 0)
+        state.tag = "foo"
+        match = state.get_match(Match)
+        self.assertEqual(match.forward, {0: 3, 1: 2, 2: 4, 3: 0})
+        self.assertEqual(match.reverse, {3: 0, 2: 1, 4: 2, 0: 3})
+        self.assertEqual(match.tag, "foo")
+        state.pop()
+        self.assertEqual(len(state), 1)
+        self.assertEqual(dict(state.forward.iteritems()), {0: 3})
+        self.assertEqual(state.reverse.get(4), None)
+        self.assert_(not hasattr(state, "tag"))
@@ -22,7 +22,7 @@
 #--
 
 from molmod import *
-from molmod.bonds import BOND_SINGLE
+from molmod.bonds import BOND_SINGLE, bonds
 
 import unittest, numpy, os
 from nose.plugins.skip import SkipTest
@@ -335,6 +335,82 @@ class MolecularGraphTestCase(unittest.TestCase):
 
             self.verify_graph_search(molecule.graph, expected_results, test_results, iter_alternatives)
 
+    def test_multi_pattern_search(self):
+        molecule = self.load_molecule("tpa.xyz")
+        patterns = [
+            BondPattern([CriteriaSet(atom_criteria(1, 6), tag="HC")]),
+            DihedralAnglePattern([CriteriaSet(atom_criteria(1, 6, 6, 1), tag="HCCH")]),
+            BondPattern([
+                CriteriaSet(atom_criteria(6, 6), tag="CC"),
+                CriteriaSet(atom_criteria(6, 7), tag="CN"),
+            ]),
+            DihedralAnglePattern([CriteriaSet(atom_criteria(1, 6, 7, 6), tag="HCNC")]),
+            BondPattern(),
+            NRingPattern(5, [CriteriaSet(tag="ring")], strong=True),
+            NRingPattern(5, [CriteriaSet(tag="ring")]),
+        ]
+        multi_pattern_search = MultiPatternSearch(patterns)
+        self.assertEqual(len(multi_pattern_search.groups), 5)
+        results = dict((id(pattern), []) for pattern in patterns)
+        for pattern, match in multi_pattern_search(molecule.graph):
+            results[id(pattern)].append((getattr(match, "tag", None), match.forward))
+        for pattern in patterns:
+            expected = [
+                (getattr(match, "tag", None), match.forward)
+                for match in GraphSearch(pattern)(molecule.graph)
+            ]
+            self.assertEqual(sorted(results[id(pattern)]), sorted(expected))
+
+    def test_search_plan(self):
+        import cPickle
+        patterns = [
+            BondPattern([
+                CriteriaSet(atom_criteria(1, 6), tag="HC"),
+                CriteriaSet(edge_criteria={0: BondLongerThan(1.3*angstrom)}, tag="long"),
+            ]),
+            DihedralAnglePattern([
+                CriteriaSet(atom_criteria(1, 6, 6, HasNeighbors(*atom_criteria(1,1,6,6).values())), tag="HCCC"),
+                CriteriaSet(atom_criteria(None, 6, 6, None), tag="xCCx"),
+            ], vertex_tags={0: 1}),
+            NRingPattern(6),
+        ]
+        molecules = list(self.iter_molecules())
+        for molecule in molecules:
+            molecule.graph.bond_lengths = molecule.distance_matrix[molecule.graph.edge_array[:,0], molecule.graph.edge_array[:,1]]
+        for pattern in patterns:
+            plan = pattern.compile()
+            batch = plan.iter_batch(molecule.graph for molecule in molecules)
+            for molecule, matches in zip(molecules, batch):
+                expected = [
+                    (getattr(match, "tag", None), match.forward)
+                    for match in GraphSearch(pattern)(molecule.graph)
+                ]
+                self.assertEqual([(getattr(match, "tag", None), match.forward) for match in matches], expected)
+            # a pickled plan may pick other representatives of symmetric matches
+            plan = cPickle.loads(cPickle.dumps(plan))
+            batch = plan.iter_batch(molecule.graph for molecule in molecules)
+            for molecule, matches in zip(molecules, batch):
+                self.assertEqual(len(matches), GraphSearch(pattern).count(molecule.graph))
+        # the worker processes get the graphs without the bond lengths
+        plan = patterns[2].compile()
+        expected = list(plan.iter_batch(molecule.graph for molecule in molecules))
+        batch = plan.iter_batch((molecule.graph for molecule in molecules), workers=2, chunksize=3)
+        for matches0, matches1 in zip(expected, batch):
+            self.assertEqual([match.forward for match in matches0], [match.forward for match in matches1])
+        # patterns that override iter_final_matches
+        class ReversedBondPattern(BondPattern):
+            def iter_final_matches(self, canonical_match, subject_graph, one_match):
+                ifm = BondPattern.iter_final_matches(self, canonical_match, subject_graph, one_match)
+                for final_match in ifm:
+                    if final_match.forward[0] > final_match.forward[1]:
+                        yield final_match
+        for criteria_sets in None, [CriteriaSet(atom_criteria(6, 6), tag="CC")]:
+            pattern = ReversedBondPattern(criteria_sets)
+            plan = pattern.compile()
+            for molecule in molecules:
+                expected = [match.forward for match in GraphSearch(pattern)(molecule.graph)]
+                self.assertEqual([match.forward for match in plan.iter_matches(molecule.graph)], expected)
+
     # test other molecular graph stuff
 
     def test_multiply(self):
@@ -408,6 +484,25 @@ class MolecularGraphTestCase(unittest.TestCase):
             self.assertEqual(g1.num_vertices, len(group))
             self.assert_((g0.numbers[group]==g1.numbers).all())
 
+    def test_from_arrays(self):
+        for mol in self.iter_molecules(allow_multi=True):
+            g0 = mol.graph
+            symbols = tuple("A%i" % i for i in xrange(g0.num_vertices))
+            g1 = MolecularGraph.from_arrays(g0.edge_array, g0.numbers, g0.orders, symbols)
+            self.assertEqual(g1.edges, g0.edges)
+            self.assertEqual(g1.num_vertices, g0.num_vertices)
+            self.assert_((g1.orders == g0.orders).all())
+            self.assertEqual(g1.symbols, symbols)
+            # the symbols are carried through by get_subgraph
+            permutation = numpy.random.permutation(g1.num_vertices)
+            g2 = g1.get_subgraph(permutation, normalize=True)
+            self.assertEqual(g2.symbols, tuple(symbols[i] for i in permutation))
+            self.assert_((g2.orders == g0.orders[g2._old_edge_indexes]).all())
+        graph = MolecularGraph.from_arrays(numpy.zeros((0, 2), int), numpy.array([8]))
+        self.assertEqual(graph.num_edges, 0)
+        self.assertEqual(len(graph.orders), 0)
+        self.assertRaises(TypeError, MolecularGraph.from_arrays, [[0, 1]], numpy.array([1, 1]), symbols=("H",))
+
     def test_iter_shortest_paths(self):
         molecule = self.load_molecule("precursor.xyz")
         cases = {
@@ -440,23 +535,45 @@ class MolecularGraphTestCase(unittest.TestCase):
             self.assertEqual(len(match), g.num_vertices)
 
     def test_canonical_order(self):
-        # TODO: analogous tests voor pure graphs + fixen
         for molecule in self.iter_molecules():
-            try:
-                g0 = molecule.graph
-                order0 = g0.canonical_order
-                g0_bis = g0.get_subgraph(order0, normalize=True)
+            g0 = molecule.graph
+            order0 = g0.canonical_order
+            g0_bis = g0.get_subgraph(order0, normalize=True)
 
-                permutation = numpy.random.permutation(g0.num_vertices)
-                g1 = g0.get_subgraph(permutation, normalize=True)
-                order1 = g1.canonical_order
-                g1_bis = g1.get_subgraph(order1, normalize=True)
+            permutation = numpy.random.permutation(g0.num_vertices)
+            g1 = g0.get_subgraph(permutation, normalize=True)
+            order1 = g1.canonical_order
+            g1_bis = g1.get_subgraph(order1, normalize=True)
 
-                self.assertEqual(str(g0_bis), str(g1_bis))
-                self.assert_((g0_bis.numbers==g1_bis.numbers).all())
-                self.assert_((g0_bis.orders==g1_bis.orders).all())
-            except NotImplementedError:
-                pass
+            self.assertEqual(str(g0_bis), str(g1_bis))
+            self.assert_((g0_bis.numbers==g1_bis.numbers).all())
+            self.assert_((g0_bis.orders==g1_bis.orders).all())
+
+    def test_canonical_hash(self):
+        hashes = {}
+        for molecule in self.iter_molecules(allow_multi=True):
+            g0 = molecule.graph
+            permutation = numpy.random.permutation(g0.num_vertices)
+            g1 = g0.get_subgraph(permutation, normalize=True)
+            self.assertEqual(g0.canonical_hash, g1.canonical_hash)
+            # the canonical labels give identical graphs
+            g0_bis = g0.get_subgraph(g0.canonical_labels.argsort(), normalize=True)
+            g1_bis = g1.get_subgraph(g1.canonical_labels.argsort(), normalize=True)
+            self.assertEqual(g0_bis.edges, g1_bis.edges)
+            self.assert_((g0_bis.numbers==g1_bis.numbers).all())
+            self.assert_((g0_bis.orders==g1_bis.orders).all())
+            hashes[g0.canonical_hash] = g0
+        # all test molecules are different, including the pairs that have the
+        # same fingerprint
+        self.assertEqual(len(hashes), len(list(self.iter_molecules(allow_multi=True))))
+        # the atom numbers and bond orders matter
+        g0 = MolecularGraph([(0, 1), (1, 2)], [8, 1, 1])
+        g1 = MolecularGraph([(0, 1), (1, 2)], [1, 8, 1])
+        g2 = MolecularGraph([(0, 1), (1, 2)], [8, 1, 1], orders=[1, 2])
+        g3 = MolecularGraph([(1, 2), (0, 1)], [8, 1, 1], orders=[1, 2])
+        self.assertNotEqual(g0.canonical_hash, g1.canonical_hash)
+        self.assertNotEqual(g0.canonical_hash, g2.canonical_hash)
+        self.assertNotEqual(g2.canonical_hash, g3.canonical_hash)
 
     def test_blob(self):
         for molecule in self.iter_molecules(allow_multi=True):
@@ -522,6 +639,64 @@ class MolecularGraphTestCase(unittest.TestCase):
             pass
         HasNeighbors(HasAtomNumber(1), HasAtomNumber(6))
 
+    def test_criteria_masks(self):
+        from molmod.graphs import _get_mask
+        criteria = [
+            HasAtomNumber(6), HasNumNeighbors(4), HasNeighborNumbers(1, 1, 6, 6),
+            HasNeighborNumbers(6, 7, 8), Anything(),
+            CritAnd(HasAtomNumber(6), HasNumNeighbors(3)),
+            CritOr(HasAtomNumber(1), CritNot(HasNumNeighbors(1))),
+            CritXor(HasAtomNumber(6), HasNumNeighbors(4), HasNeighborNumbers(6)),
+        ]
+        for molecule in self.iter_molecules(allow_multi=True):
+            graph = molecule.graph
+            for criterion in criteria:
+                expected = [bool(criterion(i, graph)) for i in xrange(graph.num_vertices)]
+                self.assertEqual(_get_mask(criterion, graph).tolist(), expected)
+            # criteria without a mask
+            self.assertEqual(_get_mask(HasNeighbors(HasAtomNumber(1)), graph), None)
+            self.assertEqual(_get_mask(CritAnd(HasAtomNumber(1), HasNeighbors()), graph), None)
+
+    def test_criteria_masks_pattern(self):
+        molecule = self.load_molecule("tpa.xyz")
+        criteria_sets = [
+            CriteriaSet(atom_criteria(1, 6, 6, HasNeighborNumbers(6, 1, 1, 1)), tag="HCCC"),
+            CriteriaSet(atom_criteria(6, 7, 6, 6), tag="CNCC"),
+        ]
+        pattern = DihedralAnglePattern(criteria_sets)
+        masks = pattern.get_candidate_masks(molecule.graph)
+        # the end vertices are related to H, C or C atoms
+        numbers = molecule.numbers
+        self.assertEqual(masks[0].tolist(), ((numbers == 1) | (numbers == 6)).tolist())
+        self.assertEqual(masks[1].tolist(), ((numbers == 6) | (numbers == 7)).tolist())
+        graph_search = GraphSearch(pattern)
+        initial = list(graph_search._iter_initial_relations(molecule.graph, masks))
+        self.assertEqual(
+            [vertex1 for vertex0, vertex1 in initial],
+            [vertex1 for vertex1 in xrange(molecule.size) if numbers[vertex1] in (6, 7)]
+        )
+        # no masks when a criterion can not be vectorized
+        pattern = DihedralAnglePattern([CriteriaSet(atom_criteria(HasNeighbors(), 6, 6, 1))])
+        self.assertEqual(sorted(pattern.get_candidate_masks(molecule.graph)), [1, 2])
+
+    def test_criteria_masks_changed_pattern(self):
+        # C-O-C-H
+        graph = MolecularGraph([(0, 1), (1, 2), (2, 3)], numpy.array([6, 8, 6, 1]))
+        pattern = BendingAnglePattern([CriteriaSet(vertex_criteria={1: HasAtomNumber(8)})])
+        graph_search = GraphSearch(pattern)
+        self.assertEqual([match.forward[1] for match in graph_search(graph)], [1])
+        pattern.criteria_sets = [CriteriaSet(vertex_criteria={1: HasAtomNumber(6)})]
+        self.assertEqual([match.forward[1] for match in graph_search(graph)], [2])
+
+    def test_criteria_masks_one_match(self):
+        # The criteria sets are ignored when only one match is sought.
+        graph = MolecularGraph([(0, 1), (1, 2), (2, 3)], numpy.array([6, 8, 6, 1]))
+        pattern = BendingAnglePattern([CriteriaSet(vertex_criteria={1: HasAtomNumber(7)})])
+        graph_search = GraphSearch(pattern)
+        self.assertEqual(list(graph_search(graph)), [])
+        self.assertEqual(len(list(graph_search(graph, one_match=True))), 1)
+        self.assert_(not graph_search.exists(graph))
+
     def test_zirconium(self):
         mol = Molecule.from_file(context.get_fn('test/oh3siozroh3.xyz'))
         mol.set_default_graph()
@@ -536,6 +711,64 @@ class MolecularGraphTestCase(unittest.TestCase):
         mol.set_default_graph()
         assert len(mol.graph.edges)==12
 
+    def test_from_geometry_orders(self):
+        for mol in self.iter_molecules(allow_multi=True):
+            graph = MolecularGraph.from_geometry(mol, do_orders=True)
+            self.assertEqual(graph.edges, MolecularGraph.from_geometry(mol).edges)
+            self.assertEqual(len(graph.orders), graph.num_edges)
+            self.assertEqual(len(graph.bond_lengths), graph.num_edges)
+            for (i, j), order, length in zip(graph.edges, graph.orders, graph.bond_lengths):
+                self.assertAlmostEqual(length, mol.distance_matrix[i, j])
+                self.assertEqual(order, bonds.bonded(mol.numbers[i], mol.numbers[j], length))
+
+    def test_from_geometry_pruning(self):
+        # reference implementation of the 45 degree check, with loops
+        threshold = 0.5**0.5
+        for mol in self.iter_molecules(allow_multi=True):
+            graph = MolecularGraph.from_geometry(mol, scaling=1.5)
+            pairs = []
+            for i in xrange(mol.size):
+                for j in xrange(i):
+                    distance = mol.distance_matrix[i, j]
+                    if bonds.bonded(mol.numbers[i], mol.numbers[j], distance/1.5) is not None:
+                        pairs.append((i, j))
+            removed = set([])
+            for c in xrange(mol.size):
+                ns = [n for pair in pairs if c in pair for n in pair if n != c]
+                ns.sort(key=(lambda n: (-mol.distance_matrix[c, n], n)))
+                for i0, n0 in enumerate(ns):
+                    delta0 = mol.coordinates[n0] - mol.coordinates[c]
+                    for n1 in ns[:i0]:
+                        delta1 = mol.coordinates[n1] - mol.coordinates[c]
+                        cosine = numpy.dot(delta0, delta1)/numpy.linalg.norm(delta0)/numpy.linalg.norm(delta1)
+                        if cosine > threshold:
+                            removed.add(frozenset([c, n1]))
+            expected = set(frozenset(pair) for pair in pairs) - removed
+            self.assertEqual(set(graph.edges), expected)
+
+    def test_from_geometry_slabs(self):
+        def get_summary(graph):
+            return dict(
+                (frozenset(edge), (round(length, 10), order))
+                for edge, length, order
+                in zip(graph.edges, graph.bond_lengths, graph.orders)
+            )
+
+        for mol in self.iter_molecules(allow_multi=True):
+            extents = mol.coordinates.max(axis=0) - mol.coordinates.min(axis=0)
+            unit_cell = UnitCell(numpy.diag(extents + 1.5))
+            for uc in None, unit_cell:
+                mol_uc = Molecule(mol.numbers, mol.coordinates, unit_cell=uc)
+                expected = get_summary(MolecularGraph.from_geometry(mol_uc, do_orders=True))
+                for num_slabs in 1, 3, 7:
+                    graph = MolecularGraph.from_geometry(mol_uc, do_orders=True, num_slabs=num_slabs)
+                    self.assertEqual(get_summary(graph), expected)
+        # use a pool of worker processes
+        mol = Molecule.from_file(context.get_fn("test/thf.xyz"))
+        expected = get_summary(MolecularGraph.from_geometry(mol))
+        graph = MolecularGraph.from_geometry(mol, workers=2)
+        self.assertEqual(get_summary(graph), expected)
+
     def test_copy_with(self):
         for mol in self.iter_molecules():
             graph = mol.graph.copy_with()
@@ -90,3 +90,25 @@ class RandomizeTestCase(BaseTestCase):
                 self.assertEqual(mol_transformation.affected_atoms, check_transformation.affected_atoms)
                 self.assertArraysAlmostEqual(mol_transformation.transformation.r, check_transformation.transformation.r, 1e-5, doabs=True)
                 self.assertArraysAlmostEqual(mol_transformation.transformation.t, check_transformation.transformation.t, 1e-5, doabs=True)
+
+    def test_check_nonbond(self):
+        for molecule in self.iter_test_molecules():
+            graph = molecule.graph
+            for scale in 0.5, 1.0, 2.0:
+                thresholds = dict(
+                    (key, value*scale) for key, value
+                    in nonbond_thresholds.iteritems()
+                )
+                # reference implementation with the dense distance matrix
+                expected = True
+                for atom1 in xrange(graph.num_vertices):
+                    for atom2 in xrange(atom1):
+                        if graph.distances[atom1, atom2] > 2:
+                            distance = numpy.linalg.norm(molecule.coordinates[atom1] - molecule.coordinates[atom2])
+                            if distance < thresholds[frozenset([molecule.numbers[atom1], molecule.numbers[atom2]])]:
+                                expected = False
+                self.assertEqual(check_nonbond(molecule, thresholds), expected)
+        # no thresholds
+        molecule = Molecule([8, 1, 1], numpy.array([[0.0, 0.0, 0.0], [1.8, 0.0, 0.0], [0.0, 1.8, 0.0]]))
+        molecule.set_default_graph()
+        self.assert_(check_nonbond(molecule, {}))
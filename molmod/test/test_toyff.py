@@ -84,7 +84,10 @@ class ToyFFTestCase(unittest.TestCase):
                 unit_cell = None
                 dm = molecules_distance_matrix(coordinates)
             else:
-                dm = molecules_distance_matrix(coordinates, unit_cell.matrix, unit_cell.reciprocal)
+                # the force field uses the exact minimum image convention
+                deltas = coordinates.reshape(-1, 1, 3) - coordinates
+                deltas = unit_cell.shortest_vector(deltas.reshape(-1, 3), exact=True)
+                dm = numpy.sqrt((deltas**2).sum(axis=1)).reshape(N, N)
             if dm[mask].min() > 1.0:
                 break
 
@@ -186,6 +186,50 @@ class UnitCellTestCase(BaseTestCase):
         self.assertArraysEqual(uc.shortest_vector(half), -half)
         self.assertArraysEqual(uc.shortest_vector(-half), -half)
 
+    def test_shortest_vector_exact(self):
+        for uc_counter in xrange(100):
+            uc = self.get_random_uc(full=False)
+            r0 = numpy.random.normal(0, 3, (10,3))
+            r1 = uc.shortest_vector(r0, exact=True)
+            for i in xrange(10):
+                # brute force search over all lattice vectors that are at most
+                # twice as long as r0 (enumerated with the reduced cell vectors
+                # to keep the number of indexes manageable)
+                ranges = uc.reduced.get_radius_ranges(2*numpy.linalg.norm(r0[i]))
+                indexes = numpy.indices(ranges*2+1).reshape(3, -1).T - ranges
+                images = r0[i] - uc.reduced.to_cartesian(indexes)
+                norms = numpy.sqrt((images**2).sum(axis=1))
+                self.assertAlmostEqual(numpy.linalg.norm(r1[i]), norms.min())
+                index = uc.to_fractional(r0[i]-r1[i])
+                self.assertArraysAlmostEqual(index, numpy.round(index), doabs=True)
+                r1_row_bis = uc.shortest_vector(r0[i], exact=True)
+                self.assertArraysAlmostEqual(r1_row_bis, r1[i], doabs=True)
+
+    def test_reduced(self):
+        for uc_counter in xrange(100):
+            uc = self.get_random_uc(full=False)
+            reduced = uc.reduced
+            self.assertArraysEqual(reduced.active, uc.active)
+            self.assertAlmostEqual(abs(reduced.volume), abs(uc.volume))
+            # the reduced cell vectors are lattice vectors of the original cell
+            index = uc.to_fractional((reduced.matrix*reduced.active).transpose())
+            self.assertArraysAlmostEqual(index, numpy.round(index), doabs=True)
+            self.assert_(reduced.reduced is reduced)
+
+    def test_image_candidates(self):
+        uc = UnitCell(numpy.diag([3.0, 4.0, 5.0]))
+        self.assertArraysEqual(uc.image_candidates, numpy.zeros((1, 3), float))
+        uc = UnitCell(numpy.array([[1.0, 3.5, 0.0], [0.0, 0.5*numpy.sqrt(3), 0.0], [0.0, 0.0, 1.0]]))
+        candidates = uc.image_candidates
+        self.assertArraysEqual(candidates[0], numpy.zeros(3, float))
+        self.assert_(len(candidates) > 1)
+        norms = numpy.sqrt((candidates**2).sum(axis=1))
+        self.assert_((norms[1:] >= norms[:-1]).all())
+        # rounding in the skewed cell is far from the shortest vector
+        delta = numpy.array([0.55, 0.45, 0.0])
+        self.assert_(numpy.linalg.norm(uc.shortest_vector(delta)) > 0.5)
+        self.assert_(numpy.linalg.norm(uc.shortest_vector(delta, exact=True)) < 0.5)
+
     def test_spacings(self):
         uc = UnitCell(numpy.identity(3,float)*3)
         self.assertArraysAlmostEqual(uc.spacings, numpy.ones(3, float)*3.0)
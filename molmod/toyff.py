@@ -32,6 +32,7 @@
 from molmod import context
 from molmod.molecules import Molecule
 from molmod.periodic import periodic
+from molmod.utils import cached
 
 from molmod.ext import ff_dm_quad, ff_dm_reci, ff_bond_quad, ff_bond_hyper
 
@@ -178,14 +179,21 @@ class ToyFF(object):
         if unit_cell is None:
             self.matrix = None
             self.reciprocal = None
+            self.images = numpy.zeros((0, 3), float)
         else:
-            self.matrix = unit_cell.matrix
-            self.reciprocal = unit_cell.reciprocal
-
-        self.dm = graph.distances.astype(numpy.int32)
-        dm = self.dm.astype(float)
-        self.dm0 = dm**2
-        self.dmk = (dm+0.1)**(-3)
+            # exact minimum image convention, see UnitCell.image_candidates
+            self.matrix = unit_cell.reduced.matrix
+            self.reciprocal = unit_cell.reduced.reciprocal
+            self.images = unit_cell.image_candidates
+
+        self.graph = graph
+        # The repulsion between atoms (dm_reci) excludes bonded atoms and atoms
+        # in different molecules. It only needs the sparse list of neighbors.
+        # The dense graph distance matrix is only used for dm_quad.
+        self.labels = graph.component_labels.astype(numpy.int32)
+        indptr, indices, distances = graph.get_distances(1)
+        self.excluded_indptr = indptr.astype(numpy.int32)
+        self.excluded_indices = indices.astype(numpy.int32)
         self.vdw_radii = numpy.array([periodic[number].vdw_radius for number in graph.numbers], dtype=float)
         self.covalent_radii = numpy.array([periodic[number].covalent_radius for number in graph.numbers], dtype=float)
 
@@ -224,7 +232,7 @@ class ToyFF(object):
             for j in neighbors:
                 number_j = graph.numbers[j]
                 for k in neighbors:
-                    if j < k and not frozenset([j, k]) in graph.edges:
+                    if j < k and not k in graph.neighbors[j]:
                         number_k = graph.numbers[k]
 
                         triplet = (
@@ -252,6 +260,21 @@ class ToyFF(object):
         self.bond_hyper = 0.0
         self.bond_hyper_scale = 5.0
 
+    @cached
+    def dm(self):
+        """The matrix with graph distances"""
+        return self.graph.distances.astype(numpy.int32)
+
+    @cached
+    def dm0(self):
+        """The squared graph distances, i.e. the rest lengths of dm_quad"""
+        return self.dm.astype(float)**2
+
+    @cached
+    def dmk(self):
+        """The force constants of dm_quad"""
+        return (self.dm.astype(float)+0.1)**(-3)
+
     def __call__(self, x, do_gradient=False):
         """Compute the energy (and gradient) for a set of Cartesian coordinates
 
@@ -266,22 +289,26 @@ class ToyFF(object):
         gradient = numpy.zeros(x.shape, float)
         if self.dm_quad > 0.0:
             result += ff_dm_quad(x, self.dm0, self.dmk, self.dm_quad,
-                                 gradient, self.matrix, self.reciprocal)
+                                 gradient, self.images, self.matrix,
+                                 self.reciprocal)
         if self.dm_reci:
-            result += ff_dm_reci(x, self.vdw_radii, self.dm, self.dm_reci,
-                                 gradient, self.matrix, self.reciprocal)
+            result += ff_dm_reci(x, self.vdw_radii, self.labels,
+                                 self.excluded_indptr, self.excluded_indices,
+                                 self.dm_reci, gradient, self.images,
+                                 self.matrix, self.reciprocal)
         if self.bond_quad:
             result += ff_bond_quad(x, self.bond_edges, self.bond_lengths,
-                                   self.bond_quad, gradient, self.matrix,
-                                   self.reciprocal)
+                                   self.bond_quad, gradient, self.images,
+                                   self.matrix, self.reciprocal)
         if self.span_quad:
             result += ff_bond_quad(x, self.span_edges, self.span_lengths,
-                                   self.span_quad, gradient, self.matrix,
-                                   self.reciprocal)
+                                   self.span_quad, gradient, self.images,
+                                   self.matrix, self.reciprocal)
         if self.bond_hyper:
             result += ff_bond_hyper(x, self.bond_edges, self.bond_lengths,
                                     self.bond_hyper_scale, self.bond_hyper,
-                                    gradient, self.matrix, self.reciprocal)
+                                    gradient, self.images, self.matrix,
+                                    self.reciprocal)
 
         if do_gradient:
             return result, gradient.ravel()
@@ -32,6 +32,17 @@ import numpy
 __all__ = ["UnitCell"]
 
 
+def _gram_schmidt(basis):
+    """Orthogonalize a list of vectors without normalization"""
+    result = []
+    for vector in basis:
+        vector = vector.copy()
+        for other in result:
+            vector -= numpy.dot(vector, other)/numpy.dot(other, other)*other
+        result.append(vector)
+    return result
+
+
 class UnitCell(ReadOnly):
     """Extensible representation of a unit cell.
 
@@ -197,6 +208,39 @@ class UnitCell(ReadOnly):
         order = active + inactive
         return UnitCell(self.matrix[:,order], self.active[order])
 
+    @cached
+    def reduced(self):
+        """An equivalent unit cell with LLL-reduced active cell vectors
+
+           The reduced cell describes the same lattice, but its active cell
+           vectors are short and nearly orthogonal. Inactive cell vectors are
+           left untouched.
+        """
+        active = self.active_inactive[0]
+        basis = [self.matrix[:, i].copy() for i in active]
+        k = 1
+        while k < len(basis):
+            # size reduction of basis vector k
+            for j in xrange(k-1, -1, -1):
+                ortho = _gram_schmidt(basis)
+                mu = numpy.dot(basis[k], ortho[j])/numpy.dot(ortho[j], ortho[j])
+                if abs(mu) > 0.5:
+                    basis[k] -= numpy.round(mu)*basis[j]
+            # Lovasz condition
+            ortho = _gram_schmidt(basis)
+            mu = numpy.dot(basis[k], ortho[k-1])/numpy.dot(ortho[k-1], ortho[k-1])
+            if numpy.dot(ortho[k], ortho[k]) >= (0.75 - mu*mu)*numpy.dot(ortho[k-1], ortho[k-1]):
+                k += 1
+            else:
+                basis[k], basis[k-1] = basis[k-1], basis[k]
+                k = max(k-1, 1)
+        matrix = self.matrix.copy()
+        for i, vector in zip(active, basis):
+            matrix[:, i] = vector
+        result = UnitCell(matrix, self.active)
+        result._cache_reduced = result
+        return result
+
     @cached
     def alignment_a(self):
         """Computes the rotation matrix that aligns the unit cell with the
@@ -267,21 +311,90 @@ class UnitCell(ReadOnly):
         """
         return numpy.dot(fractional, self.matrix.transpose())
 
-    def shortest_vector(self, delta):
+    @cached
+    def image_candidates(self):
+        """Lattice translations that may shorten a rounded relative vector
+
+           After rounding the fractional coordinates with respect to the
+           :attr:`reduced` cell (see :meth:`shortest_vector`), a relative vector
+           lies in the parallelepiped spanned by the reduced (active) cell
+           vectors, centered at the origin. Its length is at most ``R``, half
+           the longest diagonal of the reduced cell, such
+           that the translation to the shortest image can never be longer than
+           ``2*R``. A translation ``t`` can only shorten some vector ``r`` in
+           the parallelepiped if ``2*dot(r, t) > dot(t, t)``, which is
+           feasible only when ``sum_i |dot(a_i, t)| > dot(t, t)``, where
+           ``a_i`` are the reduced active cell vectors.
+
+           This attribute is an array with shape (K, 3) containing all
+           Cartesian lattice translations that pass both tests, sorted by
+           length. The first row is always the zero translation. For
+           orthorhombic cells, it is the only row.
+        """
+        reduced = self.reduced
+        active = reduced.active_inactive[0]
+        if len(active) == 0:
+            return numpy.zeros((1, 3), float)
+        matrix = reduced.matrix[:, active]
+        # half the longest diagonal of the (active part of the) cell
+        signs = numpy.indices((2,)*len(active)).reshape(len(active), -1).T*2-1
+        radius = numpy.sqrt((numpy.dot(0.5*signs, matrix.T)**2).sum(axis=1)).max()
+        # all lattice points within twice that radius
+        ranges = reduced.get_radius_ranges(2*radius)
+        indexes = numpy.indices(ranges*2+1).reshape(3, -1).T - ranges
+        candidates = reduced.to_cartesian(indexes)
+        normsq = (candidates**2).sum(axis=1)
+        reach = abs(numpy.dot(candidates, matrix)).sum(axis=1)
+        mask = (normsq <= 4*radius*radius) & (reach > normsq*(1+1e-10))
+        mask[normsq == 0] = True
+        norms = numpy.sqrt(normsq)
+        order = norms[mask].argsort(kind="mergesort")
+        return candidates[mask][order]
+
+    def shortest_vector(self, delta, exact=False):
         """Compute the relative vector under periodic boundary conditions.
 
            Argument:
             | ``delta``  --  the relative vector between two points
 
-           The return value is not necessarily the shortest possible vector,
-           but instead is the vector with fractional coordinates in the range
-           [-0.5,0.5[. This is most of the times the shortest vector between
-           the two points, but not always. (See commented test.) It is always
-           the shortest vector for orthorombic cells.
+           Optional argument:
+            | ``exact``  --  when True, the shortest image is searched among
+                             :attr:`image_candidates`. [default=False]
+
+           Without the exact option, the return value is not necessarily the
+           shortest possible vector, but instead is the vector with fractional
+           coordinates in the range [-0.5,0.5[. This is most of the times the
+           shortest vector between the two points, but not always. (See
+           commented test.) It is always the shortest vector for orthorombic
+           cells. With the exact option, the rounding is carried out in the
+           :attr:`reduced` cell and the result is the shortest vector, also for
+           strongly skewed cells. Ties are resolved in favor of the rounded
+           vector. The argument may have shape (3,) or (N, 3).
         """
-        fractional = self.to_fractional(delta)
+        if exact:
+            cell = self.reduced
+        else:
+            cell = self
+        fractional = cell.to_fractional(delta)
         fractional = numpy.floor(fractional + 0.5)
-        return delta - self.to_cartesian(fractional)
+        result = delta - cell.to_cartesian(fractional)
+        if exact:
+            candidates = self.image_candidates
+            if len(candidates) > 1:
+                # |r - t|^2 - |r|^2 = |t|^2 - 2 r.t for all candidates t
+                scores = (candidates**2).sum(axis=1) - 2*numpy.dot(result, candidates.T)
+                best = scores.argmin(axis=-1)
+                # only accept a significant improvement, which keeps ties
+                # consistent with the rounded result
+                tolerance = 1e-10*(candidates[-1]**2).sum()
+                if result.ndim == 1:
+                    if scores[best] < -tolerance:
+                        result = result - candidates[best]
+                else:
+                    rows = numpy.arange(len(result))
+                    best[scores[rows, best] >= -tolerance] = 0
+                    result = result - candidates[best]
+        return result
 
     def add_cell_vector(self, vector):
         """Returns a new unit cell with an additional cell vector"""
@@ -62,11 +62,16 @@ class ZMatrixGenerator(object):
         # to one of the previous atoms. It is the user's responsability to make
         # sure that heavier atoms come first.
         new_order = [0]
+        # Only the bonded neighbors are needed, not the full distance matrix.
+        indptr, indices, distances = graph.get_distances(1)
+        ordered = numpy.zeros(graph.num_vertices, bool)
+        ordered[0] = True
         # We will try to take the original order as long as it satisfies the
         # constraint.
         for i in xrange(1, graph.num_vertices):
-            if (graph.distances[i][new_order] == 1).any():
+            if ordered[indices[indptr[i]:indptr[i+1]]].any():
                 new_order.append(i)
+                ordered[i] = True
             else:
                 break
         # If not all atoms are listed in new_order, we continue adding the
@@ -75,8 +80,9 @@ class ZMatrixGenerator(object):
         remaining = range(len(new_order), graph.num_vertices)
         while len(remaining) > 0:
             pivot = remaining.pop()
-            if (graph.distances[pivot][new_order] == 1).any():
+            if ordered[indices[indptr[pivot]:indptr[pivot+1]]].any():
                 new_order.append(pivot)
+                ordered[pivot] = True
             else:
                 remaining.insert(0, pivot)
         # store the orders as indexes
@@ -79,7 +79,7 @@ setup(
     ext_modules=[
         Extension("molmod.ext", ["molmod/ext.pyf", "molmod/common.c",
             "molmod/ff.c", "molmod/graphs.c", "molmod/similarity.c",
-            "molmod/molecules.c", "molmod/unit_cells.c",
+            "molmod/molecules.c", "molmod/unit_cells.c", "molmod/binning.c",
         ]),
     ],
     classifiers=[